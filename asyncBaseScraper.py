@@ -0,0 +1,150 @@
+import asyncio, concurrent.futures, functools, http.server, threading, time, unittest
+import logging
+logger = logging.getLogger(__name__)
+
+import requests
+
+from baseScraper import BaseScraper
+from rateLimiter import TokenBucket, AdaptiveRateController
+
+class AsyncBaseScraper(BaseScraper):
+    """
+    A BaseScraper that can also make requests from asyncio coroutines.
+
+    Every request (sync or async) takes a token from the shared self.rate_limiter, so we
+    still make at most one request per crawl delay.  But with several requests in flight,
+    the DNS/TLS/transfer time of one request overlaps with the wait for the next, instead
+    of adding to it.  The blocking requests.Session calls run in a thread pool of
+    max_in_flight threads.
+    """
+    def __init__(self, max_in_flight=4, **kwargs):
+        """
+        Params:
+            max_in_flight - most requests in flight at once in async mode
+            kwargs - passed to BaseScraper
+        """
+        super().__init__(**kwargs)
+
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._executor = None
+
+    async def asyncSessionGet(self, url, params=None, conditional=False, **kwargs):
+        """
+        Like BaseScraper.sessionGet, but awaits the rate limiter and the response.
+        Only use this from a coroutine running under .runOnEventLoop().
+        """
+        response = self.getCachedResponse(url, params)
+        if response is not None:
+            return response
+
+        key = self.prepareRequest(url, params, conditional, kwargs)
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.rate_controller.max_retries + 1):
+            await self.rate_limiter.acquireAsync()
+            _t = time.monotonic()
+            try:
+                response = await loop.run_in_executor(self._executor,
+                                                      functools.partial(self.session.get, url, params=params, **kwargs))
+            except requests.RequestException:
+                self.rate_controller.recordError(url, time.monotonic() - _t)
+                raise
+            if not self.rate_controller.onResponse(url, response, time.monotonic() - _t):
+                break
+
+        self.handleResponse(url, params, key, response)
+        return response
+
+    def runOnEventLoop(self, coroutine_function, *args, **kwargs):
+        """
+        Read robots.txt, then run coroutine_function(*args, **kwargs) to completion on a new
+        event loop and return its result.
+        """
+        self.loadRobots()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight) as self._executor:
+            try:
+                return asyncio.run(coroutine_function(*args, **kwargs))
+            finally:
+                self._executor = None
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves self.server.robots_text at /robots.txt and a small page everywhere else, and
+    records when each request came in (in self.server.request_times)
+    """
+    def do_GET(self):
+        self.server.request_times.append((self.path, time.monotonic()))
+        body = (self.server.robots_text if self.path == '/robots.txt' else '<html></html>').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain' if self.path == '/robots.txt' else 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Test(unittest.TestCase):
+    """
+    Runs AsyncBaseScraper against a stub server on localhost; run with
+    python -m unittest asyncBaseScraper
+    """
+    def startServer(self, robots_text):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.robots_text = robots_text
+        self.server.request_times = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def makeScraper(self, crawl_delay, max_in_flight=4):
+        scraper = AsyncBaseScraper(max_in_flight=max_in_flight)
+        scraper.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        scraper.session.trust_env = False # no proxies for localhost
+        scraper.crawl_delay = crawl_delay
+        scraper.rate_limiter = TokenBucket(crawl_delay)
+        scraper.rate_controller = AdaptiveRateController(scraper.rate_limiter, crawl_delay)
+        self.addCleanup(scraper.session.close)
+        return scraper
+
+    def fetchAll(self, scraper, paths):
+        async def fetch_all():
+            return await asyncio.gather(*(scraper.asyncSessionGet(scraper.base_url + path) for path in paths))
+        return scraper.runOnEventLoop(fetch_all)
+
+    def requestGaps(self):
+        times = [t for _, t in self.server.request_times]
+        return [b - a for a, b in zip(times, times[1:])]
+
+    def testConcurrentRequestsAreSpaced(self):
+        self.startServer('User-agent: *\nDisallow: /private/\n')
+        scraper = self.makeScraper(0.2)
+        responses = self.fetchAll(scraper, ['/page/{}'.format(i) for i in range(6)])
+
+        self.assertEqual([response.status_code for response in responses], [200]*6)
+        # robots.txt and the 6 pages, each at least a crawl delay after the last
+        # (less a bit for when the server thread gets to them)
+        self.assertEqual(len(self.server.request_times), 7)
+        for gap in self.requestGaps():
+            self.assertGreater(gap, 0.15)
+
+    def testRobotsDisallow(self):
+        self.startServer('User-agent: *\nDisallow: /private/\n')
+        scraper = self.makeScraper(0.05)
+        with self.assertRaises(RuntimeError):
+            self.fetchAll(scraper, ['/page/1', '/private/2'])
+        self.assertNotIn('/private/2', [path for path, _ in self.server.request_times])
+
+    def testLongerCrawlDelay(self):
+        # robotparser only takes whole seconds
+        self.startServer('User-agent: *\nCrawl-delay: 1\n')
+        scraper = self.makeScraper(0.05)
+        self.fetchAll(scraper, ['/page/1', '/page/2'])
+
+        self.assertEqual(scraper.crawl_delay, 1.)
+        for gap in self.requestGaps():
+            self.assertGreater(gap, 0.9)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,34 +1,65 @@
-import argparse, datetime, os, json, csv
+import argparse, asyncio, datetime, os, json, csv
 import logging
 logger = logging.getLogger(__name__)
 
-import bs4
-
-from baseScraper import BaseScraper
+from asyncBaseScraper import AsyncBaseScraper
+from checkpoint import Checkpoint, sync_file
+from insert_basic_info import InsertBasicInfo
+from fragments import parse_band_rows
+from responseCache import add_cache_arguments, cache_from_args
  
-class BandListScraper(BaseScraper):
+class BandListScraper(AsyncBaseScraper):
     """
     Collects brief band info from https://www.metal-archives.com/browse/letter
     """
-    def __init__(self, outfile='', test=False):
+    def __init__(self, outfile='', test=False, use_async=False, max_in_flight=4,
+                 soup_features='html5lib', cache=None, resume=False,
+                 database_filename=None):
         """
         Params:
             outfile - where to put CSV
             test - do a shorter test instead of a full run
+            use_async - make the requests for each letter concurrently (still at most one
+                        request per crawl delay); see AsyncBaseScraper
+            max_in_flight - most requests in flight at once with use_async
+            soup_features - BeautifulSoup parser backend ('html5lib', 'lxml', or 'html.parser')
+            cache - a responseCache.ResponseCache to replay/record responses
+            resume - continue from the checkpoint for outfile (if there is one), appending
+                     to outfile
+            database_filename - insert each page straight into this sqlite3 database (see
+                                InsertBasicInfo) instead of writing a CSV
         """
-        super().__init__()
+        super().__init__(max_in_flight=max_in_flight, cache=cache, soup_features=soup_features)
+        
+        self.inserter = None
+        if database_filename:
+            self.inserter = InsertBasicInfo(database_filename)
+            # only used to name the checkpoint
+            outfile = database_filename + '.band_list'
+        
+        if resume and not outfile:
+            raise ValueError('Need the outfile to resume')
         
         if not outfile:
             date = datetime.datetime.utcnow()
             date_str = date.strftime('%Y%m%d_%H%M%S')
             outfile = 'metal-archives_band_list_' + date_str + '.csv'
         self.outfile = str(outfile)
-        print('Will output band data to', self.outfile)
+        if self.inserter is None:
+            print('Will output band data to', self.outfile)
+        else:
+            print('Will insert band data into', database_filename)
         
         self.test = bool(test)
         if self.test:
             print('Doing a shorter test run instead of a full scrape')
         
+        self.use_async = bool(use_async)
+        
+        self.resume = bool(resume)
+        self.checkpoint = Checkpoint(Checkpoint.filenameFor(self.outfile))
+        self.records_before = 0
+        
         # letters used in the browse tabs: A-Z, NBR, ~
         self.letters = ['NBR', '~']
         self.letters.extend(map(chr, range(ord('A'), ord('Z')+1)))
@@ -45,8 +76,12 @@ class BandListScraper(BaseScraper):
         """
         Do the stuff.  Will close things at the end of .run()
         """
+        state = self.checkpoint.load() if self.resume else None
+        if self.resume and state is None:
+            print('No checkpoint for "{}"; starting from the beginning'.format(self.outfile))
+        
         # check if the output file already exists and ask the user if they wish to overwrite
-        if os.path.isfile(self.outfile):
+        if self.inserter is None and state is None and os.path.isfile(self.outfile):
             print('The outfile "{}" already exists.'.format(self.outfile))
             response = input('Overwrite (y/n): ').lower()
             if response != 'y':
@@ -55,39 +90,128 @@ class BandListScraper(BaseScraper):
             else:
                 print('Okay, will overwrite')
         
-        self.openOutfile()
+        self.openOutfile(state['offset'] if state else None)
+        self.records_before = state['records_before'] if state else 0
+        work = self.remainingWork(state)
         
-        total_records_sum = 0
-        for letter in self.letters:
-            print('Getting stuff for letter =', letter)
-            
+        if self.use_async:
+            self.runOnEventLoop(self.runAsync, work)
+        else:
+            for letter, last_start, total_records in work:
+                self.scrapeLetter(letter, last_start, total_records)
+        
+        self.close()
+        self.closeOutfile()
+        self.checkpoint.remove()
+        
+        if self.inserter is None:
+            print('There should be {} rows in {}'.format(self.records_before+1, self.outfile))
+        else:
+            print('There should be {} bands in {}'.format(self.records_before, self.inserter.database_filename))
+    
+    def remainingWork(self, state):
+        """
+        Return a list of (letter, last_start, total_records) still to do, given the state
+        from the checkpoint (or None to do everything).  last_start and total_records are
+        None for letters we haven't started.
+        """
+        if state is None:
+            return [(letter, None, None) for letter in self.letters]
+        
+        if state['key'] not in self.letters:
+            raise ValueError('Checkpoint {} is for letter {}, which is not in {}'.format(
+                self.checkpoint.filename, state['key'], self.letters))
+        
+        print('Resuming from letter={} after start={}'.format(state['key'], state['last_start']))
+        i = self.letters.index(state['key'])
+        return ([(state['key'], state['last_start'], state['total_records'])]
+                + [(letter, None, None) for letter in self.letters[i+1:]])
+    
+    def scrapeLetter(self, letter, last_start=None, total_records=None):
+        """
+        Get all the bands for one letter and write them to the outfile, starting after
+        last_start if given (when resuming).
+        Returns the total number of records for the letter.
+        """
+        print('Getting stuff for letter =', letter)
+        
+        if last_start is None:
             # Make the first request
             # That will tell us the total number of entries for this letter
-            start = 0
-            data = self.makeRequest(letter, start=start)
+            data = self.makeRequest(letter, start=0)
             
             self.writeBandData(data['aaData'])
-           
-            total_records = data['iTotalRecords']
-            total_records_sum += total_records
-            print('There are {} records for letter "{}"'.format(total_records, letter))
             
-            n_do = max(0, total_records - self.display_length) // self.display_length + 1
-            if self.test:
-                n_do = min(2, n_do)
-            print('Going to do {} more requests'.format(n_do))
+            total_records = data['iTotalRecords']
+            self.saveCheckpoint(letter, 0, total_records)
+        
+        # Now make all the other requests
+        for start in self.remainingStarts(letter, total_records, last_start):
+            data = self.makeRequest(letter, start=start)
             
-            # Now make all the other requests
-            for _ in range(n_do):
-                start += self.display_length
-                data = self.makeRequest(letter, start=start)
+            self.writeBandData(data['aaData'])
+            self.saveCheckpoint(letter, start, total_records)
+        
+        self.records_before += total_records
+        return total_records
+    
+    async def runAsync(self, work):
+        """
+        Like the sequential part of .run(), but each letter's requests after the first
+        are in flight concurrently.  Results are still written (and checkpointed) in order.
+        """
+        for letter, last_start, total_records in work:
+            print('Getting stuff for letter =', letter)
             
+            if last_start is None:
+                data = await self.makeRequestAsync(letter, start=0)
                 self.writeBandData(data['aaData'])
+                
+                total_records = data['iTotalRecords']
+                self.saveCheckpoint(letter, 0, total_records)
+            
+            starts = self.remainingStarts(letter, total_records, last_start)
+            tasks = [asyncio.ensure_future(self.makeRequestAsync(letter, start=start))
+                     for start in starts]
+            try:
+                for start, task in zip(starts, tasks):
+                    data = await task
+                    self.writeBandData(data['aaData'])
+                    self.saveCheckpoint(letter, start, total_records)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            
+            self.records_before += total_records
         
-        self.close()
-        self.closeOutfile()
+        return self.records_before
+    
+    def saveCheckpoint(self, letter, start, total_records):
+        """
+        Record that the page for letter at start is safely in the outfile
+        """
+        self.checkpoint.save({'key': letter,
+                              'last_start': start,
+                              'total_records': total_records,
+                              'records_before': self.records_before,
+                              'offset': sync_file(self.outfile_handle) if self.inserter is None else None})
+    
+    def remainingStarts(self, letter, total_records, last_start=None):
+        """
+        Return the iDisplayStart values of the requests after the first (and after
+        last_start, if given)
+        """
+        print('There are {} records for letter "{}"'.format(total_records, letter))
+        
+        n_do = max(0, total_records - self.display_length) // self.display_length + 1
+        if self.test:
+            n_do = min(2, n_do)
+        starts = [self.display_length*(i+1) for i in range(n_do)]
+        if last_start is not None:
+            starts = [start for start in starts if start > last_start]
+        print('Going to do {} more requests'.format(len(starts)))
         
-        print('There should be {} rows in {}'.format(total_records_sum+1, self.outfile))
+        return starts
     
     def close(self):
         super().close()
@@ -96,6 +220,22 @@ class BandListScraper(BaseScraper):
         """
         Make a GET request and return the JSON response as a dict
         """
+        url, payload = self.requestArgs(letter, start)
+        response = self.sessionGet(url, params=payload)
+        return self.parseResponse(response)
+    
+    async def makeRequestAsync(self, letter, start=0):
+        """
+        Like .makeRequest(), but async
+        """
+        url, payload = self.requestArgs(letter, start)
+        response = await self.asyncSessionGet(url, params=payload)
+        return self.parseResponse(response)
+    
+    def requestArgs(self, letter, start):
+        """
+        Return the URL and params for the request for letter starting at start
+        """
         url = self.base_url + '/browse/ajax-letter/l/' + str(letter) + '/json/1'
         
         if start % self.display_length != 0:
@@ -107,8 +247,9 @@ class BandListScraper(BaseScraper):
                    'iDisplayLength': self.display_length}
         
         print('Making request for letter={} start={}'.format(letter, start))
-        response = self.sessionGet(url, params=payload)
-        
+        return url, payload
+    
+    def parseResponse(self, response):
         try:
             data = response.json()
         except json.JSONDecodeError as e:
@@ -117,12 +258,26 @@ class BandListScraper(BaseScraper):
         
         return data
     
-    def openOutfile(self):
-        self.outfile_handle = open(self.outfile, 'w')
+    def openOutfile(self, offset=None):
+        """
+        Open the outfile and write the header, or, when resuming, cut the outfile back
+        to offset (the end of the last checkpointed page) and append to it.
+        With a database, just connect to it.
+        """
+        if self.inserter is not None:
+            self.inserter.connect()
+            return
         
         fieldnames = ('band_url', 'band', 'country', 'genre', 'status')
-        self.outfile_writer = csv.DictWriter(self.outfile_handle, fieldnames)
-        self.outfile_writer.writeheader()
+        if offset is None:
+            self.outfile_handle = open(self.outfile, 'w')
+            self.outfile_writer = csv.DictWriter(self.outfile_handle, fieldnames)
+            self.outfile_writer.writeheader()
+        else:
+            self.outfile_handle = open(self.outfile, 'r+')
+            self.outfile_handle.truncate(offset)
+            self.outfile_handle.seek(0, os.SEEK_END)
+            self.outfile_writer = csv.DictWriter(self.outfile_handle, fieldnames)
     
     def writeBandData(self, band_data):
         """
@@ -134,31 +289,23 @@ class BandListScraper(BaseScraper):
          'Thrash Metal',
          '<span class="split_up">Split-up</span>']
         
-        and cleans it up a bit.  Specifically, this stores the URL (from href), name (from text),
-        country, genre, and status (from text).
+        and cleans it up a bit (see fragments.parse_band_rows).  Specifically, this stores the
+        URL (from href), name (from text), country, genre, and status (from text).
         
-        This isn't the most performant implementation, but that's okay since
-        we're gonna be sleeping between requests so we're not blasting MA's
-        servers.
+        With a database, upserts the page into Bands in one transaction instead.
         """
-        for data_list in band_data:
-            soup = bs4.BeautifulSoup(data_list[0], 'html5lib')
-            soup2 = bs4.BeautifulSoup(data_list[3], 'html5lib')
-            
-            name = soup.a.text
-            url = soup.a.get('href')
-            country = data_list[1]
-            genre = data_list[2]
-            status = soup2.span.text
-            
-            self.outfile_writer.writerow({'band': name,
-                                          'band_url': url,
-                                          'country': country,
-                                          'genre': genre,
-                                          'status': status})
+        rows = parse_band_rows(band_data, self.soup_features)
+        if self.inserter is None:
+            self.outfile_writer.writerows(rows)
+        else:
+            with self.inserter.connection:
+                self.inserter.insertBandRows(rows)
     
     def closeOutfile(self):
-        self.outfile_handle.close()
+        if self.inserter is not None:
+            self.inserter.close()
+        else:
+            self.outfile_handle.close()
         
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Scrape metal-archives.com for all bands.')
@@ -166,11 +313,29 @@ if __name__ == '__main__':
                         help='filename of output CSV file')
     parser.add_argument('--test', action='store_true',
                         help='Do a shorter test run instead of a full scrape')
+    parser.add_argument('--database', type=str, default=None,
+                        help='Insert into this sqlite3 database (must already exist) instead of writing a CSV')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue a run that died, from the checkpoint next to --outfile')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Make requests concurrently (still at most one per crawl delay)')
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help='Most requests in flight at once with --async')
+    BandListScraper.addParserArgument(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
+    if args.resume and not (args.outfile or args.database):
+        parser.error('--resume needs --outfile or --database')
     
     scraper = BandListScraper(outfile=args.outfile,
                               test=args.test,
+                              use_async=args.use_async,
+                              max_in_flight=args.max_in_flight,
+                              soup_features=args.parser,
+                              cache=cache_from_args(args),
+                              resume=args.resume,
+                              database_filename=args.database,
                               )
     scraper.run()
     
\ No newline at end of file
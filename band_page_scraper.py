@@ -1,4 +1,4 @@
-import argparse, os, re, collections
+import argparse, asyncio, contextlib, os, re, collections, queue, tempfile, threading, time, unittest
 import sqlite3 as lite
 from pprint import pprint
 import logging
@@ -6,7 +6,13 @@ logger = logging.getLogger(__name__)
 
 import bs4, tqdm
 
-from baseScraper import BaseScraper
+from asyncBaseScraper import AsyncBaseScraper
+from deadLetters import DeadLetterStore, ScrapeFailure
+from httpValidators import ValidatorStore
+from responseArchive import ResponseArchive
+from responseCache import ResponseCache, ReplayMiss, add_cache_arguments, cache_from_args
+from scrapeQueue import ScrapeQueue, LEASE_SECONDS
+from upsertBatch import UpsertBatch
 from utils import *
 
 
@@ -19,7 +25,34 @@ MemberStatus = collections.namedtuple('MemberStatus',
                                        'last_known_live',
                                        ))
 
-class BandPageScraper(BaseScraper):
+# Key columns of the tables storeInDatabase writes, in the order they're written
+STORE_KEYS = {'Artists': ('artist_id',),
+              'Labels': ('label_id',),
+              'BandLineup': ('band_id', 'artist_id'),
+              'Similarities': ('band_id', 'similar_to_id'),
+              'Albums': ('album_id', 'band_id'),
+              'Bands': ('band_id',),
+              }
+
+# table: {column: derived column} for UpsertBatch; themes_tokenizer.py --incremental
+# retokenizes bands with null themes_tokens, so they're cleared when the themes change
+STORE_RESETS = {'Bands': {'themes': 'themes_tokens'}}
+
+# The parts of the band page that parseBandPage reads: div#band_info (with h1.band_name and
+# div#band_stats), div#band_members, and div#auditTrail.  Everything else (header, menus,
+# discography placeholder, footer, ...) is skipped when building the soup.
+BAND_PAGE_IDS = ('band_info', 'band_members', 'auditTrail')
+BAND_PAGE_STRAINER = bs4.SoupStrainer(id=list(BAND_PAGE_IDS))
+
+class BadResponse(RuntimeError):
+    """
+    Got a response we can't use (anything but a 200 or 304)
+    """
+    def __init__(self, response):
+        super().__init__('Got response status {}, bailing.'.format(response.status_code))
+        self.response = response
+
+class BandPageScraper(AsyncBaseScraper):
     def __init__(self,
                  database_filename,
                  only_if_not_scraped=False,
@@ -32,10 +65,29 @@ class BandPageScraper(BaseScraper):
                  skip_full_comment=False,
                  skip_recommendations=False,
                  skip_discography=False,
-                 no_store=False):
+                 no_store=False,
+                 revalidate=False,
+                 refresh=False,
+                 pipeline=False,
+                 parse_workers=2,
+                 queue_size=16,
+                 use_async=False,
+                 max_in_flight=4,
+                 soup_features='html5lib',
+                 cache=None,
+                 archive=None,
+                 commit_every=1,
+                 use_queue=False,
+                 claim_size=16,
+                 worker_id=None,
+                 lease_seconds=LEASE_SECONDS,
+                 shared_rate_limit=None,
+                 fail_fast=False,
+                 retry_dead_letters=False):
         """
         Params:
-            database - the sqlit3 database, already populated with basic band info
+            database - the sqlit3 database, already populated with basic band info; may be None
+                       if we're only going to use the parse* methods
             only_if_not_scraped - only scrape pages that haven't been previously scraped
             limit - only scrape this many pages, then exit
             offset - start `offset` rows into the band query
@@ -52,6 +104,41 @@ class BandPageScraper(BaseScraper):
             skip_discography - skip requesting the band's discography
             no_store - don't actually store anything in the database, but still do all the
                        requests and parsing
+            revalidate - make conditional GETs (If-None-Match/If-Modified-Since) for the band page,
+                         recommendations, and discography; pages the server says haven't
+                         changed (304) are neither parsed nor stored
+            refresh - fetch the band page first, and if its "Last modified on" date is the
+                      modified_date we already have (or it's a 304 with revalidate), skip the
+                      read more, recommendations, and discography requests for that band.
+                      Note that recommendations are votes by users, so they can change without
+                      the band page's date changing.
+            pipeline - fetch, parse, and store in separate threads (see runPipelined), so that
+                       parsing and storing happen during the crawl delay
+            parse_workers - number of parser threads in pipelined mode
+            queue_size - size of the bounded queues between the pipeline stages
+            use_async - scrape several bands at once on an asyncio event loop (see runAsync);
+                        still at most one request per crawl delay
+            max_in_flight - most bands/requests in flight at once with use_async
+            soup_features - BeautifulSoup parser backend ('html5lib', 'lxml', or 'html.parser')
+            cache - a responseCache.ResponseCache to replay/record responses; in replay-only
+                    mode, bands without cached pages are skipped
+            archive - a responseArchive.ResponseArchive to keep every page we fetch in, so
+                      they can be parsed again later (see reparse.py)
+            commit_every - commit the database every this many bands
+            use_queue - take the bands with the highest priority from the ScrapeQueue table
+                        (see scrapeQueue.py) instead of the query built from only_if_not_scraped,
+                        reviews_gt, order_by_*, and offset; limit still applies
+            claim_size - number of bands to claim from the queue at a time
+            worker_id - name of this worker in the queue's leases; defaults to hostname:pid
+            lease_seconds - claims not renewed (on each claim and commit) for this long are
+                            handed to other workers, e.g. if this one crashes
+            shared_rate_limit - filename of a sqlite3 file shared by all the workers, so together
+                                they make at most one request per crawl delay
+                                (see rateLimiter.SharedTokenBucket)
+            fail_fast - stop the run on the first band that fails, instead of recording it in
+                        the DeadLetters table (see deadLetters.py) and moving on
+            retry_dead_letters - instead of the usual bands, retry the failed bands whose
+                                 backoff has run out; limit still applies
             
             TODO
             update - deprecate only_if_not_scraped and instead make default behavior to
@@ -69,9 +156,10 @@ class BandPageScraper(BaseScraper):
                      this should really be a band_page_scraper, full_comment_scraper,
                      recommendations_scraper, and discography_scraper.
         """
-        super().__init__()
+        super().__init__(max_in_flight=max_in_flight, cache=cache, soup_features=soup_features, archive=archive,
+                         shared_rate_limit=shared_rate_limit)
         
-        if not os.path.isfile(database_filename):
+        if database_filename is not None and not os.path.isfile(database_filename):
             raise ValueError("database file {} doesn't exist".format(database_filename))
         self.database_filename = database_filename
         
@@ -86,114 +174,594 @@ class BandPageScraper(BaseScraper):
         self.skip_recommendations = bool(skip_recommendations)
         self.skip_discography = bool(skip_discography)
         self.no_store = bool(no_store)
+        self.revalidate = bool(revalidate)
+        self.refresh = bool(refresh)
+        self.n_unchanged = 0
+        self.pipeline = bool(pipeline)
+        self.parse_workers = max(1, int(parse_workers))
+        self.queue_size = max(1, int(queue_size))
+        self.use_async = bool(use_async)
+        if self.pipeline and self.use_async:
+            raise ValueError("Can't use both pipeline and use_async")
+        
+        # guards self.connection; in pipelined mode the fetcher reads validators while
+        # the writer thread is storing
+        self.db_lock = threading.RLock()
+        
+        self.commit_every = max(1, int(commit_every))
+        self.store_batch = UpsertBatch(STORE_KEYS, STORE_RESETS)
+        self.store_validators = {}
+        self.store_band_ids = []
+        self.n_uncommitted = 0
+        
+        self.use_queue = bool(use_queue)
+        self.claim_size = max(1, int(claim_size))
+        self.worker_id = worker_id
+        self.lease_seconds = float(lease_seconds)
+        self.scrape_queue = None
+        self.claimed = set()
+        self.last_heartbeat = time.monotonic()
         
-        self.soup_features = 'html5lib'
+        self.fail_fast = bool(fail_fast)
+        self.retry_dead_letters = bool(retry_dead_letters)
+        if self.retry_dead_letters and self.use_queue:
+            raise ValueError("Can't use both use_queue and retry_dead_letters")
+        self.dead_letters = None
+        self.n_failed = 0
+        if self.use_queue and (self.only_if_not_scraped or self.order_by_reviews
+                               or self.order_by_insert_date or self.offset > 0):
+            logger.warning('Using the scrape queue; ignoring only_if_not_scraped, order_by_*, and offset')
         
         self.date_re = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
         self.added_on_re = re.compile(r'Added on: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
         self.modified_on_re = re.compile(r'Last modified on: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+        
+        # only build the parts of the band page we use (see BAND_PAGE_STRAINER)
+        self.strain_band_page = True
     
     def run(self):
         """
         Call .getBandPage() for each band found in the query
         """
-        with lite.connect(self.database_filename, isolation_level='IMMEDIATE') as self.connection:
-            # How many do we need to do?
-            if self.only_if_not_scraped:
-                n_do_query = 'select count(band_id) from Bands where modified_date is null'
-                if self.reviews_gt >= 0:
-                    n_do_query += f' and (select count(*) from Reviews where Reviews.band_id=Bands.band_id) > {self.reviews_gt}'
-            else:
-                n_do_query = 'select count(band_id) from Bands'
-                if self.reviews_gt >= 0:
-                    n_do_query += f' where (select count(*) from Reviews where Reviews.band_id=Bands.band_id) > {self.reviews_gt}'
-            n_queried = self.connection.execute(n_do_query).fetchall()[0][0]
+        # In pipelined mode the DB writer thread uses the connection, not the thread that opened it
+        # Other workers may hold the write lock for a bit with use_queue, so wait for it
+        with lite.connect(self.database_filename, isolation_level='IMMEDIATE', timeout=60.,
+                          check_same_thread=not self.pipeline) as self.connection:
+            if self.revalidate:
+                self.validators = ValidatorStore(self.connection, lock=self.db_lock)
+            if not self.no_store:
+                self.dead_letters = DeadLetterStore(self.connection)
             
-            if self.limit >= 0:
-                logger.debug('Invoking limit of %d pages', self.limit)
-                n_do = min(n_queried, self.limit)
+            if self.retry_dead_letters:
+                n_do, work = self.getDeadLetterWork()
+            elif self.use_queue:
+                self.scrape_queue = ScrapeQueue(self.connection, owner=self.worker_id,
+                                                lease_seconds=self.lease_seconds)
+                n_do, work = self.getQueueWork()
             else:
-                n_do = n_queried
-                
-            if self.offset > 0:
-                logger.debug('Invoking offset of %d pages', self.offset)
-                if self.offset + n_do > n_queried:
-                    n_do = max(0, n_queried - self.offset)
+                n_do, query = self.getWorkQueue()
+                logger.debug('query = %s', repr(query))
+                work = self.connection.execute(query)
             
-            logger.info('Gonna scrape %d band pages', n_do)
+            try:
+                if self.pipeline:
+                    # Don't keep a read cursor open on the database while the writer thread writes
+                    self.runPipelined(list(work))
+                elif self.use_async:
+                    self.runOnEventLoop(self.runAsync, work, n_do)
+                else:
+                    self.runSequential(work, n_do)
+            finally:
+                # keep the bands we finished, even if we're bailing
+                self.commitStored()
+                if self.scrape_queue is not None:
+                    with self.db_lock:
+                        self.scrape_queue.release(self.claimed)
+                        self.connection.commit()
             
-            # Okay, now do the stuff
-            if self.only_if_not_scraped:
-                query = 'select band_id,band_url from Bands where modified_date is null'
-                if self.reviews_gt >= 0:
-                    query += f' and (select count(*) from Reviews where Reviews.band_id=Bands.band_id) > {self.reviews_gt}'
-            else:
-                query = 'select band_id,band_url from Bands'
-                if self.reviews_gt >= 0:
-                    query += f' where (select count(*) from Reviews where Reviews.band_id=Bands.band_id) > {self.reviews_gt}'
-           
-            if self.order_by_reviews:
-                query += ' order by (select count(*) from Reviews where Reviews.band_id=Bands.band_id) desc'
-            elif self.order_by_insert_date:
-                query += ' order by insert_date asc'
+            if self.n_failed:
+                logger.warning('Failed to scrape %d bands; see the DeadLetters table', self.n_failed)
+            if self.refresh:
+                logger.info("Skipped the other requests for %d bands that haven't changed", self.n_unchanged)
+            self.finalDatabaseStuff()
             
-            #TODO JMF 10 Mar 2019: this should use lite's parameter substitution
-            if self.limit >= 0:
-                query += ' limit {}'.format(self.limit)
+        self.close()
+    
+    def getWorkQueue(self):
+        """
+        Return the number of bands to scrape and the query that selects (band_id, band_url) for them
+        """
+        # Bands.review_count (indexed) is kept up to date by InsertBasicInfo, so these are
+        # index scans instead of a count over Reviews for every band
+        conditions = []
+        if self.only_if_not_scraped:
+            conditions.append('modified_date is null')
+        if self.reviews_gt >= 0:
+            conditions.append(f'review_count > {self.reviews_gt}')
+        where = ' where ' + ' and '.join(conditions) if conditions else ''
+        
+        # How many do we need to do?
+        n_do_query = 'select count(band_id) from Bands' + where
+        n_queried = self.connection.execute(n_do_query).fetchall()[0][0]
+        
+        if self.limit >= 0:
+            logger.debug('Invoking limit of %d pages', self.limit)
+            n_do = min(n_queried, self.limit)
+        else:
+            n_do = n_queried
             
-            if self.offset >= 0:
-                if self.limit < 0:
-                    query += ' limit {}'.format(n_queried)
-                query += ' offset {}'.format(self.offset)
+        if self.offset > 0:
+            logger.debug('Invoking offset of %d pages', self.offset)
+            if self.offset + n_do > n_queried:
+                n_do = max(0, n_queried - self.offset)
+        
+        logger.info('Gonna scrape %d band pages', n_do)
+        
+        # Okay, now do the stuff
+        query = 'select band_id,band_url from Bands' + where
+       
+        if self.order_by_reviews:
+            query += ' order by review_count desc'
+        elif self.order_by_insert_date:
+            query += ' order by insert_date asc'
+        
+        #TODO JMF 10 Mar 2019: this should use lite's parameter substitution
+        if self.limit >= 0:
+            query += ' limit {}'.format(self.limit)
+        
+        if self.offset >= 0:
+            if self.limit < 0:
+                query += ' limit {}'.format(n_queried)
+            query += ' offset {}'.format(self.offset)
+        
+        return n_do, query
+    
+    def getQueueWork(self):
+        """
+        Bring the scrape queue up to date and return the number of bands to scrape and a
+        generator of (band_id, band_url) that claims them from the queue as it goes
+        """
+        self.scrape_queue.refresh()
+        n_do = self.scrape_queue.countPending()
+        if self.limit >= 0:
+            logger.debug('Invoking limit of %d pages', self.limit)
+            n_do = min(n_do, self.limit)
+        self.connection.commit()
+        
+        logger.info('Gonna scrape %d band pages from the scrape queue', n_do)
+        return n_do, self.claimWork(n_do)
+    
+    def getDeadLetterWork(self):
+        """
+        Return the number of failed bands due for a retry and a list of their (band_id, band_url)
+        """
+        if self.dead_letters is None:
+            raise ValueError("Can't retry dead letters with no_store")
+        
+        work = self.dead_letters.due()
+        if self.limit >= 0:
+            logger.debug('Invoking limit of %d pages', self.limit)
+            work = work[:self.limit]
+        
+        logger.info('Gonna retry %d failed bands', len(work))
+        return len(work), work
+    
+    def claimWork(self, n_do):
+        """
+        Claim up to n_do bands from the scrape queue, claim_size at a time, and yield their
+        (band_id, band_url).  Claimed bands that don't get stored are released at the end of .run().
+        Stops early if other workers have claimed the rest.
+        """
+        n_claimed = 0
+        while n_claimed < n_do:
+            with self.db_lock:
+                self.renewLeases()
+                rows = self.scrape_queue.claim(min(self.claim_size, n_do - n_claimed))
+                self.connection.commit()
+            if not rows:
+                break
             
-            logger.debug('query = %s', repr(query))
-            for band_id,band_url in tqdm.tqdm(self.connection.execute(query), total=n_do):
-                if self.order_by_reviews:
-                    num_reviews = self.connection.execute('select count(*) from Reviews where band_id=?', (band_id,)).fetchall()[0][0]
-                    logger.debug('num_reviews = %d', num_reviews)
-                
-                # Request and scrape the band's page
-                if not self.skip_band_page:
-                    band_dict, artist_dict_list, band_lineup_dict_list, label_dict =\
-                        self.getBandPage(band_id, band_url)
-                else:
-                    band_dict = {}
-                    artist_dict_list = []
-                    band_lineup_dict_list = []
-                    label_dict = {}
-                    
-                # Request the full band comment/read more text
-                if not self.skip_full_comment:
-                    comment_body = self.getBandsFullComment(band_id)
-                    if not band_dict: # if we didn't get the band page
-                        band_dict['band_id'] = band_id
-                    band_dict['comment'] = comment_body
-                
-                # Get similar bands
-                if not self.skip_recommendations:
-                    similar_band_dict_list = self.getSimilarBands(band_id)
-                else:
-                    similar_band_dict_list = []
+            self.claimed.update(band_id for band_id, _ in rows)
+            n_claimed += len(rows)
+            yield from rows
+    
+    def renewLeases(self):
+        """
+        Heartbeat our claims if a good chunk of the lease has gone by since the last one.
+        Call with self.db_lock held, before a commit.
+        """
+        now = time.monotonic()
+        if not self.claimed:
+            # fresh claims have full leases
+            self.last_heartbeat = now
+        elif now - self.last_heartbeat > self.lease_seconds/3:
+            n = self.scrape_queue.heartbeat(self.claimed)
+            logger.debug('Renewed %d of %d leases', n, len(self.claimed))
+            self.last_heartbeat = now
+    
+    def runSequential(self, work, n_do):
+        """
+        Fetch, parse, and store each (band_id, band_url) in work, one band at a time.
+        """
+        for band_id,band_url in tqdm.tqdm(work, total=n_do):
+            if self.order_by_reviews:
+                num_reviews = self.connection.execute('select review_count from Bands where band_id=?', (band_id,)).fetchall()[0][0]
+                logger.debug('num_reviews = %d', num_reviews)
+            
+            try:
+                results = self.scrapeBand(band_id, band_url)
+            except ReplayMiss as e:
+                logger.debug('Skipping band_id=%d: %s', band_id, e)
+                continue
+            except Exception as e:
+                self.handleFailure(band_id, e)
+                continue
+            
+            self.storeBand(band_id, results)
+    
+    def runPipelined(self, work):
+        """
+        Like runSequential, but the fetching, parsing, and storing happen in separate threads
+        connected by bounded queues:
+         - this thread fetches (and so owns the crawl delay)
+         - self.parse_workers threads parse the pages
+         - one thread stores the results in the database
+        The parsing and storing then happen while the fetcher is sleeping between requests.
+        """
+        parse_queue = queue.Queue(maxsize=self.queue_size)
+        store_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+        
+        def put(q, item):
+            # Don't block forever if some other stage died
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def get(q):
+            # Likewise; once some stage died, the sentinels may never come (put gives up),
+            # so returns None when stopped instead of waiting for one
+            while True:
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        return None
+        
+        def parser():
+            try:
+                while True:
+                    item = get(parse_queue)
+                    if item is None:
+                        break
+                    band_id, pages, validators = item
+                    try:
+                        results = self.parseBand(band_id, pages)
+                    except ScrapeFailure as e:
+                        self.handleFailure(band_id, e)
+                        continue
+                    if not put(store_queue, (band_id, results, validators)):
+                        break
+            except Exception as e:
+                logger.exception('Parser worker died')
+                errors.append(e)
+                stop.set()
+            finally:
+                put(store_queue, None)
+        
+        def writer():
+            n_parsers_done = 0
+            try:
+                with tqdm.tqdm(total=len(work)) as progress:
+                    while n_parsers_done < self.parse_workers:
+                        item = get(store_queue)
+                        if item is None:
+                            if stop.is_set():
+                                break
+                            n_parsers_done += 1
+                            continue
+                        band_id, results, validators = item
+                        self.storeBand(band_id, results, validators)
+                        progress.update()
+            except Exception as e:
+                logger.exception('Database writer died')
+                errors.append(e)
+                stop.set()
+        
+        threads = [threading.Thread(target=parser, name=f'parser-{i}') for i in range(self.parse_workers)]
+        threads.append(threading.Thread(target=writer, name='writer'))
+        for thread in threads:
+            thread.start()
+        
+        try:
+            for band_id,band_url in work:
+                if stop.is_set():
+                    break
                 
-                # Get discography
-                if not self.skip_discography:
-                    album_dict_list = self.getBandsDiscography(band_id)
-                else:
-                    album_dict_list = []
+                try:
+                    pages = self.fetchBand(band_id, band_url)
+                except ReplayMiss as e:
+                    logger.debug('Skipping band_id=%d: %s', band_id, e)
+                    continue
+                except Exception as e:
+                    self.handleFailure(band_id, e)
+                    continue
                 
-                # Store in database
-                if not self.no_store:
-                    self.storeInDatabase(band_id,
-                                    band_dict=band_dict,
-                                    artist_dicts=artist_dict_list,
-                                    bandlineup_dicts=band_lineup_dict_list,
-                                    label_dict=label_dict,
-                                    similarity_dicts=similar_band_dict_list,
-                                    album_dicts=album_dict_list)
+                validators = self.validators.takeStaged() if self.validators is not None else {}
+                if not put(parse_queue, (band_id, pages, validators)):
+                    break
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for _ in range(self.parse_workers):
+                put(parse_queue, None)
+            for thread in threads:
+                thread.join()
+        
+        if errors:
+            raise errors[0]
+    
+    async def runAsync(self, work, n_do):
+        """
+        Like runSequential, but max_in_flight bands are fetched at once (and each band's
+        requests are made concurrently).  All the requests share the rate limiter, so we
+        still make at most one request per crawl delay, but we don't wait on the network
+        and the crawl delay one after the other.  Parsing and storing happen on the event
+        loop's thread.
+        """
+        work = iter(work)
+        
+        with tqdm.tqdm(total=n_do) as progress:
+            async def worker():
+                # each worker pulls the next band from the shared iterator
+                for band_id,band_url in work:
+                    try:
+                        pages, validators = await self.fetchBandAsync(band_id, band_url)
+                        results = self.parseBand(band_id, pages)
+                    except ReplayMiss as e:
+                        logger.debug('Skipping band_id=%d: %s', band_id, e)
+                        continue
+                    except Exception as e:
+                        self.handleFailure(band_id, e)
+                        continue
+                    
+                    self.storeBand(band_id, results, validators)
+                    progress.update()
             
-            self.finalDatabaseStuff()
+            await asyncio.gather(*(worker() for _ in range(self.max_in_flight)))
+    
+    def handleFailure(self, band_id, error):
+        """
+        Record a band we failed to fetch or parse (error is usually a ScrapeFailure) in the
+        DeadLetters table and the scrape queue, so the run can go on without it.  With
+        fail_fast, re-raises error instead (after telling the scrape queue).
+        """
+        with self.db_lock:
+            if self.scrape_queue is not None:
+                self.scrape_queue.fail(band_id, repr(error))
+                self.claimed.discard(band_id)
             
-        self.close()
+            if self.fail_fast:
+                raise error
+            
+            self.n_failed += 1
+            if self.dead_letters is not None:
+                n_attempts = self.dead_letters.record(band_id, error)
+                logger.warning('Failed to scrape band_id=%d (attempt %d), moving on: %s', band_id, n_attempts, error)
+            else:
+                logger.warning('Failed to scrape band_id=%d, moving on: %s', band_id, error)
+            self.connection.commit()
+    
+    @contextlib.contextmanager
+    def failuresAs(self, band_id, endpoint, url=None, text=None):
+        """
+        Turn exceptions (other than ReplayMiss) from fetching or parsing one of a band's pages
+        into ScrapeFailures, with the response (or text) we got, for handleFailure
+        """
+        try:
+            yield
+        except (ReplayMiss, ScrapeFailure):
+            raise
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            status_code = None
+            if response is not None:
+                status_code = response.status_code
+                if text is None:
+                    text = response.text
+            raise ScrapeFailure(band_id, endpoint, e, url=url, status_code=status_code, text=text) from e
+    
+    def storeBand(self, band_id, results, validators=None):
+        """
+        Store the results of scrapeBand/parseBand in the database (unless no_store is set)
+        
+        validators are the staged HTTP validators for the band's pages, if they were taken
+        out of self.validators (see runPipelined); by default the staged ones are stored.
+        """
+        band_dict, artist_dict_list, band_lineup_dict_list, label_dict,\
+            similar_band_dict_list, album_dict_list = results
+        
+        # Store in database
+        if not self.no_store:
+            self.storeInDatabase(band_id,
+                            band_dict=band_dict,
+                            artist_dicts=artist_dict_list,
+                            bandlineup_dicts=band_lineup_dict_list,
+                            label_dict=label_dict,
+                            similarity_dicts=similar_band_dict_list,
+                            album_dicts=album_dict_list,
+                            validators=validators)
+        elif self.validators is not None and validators is None:
+            self.validators.discard()
+    
+    def scrapeBand(self, band_id, band_url):
+        """
+        Make all the requests for one band (skipping those we were asked to skip)
+        and return the results of parseBand.
+        """
+        return self.parseBand(band_id, self.fetchBand(band_id, band_url))
+    
+    def fetchBand(self, band_id, band_url):
+        """
+        Make all the requests for one band (skipping those we were asked to skip).
+        Returns a dict of endpoint: response text, where the text is None if we're
+        revalidating and the page hasn't changed.  Skipped endpoints aren't in the dict.
+        """
+        pages = {}
+        for endpoint, (url, params, conditional) in self.getRequests(band_id, band_url).items():
+            with self.failuresAs(band_id, endpoint, url):
+                pages[endpoint] = self.fetchPage(url, params, conditional)
+            
+            # the band page comes first
+            if endpoint == 'band_page' and self.refresh and self.bandPageUnchanged(band_id, pages[endpoint]):
+                return {'band_page': None}
+        return pages
+    
+    async def fetchBandAsync(self, band_id, band_url):
+        """
+        Like fetchBand, but makes the band's requests concurrently.  Also returns the
+        HTTP validators staged for these pages (see httpValidators.ValidatorStore.takeStaged).
+        """
+        requests = self.getRequests(band_id, band_url)
+        keys = [ResponseCache.makeKey(url, params) for url, params, _ in requests.values()]
+        
+        async def fetch(endpoint, url, params, conditional):
+            with self.failuresAs(band_id, endpoint, url):
+                return await self.fetchPageAsync(url, params, conditional)
+        
+        pages = {}
+        if self.refresh and 'band_page' in requests:
+            # the rest of the requests depend on what the band page says
+            pages['band_page'] = await fetch('band_page', *requests.pop('band_page'))
+            if self.bandPageUnchanged(band_id, pages['band_page']):
+                pages['band_page'] = None
+                requests = {}
+        
+        texts = await asyncio.gather(*(fetch(endpoint, *request) for endpoint, request in requests.items()))
+        pages.update(zip(requests, texts))
+        
+        validators = {}
+        if self.validators is not None:
+            validators = self.validators.takeStaged(keys)
+        
+        return pages, validators
+    
+    def bandPageUnchanged(self, band_id, text):
+        """
+        Whether the band page (text, or None for a 304) says the band hasn't been modified
+        since the modified_date we stored.  Just looks for "Last modified on" in the text, so
+        we don't have to parse the page to find out.
+        """
+        if text is None:
+            unchanged = True
+        else:
+            match = self.modified_on_re.search(text)
+            if match is None:
+                return False
+            
+            with self.db_lock:
+                rows = self.connection.execute('select modified_date from Bands where band_id=?',
+                                               (band_id,)).fetchall()
+            unchanged = bool(rows) and rows[0][0] == match.group(1)
+        
+        if unchanged:
+            logger.debug("band_id=%d hasn't changed; skipping its other pages", band_id)
+            self.n_unchanged += 1
+        return unchanged
+    
+    def getRequests(self, band_id, band_url):
+        """
+        Returns a dict of endpoint: (url, params, conditional) for the requests
+        we'll make for one band (skipping those we were asked to skip).
+        """
+        requests = {}
+        if not self.skip_band_page:
+            requests['band_page'] = self.bandPageRequest(band_id, band_url)
+        
+        if not self.skip_full_comment:
+            requests['read_more'] = self.fullCommentRequest(band_id)
+        
+        if not self.skip_recommendations:
+            requests['recommendations'] = self.similarBandsRequest(band_id)
+        
+        if not self.skip_discography:
+            requests['discography'] = self.discographyRequest(band_id)
+        
+        return requests
+    
+    def parseBand(self, band_id, pages):
+        """
+        Parse the pages from fetchBand.  Returns the band dict, artist dicts, band lineup dicts,
+        label dict, similar band dicts, and album dicts, ready for storeInDatabase.
+        """
+        # Scrape the band's page
+        band_page = None
+        if pages.get('band_page') is not None:
+            with self.failuresAs(band_id, 'band_page', text=pages['band_page']):
+                band_page = self.parseBandPage(band_id, pages['band_page'])
+        
+        if band_page is not None:
+            band_dict, artist_dict_list, band_lineup_dict_list, label_dict = band_page
+        else: # skipped or unchanged since the last scrape
+            band_dict = {}
+            artist_dict_list = []
+            band_lineup_dict_list = []
+            label_dict = {}
+            
+        # The full band comment/read more text
+        if 'read_more' in pages:
+            with self.failuresAs(band_id, 'read_more', text=pages['read_more']):
+                comment_body = self.parseBandsFullComment(pages['read_more'])
+            if not band_dict: # if we didn't get the band page
+                band_dict['band_id'] = band_id
+            band_dict['comment'] = comment_body
+        
+        # Similar bands
+        similar_band_dict_list = []
+        if pages.get('recommendations') is not None:
+            with self.failuresAs(band_id, 'recommendations', text=pages['recommendations']):
+                similar_band_dict_list = self.parseSimilarBands(band_id, pages['recommendations'])
+        
+        # Discography
+        album_dict_list = []
+        if pages.get('discography') is not None:
+            with self.failuresAs(band_id, 'discography', text=pages['discography']):
+                album_dict_list = self.parseBandsDiscography(band_id, pages['discography'])
+        
+        return (band_dict, artist_dict_list, band_lineup_dict_list, label_dict,
+                similar_band_dict_list, album_dict_list)
+    
+    def fetchPage(self, url, params=None, conditional=False):
+        """
+        GET url and return the response text, or None if we're revalidating (conditional=True)
+        and the page hasn't changed.
+        """
+        response = self.sessionGet(url, params=params, conditional=conditional)
+        return self.responseText(url, response)
+    
+    async def fetchPageAsync(self, url, params=None, conditional=False):
+        """
+        Like fetchPage, but async
+        """
+        response = await self.asyncSessionGet(url, params=params, conditional=conditional)
+        return self.responseText(url, response)
+    
+    def responseText(self, url, response):
+        """
+        Return the response text, or None for a 304 response
+        """
+        if response.status_code == 304:
+            logger.debug('%s is unchanged', url)
+            return None
+        if response.status_code != 200:
+            raise BadResponse(response)
+        return response.text
         
     def getBandPage(self, band_id, band_url):
         """
@@ -206,6 +774,27 @@ class BandPageScraper(BaseScraper):
          - getting the full band comment
          - getting the (full) album list (aka discography)
          - getting similar bands/recommendations
+        
+        Returns None if we're revalidating and the page hasn't changed.
+        """
+        text = self.fetchBandPage(band_id, band_url)
+        if text is None:
+            return None
+        return self.parseBandPage(band_id, text)
+    
+    def fetchBandPage(self, band_id, band_url):
+        """
+        GET the band page; returns the page text (or None if unchanged)
+        """
+        return self.fetchPage(*self.bandPageRequest(band_id, band_url))
+    
+    def bandPageRequest(self, band_id, band_url):
+        logger.debug('GET band page for band_id=%d', band_id)
+        return band_url, None, True
+    
+    def parseBandPage(self, band_id, text):
+        """
+        Parse the band page text; see getBandPage
         """
         # dict mapping table name to a dict (or list of dicts) of column: data.
         # We'll populate this dict first, and then store all the data at once,
@@ -214,13 +803,7 @@ class BandPageScraper(BaseScraper):
         # isn't a concern so we'll just store one band scrape at a time.
         #store_in_db = {}
         
-        # get the band page
-        logger.debug('GET band page for band_id=%d', band_id)
-        response = self.sessionGet(band_url)
-        if response.status_code != 200:
-            raise RuntimeError('Got response status {}, bailing.'.format(response.status_code))
-        
-        band_soup = bs4.BeautifulSoup(response.text, self.soup_features)
+        band_soup = self.bandPageSoup(text)
         added_on, modified_on, lyrical_themes, label_dict = self.scrapeWhatsOnBandPage(band_id, band_soup)
         
         band_dict = {'band_id': band_id,
@@ -234,6 +817,16 @@ class BandPageScraper(BaseScraper):
         
         return band_dict, artists, band_lineup_entries, label_dict
     
+    def bandPageSoup(self, text):
+        """
+        Parse the band page text, keeping only the subtrees in BAND_PAGE_IDS (if
+        self.strain_band_page is set).  html5lib can't do that, so with html5lib we always
+        parse the whole page.
+        """
+        if self.strain_band_page and self.soup_features != 'html5lib':
+            return bs4.BeautifulSoup(text, self.soup_features, parse_only=BAND_PAGE_STRAINER)
+        return bs4.BeautifulSoup(text, self.soup_features)
+    
     def scrapeWhatsOnBandPage(self, band_id, soup):
         """
         Scrape what's available on the band page without making any more requests
@@ -295,14 +888,21 @@ class BandPageScraper(BaseScraper):
         GET the band's "read-more"/full comment.
         Return the <body> (with <body> tags removed).
         """
+        return self.parseBandsFullComment(self.fetchBandsFullComment(band_id))
+    
+    def fetchBandsFullComment(self, band_id):
+        return self.fetchPage(*self.fullCommentRequest(band_id))
+    
+    def fullCommentRequest(self, band_id):
         logger.debug('GET band read-more page for band_id=%d', band_id)
-        read_more_url = 'https://www.metal-archives.com/band/read-more/id/' + str(band_id)
-        response = self.sessionGet(read_more_url)
-        if response.status_code != 200:
-            raise RuntimeError('Got response status {}, bailing.'.format(response.status_code))
-        
-        soup = bs4.BeautifulSoup(response.text, self.soup_features)
-        return ''.join(map(str, soup.body.children))
+        read_more_url = self.base_url + '/band/read-more/id/' + str(band_id)
+        return read_more_url, None, False
+    
+    def parseBandsFullComment(self, text):
+        soup = bs4.BeautifulSoup(text, self.soup_features)
+        # html.parser doesn't add the <html>/<body> tags around the fragment
+        body = soup.body if soup.body is not None else soup
+        return ''.join(map(str, body.children))
     
     def getBandsLineup(self, band_id, soup):
         """
@@ -495,15 +1095,24 @@ class BandPageScraper(BaseScraper):
         """
         GET similar bands via /band/ajax-recommendations/id/ and parse the table into
         a list of dicts suitable for storage into Similarities table.
+        Returns None if we're revalidating and the recommendations haven't changed.
         """
+        text = self.fetchSimilarBands(band_id)
+        if text is None:
+            return None
+        return self.parseSimilarBands(band_id, text)
+    
+    def fetchSimilarBands(self, band_id):
+        return self.fetchPage(*self.similarBandsRequest(band_id))
+    
+    def similarBandsRequest(self, band_id):
         logger.debug('GET band recommendations for band_id=%d', band_id)
-        similar_bands_url = 'https://www.metal-archives.com/band/ajax-recommendations/id/' + str(band_id)
+        similar_bands_url = self.base_url + '/band/ajax-recommendations/id/' + str(band_id)
         params = {'showMoreSimilar': 1}
-        response = self.sessionGet(similar_bands_url, params=params)
-        if response.status_code != 200:
-            raise RuntimeError('Got response status {}, bailing.'.format(response.status_code))
-        
-        soup = bs4.BeautifulSoup(response.text, self.soup_features)
+        return similar_bands_url, params, True
+    
+    def parseSimilarBands(self, band_id, text):
+        soup = bs4.BeautifulSoup(text, self.soup_features)
         table = soup.find('table', {'id': 'artist_list'})
         
         recommendations = []
@@ -531,14 +1140,23 @@ class BandPageScraper(BaseScraper):
         """
         GET a band's discography via /band/discography/id/{band_id}/tab/all and parse the table into
         a list of dicts suitable for storage into Albums table.
+        Returns None if we're revalidating and the discography hasn't changed.
         """
+        text = self.fetchBandsDiscography(band_id)
+        if text is None:
+            return None
+        return self.parseBandsDiscography(band_id, text)
+    
+    def fetchBandsDiscography(self, band_id):
+        return self.fetchPage(*self.discographyRequest(band_id))
+    
+    def discographyRequest(self, band_id):
         logger.debug('GET band discography for band_id=%d', band_id)
-        discog_url = f'https://www.metal-archives.com/band/discography/id/{band_id}/tab/all'
-        response = self.sessionGet(discog_url)
-        if response.status_code != 200:
-            raise RuntimeError('Got response status {}, bailing.'.format(response.status_code))
-        
-        soup = bs4.BeautifulSoup(response.text, self.soup_features)
+        discog_url = f'{self.base_url}/band/discography/id/{band_id}/tab/all'
+        return discog_url, None, True
+    
+    def parseBandsDiscography(self, band_id, text):
+        soup = bs4.BeautifulSoup(text, self.soup_features)
         table = soup.find('table', {'class': 'display discog'})
         
         if not table:
@@ -576,73 +1194,62 @@ class BandPageScraper(BaseScraper):
                         label_dict=None,
                         similarity_dicts=[],
                         album_dicts=[],
+                        validators=None,
                         ):
         """
         Store things in the database.
-        """
-        def make_str(keys):
-            return ','.join(keys)
-         
-        #def make_qmark_eq(keys):
-        #    return ','.join(map(lambda k: f"{k}=?", keys))
         
-        def make_named(keys):
-            return ','.join(map(lambda k: f":{k}", keys))
-
-        def make_named_eq(keys):
-            return ','.join(map(lambda k: f"{k}=:{k}", keys))
-        
-        def where(ids):
-            return 'where ' + ' and '.join(map(lambda k: f"{k}=:{k}", ids))
-        
-        def do_dicts_stuff(dicts, table, ids):
-            for d in dicts:
-                query = f"select {make_str(ids)} from {table} {where(ids)}"
-                #logger.debug(f'select {table} query: "%s"', query)
-                cur.execute(query, {k:v for k,v in d.items() if k in ids})
-                found_id = cur.fetchall()
-                
-                if found_id:
-                    query = f"update {table} set {make_named_eq(d.keys())} {where(ids)}"
-                else:
-                    query = f"insert into {table} ({make_str(d.keys())},insert_date) values ({make_named(d.keys())},datetime('now'))"
-                #logger.debug(f'insert/update {table} query: "%s"', query)
-                cur.execute(query, d)
-       
-        cur = self.connection.cursor()
-        
-        if band_dict:
-            table = 'Bands'
-            ids = ('band_id',)
-            do_dicts_stuff((band_dict,), table, ids)
-        
-        if artist_dicts:
-            table = 'Artists'
-            ids = ('artist_id',)
-            do_dicts_stuff(artist_dicts, table, ids)
-        
-        if label_dict:
-            table = 'Labels'
-            ids = ('label_id',)
-            do_dicts_stuff((label_dict,), table, ids)
+        The rows are upserted in batches (see upsertBatch.UpsertBatch), and committed along
+        with their HTTP validators every commit_every bands.  Bands is written last, since
+        modified_date is the sentinel for a fully scraped band page; either way, a band's
+        rows are all committed together or not at all.
+        """
+        # in pipelined mode the fetcher reads validators from another thread
+        with self.db_lock:
+            if band_dict:
+                self.store_batch.add('Bands', band_dict)
+            if artist_dicts:
+                self.store_batch.extend('Artists', artist_dicts)
+            if label_dict:
+                self.store_batch.add('Labels', label_dict)
+            if bandlineup_dicts:
+                self.store_batch.extend('BandLineup', bandlineup_dicts)
+            if similarity_dicts:
+                self.store_batch.extend('Similarities', similarity_dicts)
+            if album_dicts:
+                self.store_batch.extend('Albums', album_dicts)
             
-        if bandlineup_dicts:
-            table = 'BandLineup'
-            ids = ('band_id', 'artist_id')
-            do_dicts_stuff(bandlineup_dicts, table, ids) 
-        
-        if similarity_dicts:
-            table = 'Similarities'
-            ids = ('band_id', 'similar_to_id')
-            do_dicts_stuff(similarity_dicts, table, ids)
-        
-        if album_dicts:
-            table = 'Albums'
-            ids = ('album_id', 'band_id')
-            do_dicts_stuff(album_dicts, table, ids)
-        
-        cur.close()
-        self.connection.commit()
+            if self.validators is not None:
+                self.store_validators.update(self.validators.takeStaged() if validators is None else validators)
+            
+            self.store_band_ids.append(band_id)
+            self.n_uncommitted += 1
+            if self.n_uncommitted >= self.commit_every:
+                self.commitStored()
+    
+    def commitStored(self):
+        """
+        Write and commit everything storeInDatabase has batched up
+        """
+        with self.db_lock:
+            if not self.n_uncommitted:
+                return
+            
+            logger.debug('Committing %d bands (%d rows)', self.n_uncommitted, len(self.store_batch))
+            self.store_batch.flush(self.connection)
+            if self.validators is not None:
+                self.validators.flush(self.store_validators)
+                self.store_validators = {}
+            if self.dead_letters is not None:
+                self.dead_letters.resolve(self.store_band_ids)
+            if self.scrape_queue is not None:
+                self.scrape_queue.complete(self.store_band_ids)
+                self.claimed.difference_update(self.store_band_ids)
+                self.renewLeases()
+            
+            self.connection.commit()
+            self.store_band_ids = []
+            self.n_uncommitted = 0
         
     def finalDatabaseStuff(self):
         """
@@ -651,6 +1258,111 @@ class BandPageScraper(BaseScraper):
         """
         logger.warning('final db stuff is not implemented')
         
+class Test(unittest.TestCase):
+    """
+    The pipelined run has to return (or raise) whichever of its stages fails, and queue
+    claims have to be kept alive while they're worked on; run with
+    python -m unittest band_page_scraper
+    """
+    n_bands = 20
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_filename = os.path.join(self.directory.name, 'test.db')
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+            schema = f.read()
+        with lite.connect(self.database_filename) as connection:
+            connection.executescript(schema)
+            connection.executemany('insert into Bands (band_id,band,band_url,review_count) values (?,?,?,1)',
+                                   ((band_id, 'band', f'https://www.metal-archives.com/bands/band/{band_id}')
+                                    for band_id in range(1, self.n_bands + 1)))
+        connection.close()
+    
+    def tearDown(self):
+        self.directory.cleanup()
+    
+    def runPipelined(self, fail_in, fail_fast=False):
+        """
+        Run a pipelined scrape whose fail_in stage ('fetch', 'parse', 'store', or None) raises
+        on band 5; returns the exception run raised (or None), failing if run doesn't finish
+        """
+        scraper = BandPageScraper(self.database_filename, pipeline=True, parse_workers=2, queue_size=2,
+                                  fail_fast=fail_fast)
+        
+        def fail(stage, band_id):
+            if stage == fail_in and band_id == 5:
+                raise RuntimeError(f'{stage} failed')
+        
+        def fetch_band(band_id, band_url):
+            # slow enough that the parsers sit waiting on an empty queue
+            time.sleep(0.01)
+            fail('fetch', band_id)
+            return {}
+        
+        def parse_band(band_id, pages):
+            fail('parse', band_id)
+            return {}, [], [], {}, [], []
+        
+        def store_band(band_id, results, validators=None):
+            fail('store', band_id)
+        
+        scraper.fetchBand, scraper.parseBand, scraper.storeBand = fetch_band, parse_band, store_band
+        
+        errors = []
+        def run():
+            try:
+                scraper.run()
+            except Exception as e:
+                errors.append(e)
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive(), f'run hung after the {fail_in} stage failed')
+        scraper.session.close()
+        return errors[0] if errors else None
+    
+    def testNothingFails(self):
+        self.assertIsNone(self.runPipelined(None))
+    
+    def testFetcherFails(self):
+        error = self.runPipelined('fetch', fail_fast=True)
+        self.assertEqual(str(error), 'fetch failed')
+    
+    def testParserFails(self):
+        error = self.runPipelined('parse')
+        self.assertEqual(str(error), 'parse failed')
+    
+    def testWriterFails(self):
+        error = self.runPipelined('store')
+        self.assertEqual(str(error), 'store failed')
+    
+    def testLeasesRenewedWithFrequentCommits(self):
+        # one claim for all the bands, which takes longer than the lease to get through
+        scraper = BandPageScraper(self.database_filename, use_queue=True, claim_size=self.n_bands,
+                                  lease_seconds=2., worker_id='test')
+        
+        leases = []
+        def fetch_band(band_id, band_url):
+            time.sleep(0.15)
+            # datetime('now') only goes to the second, hence >=
+            leases.append(scraper.connection.execute(
+                "select min(lease_expires),min(lease_expires) >= datetime('now') from ScrapeQueue " +
+                "where state='claimed'").fetchone())
+            return {}
+        
+        scraper.fetchBand = fetch_band
+        scraper.parseBand = lambda band_id, pages: ({}, [], [], {}, [], [])
+        scraper.run()
+        scraper.session.close()
+        
+        self.assertTrue(all(ok for _, ok in leases), 'claims expired partway through the batch')
+        self.assertGreater(leases[-1][0], leases[0][0])
+        with lite.connect(self.database_filename) as connection:
+            self.assertEqual(connection.execute("select count(*) from ScrapeQueue where state='done'").fetchone()[0],
+                             self.n_bands)
+        connection.close()
+    
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Scrape the band page for each band in the db,'
                                      ' also making a few other GET requests and scrapes.')
@@ -686,6 +1398,58 @@ if __name__ == '__main__':
     
     parser.add_argument('--no-store', action='store_true',
                         help="Don't actually store anything in the database")
+    parser.add_argument('--commit-every', type=int, default=1,
+                        help='Commit the database every --commit-every bands')
+    
+    parser.add_argument('--queue', dest='use_queue', action='store_true',
+                        help='Scrape the bands with the highest priority in the ScrapeQueue table '
+                        '(see scrape_queue.py) instead of using --only-if-not-scraped, --order-by-*, and --offset')
+    parser.add_argument('--claim-size', type=int, default=16,
+                        help='Number of bands to claim from the queue at a time with --queue')
+    parser.add_argument('--worker-id', type=str, default=None,
+                        help='Name of this worker in the queue (default hostname:pid)')
+    parser.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS,
+                        help="Other workers take over claims we don't renew for this long "
+                        '(claims are renewed when claiming and committing)')
+    parser.add_argument('--shared-rate-limit', type=str, default=None,
+                        help='Filename of a sqlite3 file to share the crawl delay with other '
+                        'workers (e.g. several --queue processes), so together they make one '
+                        'request per crawl delay')
+    
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='Stop on the first band that fails, instead of recording it in the '
+                        'DeadLetters table and moving on')
+    parser.add_argument('--retry-dead-letters', action='store_true',
+                        help='Retry the bands in the DeadLetters table that are due for another try '
+                        '(with exponential backoff), instead of the usual bands')
+    
+    parser.add_argument('--refresh', action='store_true',
+                        help='Fetch the band page first, and skip the other requests for bands '
+                        "whose Last modified date hasn't changed since we stored it")
+    
+    parser.add_argument('--revalidate', action='store_true',
+                        help='Make conditional GETs using stored ETag/Last-Modified validators; '
+                        "pages that haven't changed aren't parsed or stored")
+    
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Fetch, parse, and store in separate threads, so that parsing and '
+                        'storing overlap with the crawl delay')
+    parser.add_argument('--parse-workers', type=int, default=2,
+                        help='Number of parser threads with --pipeline')
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='Size of the bounded queues between pipeline stages')
+    
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Scrape several bands at once on an asyncio event loop '
+                        '(still at most one request per crawl delay)')
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help='Most bands/requests in flight at once with --async')
+    
+    BandPageScraper.addParserArgument(parser)
+    add_cache_arguments(parser)
+    parser.add_argument('--archive', type=str, default=None,
+                        help='Directory of an append-only archive to keep every fetched page in, '
+                        'for reparse.py')
     
     #subparsers?
     parser.add_argument('--logging-level', type=int, default=logging.WARNING,
@@ -707,5 +1471,23 @@ if __name__ == '__main__':
                               skip_recommendations=args.skip_recommendations,
                               skip_discography=args.skip_discography,
                               no_store=args.no_store,
+                              revalidate=args.revalidate,
+                              refresh=args.refresh,
+                              pipeline=args.pipeline,
+                              parse_workers=args.parse_workers,
+                              queue_size=args.queue_size,
+                              use_async=args.use_async,
+                              max_in_flight=args.max_in_flight,
+                              soup_features=args.parser,
+                              cache=cache_from_args(args),
+                              archive=ResponseArchive(args.archive) if args.archive else None,
+                              commit_every=args.commit_every,
+                              use_queue=args.use_queue,
+                              claim_size=args.claim_size,
+                              worker_id=args.worker_id,
+                              lease_seconds=args.lease_seconds,
+                              shared_rate_limit=args.shared_rate_limit,
+                              fail_fast=args.fail_fast,
+                              retry_dead_letters=args.retry_dead_letters,
                               )
     scraper.run()
\ No newline at end of file
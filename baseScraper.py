@@ -1,4 +1,4 @@
-import datetime, time
+import time, urllib.robotparser
 import logging
 logger = logging.getLogger(__name__)
 
@@ -6,10 +6,30 @@ import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from rateLimiter import TokenBucket, SharedTokenBucket, AdaptiveRateController
+from responseCache import ResponseCache
+
+# BeautifulSoup tree builders we know how to use, slowest (but most lenient) first
+PARSER_BACKENDS = ('html5lib', 'lxml', 'html.parser')
+
 class BaseScraper(object):
-    def __init__(self):
+    def __init__(self, cache=None, soup_features='html5lib', shared_rate_limit=None, archive=None):
+        """
+        Params:
+            cache - a responseCache.ResponseCache to replay/record responses from/to; None to
+                    always hit the network
+            soup_features - BeautifulSoup parser backend, one of PARSER_BACKENDS
+            shared_rate_limit - filename of a sqlite3 file shared with other scraper processes
+                                (see rateLimiter.SharedTokenBucket), so that together they make
+                                at most one request per crawl delay; None to only limit this process
+            archive - a responseArchive.ResponseArchive to append every fetched body to
+        """
         self.base_url = 'https://www.metal-archives.com'
         
+        if soup_features not in PARSER_BACKENDS:
+            raise ValueError('Unknown parser backend {}; use one of {}'.format(soup_features, PARSER_BACKENDS))
+        self.soup_features = soup_features
+        
         # from their robots.txt
         self.crawl_delay = 3 # seconds
         
@@ -17,7 +37,8 @@ class BaseScraper(object):
         self.session = requests.Session()
         
         # https://stackoverflow.com/a/35636367
-        retries = Retry(total=5, backoff_factor=1, status_forcelist=[ 502, 503, 504 ])
+        # Only for connection errors; 429/5xx responses go through self.rate_controller
+        retries = Retry(total=5, backoff_factor=1)
         self.session.mount('https://', HTTPAdapter(max_retries=retries))
         
         # Really don't need to hear about connections being brought up again after server has closed it
@@ -27,22 +48,152 @@ class BaseScraper(object):
         # metal-archives requires us to have a user agent?
         self.session.headers['user-agent'] = 'bot'
         
-        self._last_request_time = None
+        # shared by every request this scraper makes (including from threads/coroutines),
+        # and with shared_rate_limit, by every scraper using the same file
+        if shared_rate_limit is None:
+            self.rate_limiter = TokenBucket(self.crawl_delay)
+        else:
+            self.rate_limiter = SharedTokenBucket(shared_rate_limit, self.crawl_delay)
+        
+        # backs off on 429/5xx, relaxes back to the crawl delay, and keeps per-endpoint stats
+        self.rate_controller = AdaptiveRateController(self.rate_limiter, self.crawl_delay)
+        
+        # a urllib.robotparser.RobotFileParser, once .loadRobots() has been called
+        self.robots = None
+        
+        self.cache = cache
+        self.archive = archive
+        
+        # an httpValidators.ValidatorStore; set this to make conditional GETs
+        self.validators = None
         
-    def sessionGet(self, *args, **kwargs):
-        """ Call self.session.get(*args, **kwargs) """
-        if self._last_request_time is not None:
-            date = datetime.datetime.utcnow()
-            sleep_time = self.crawl_delay - (date - self._last_request_time).total_seconds()
-            sleep_time = max(0, sleep_time)
-            #logger.debug('Sleeping for {} seconds'.format(sleep_time))
-            time.sleep(sleep_time)
+    def sessionGet(self, url, params=None, conditional=False, **kwargs):
+        """
+        Call self.session.get(url, params=params, **kwargs), unless we have a fresh response
+        in the cache.  Cache hits don't count against the crawl delay.  429/5xx responses are
+        retried (see self.rate_controller, which also slows us down), and the last response
+        is returned if they keep coming.
         
-        self._last_request_time = datetime.datetime.utcnow()
-        response = self.session.get(*args, **kwargs)
+        If conditional is set and self.validators is set, send If-None-Match/If-Modified-Since
+        with the validators we have for this URL.  The caller should then check for a 304
+        response, meaning the page hasn't changed.
+        """
+        response = self.getCachedResponse(url, params)
+        if response is not None:
+            return response
         
+        key = self.prepareRequest(url, params, conditional, kwargs)
+        
+        for attempt in range(self.rate_controller.max_retries + 1):
+            self.rate_limiter.acquire()
+            _t = time.monotonic()
+            try:
+                response = self.session.get(url, params=params, **kwargs)
+            except requests.RequestException:
+                self.rate_controller.recordError(url, time.monotonic() - _t)
+                raise
+            if not self.rate_controller.onResponse(url, response, time.monotonic() - _t):
+                break
+        
+        self.handleResponse(url, params, key, response)
         return response
     
+    def getCachedResponse(self, url, params):
+        """
+        Return a fresh response from the cache, or None
+        """
+        if self.cache is not None:
+            return self.cache.get(url, params)
+        return None
+    
+    def prepareRequest(self, url, params, conditional, kwargs):
+        """
+        Check robots.txt and add conditional request headers to kwargs (if conditional is set
+        and we have validators).  Returns the validator key for url and params, or None if
+        this isn't a conditional request.
+        """
+        if self.robots is not None:
+            if not self.robots.can_fetch(self.session.headers['user-agent'], url):
+                raise RuntimeError('robots.txt disallows fetching {}'.format(url))
+        
+        if not conditional or self.validators is None:
+            return None
+        
+        key = ResponseCache.makeKey(url, params)
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.update(self.validators.getHeaders(key))
+        kwargs['headers'] = headers
+        return key
+    
+    def handleResponse(self, url, params, key, response):
+        """
+        Stage validators (for conditional requests, see .prepareRequest()) and
+        record the response in the cache and the archive.
+        """
+        if key is not None and response.status_code == 200:
+            self.validators.stage(key, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        
+        if self.archive is not None and response.status_code == 200:
+            self.archive.append(ResponseCache.makeKey(url, params), response.content)
+        
+        if self.cache is not None:
+            if response.status_code == 304:
+                self.cache.touch(url, params)
+            else:
+                self.cache.put(url, params, response)
+    
+    @staticmethod
+    def addParserArgument(parser):
+        """
+        Add the --parser CLI argument to an argparse.ArgumentParser
+        """
+        parser.add_argument('--parser', type=str, default='html5lib', choices=PARSER_BACKENDS,
+                            help='BeautifulSoup parser backend; html5lib is the most lenient, '
+                            'lxml is much faster')
+    
+    def loadRobots(self):
+        """
+        Fetch robots.txt, honor its crawl delay (if it's longer than ours), and check
+        each URL against it from now on.
+        """
+        if self.cache is not None and self.cache.replay_only:
+            logger.debug('Not fetching robots.txt in replay-only mode')
+            return
+        
+        robots_url = self.base_url + '/robots.txt'
+        logger.debug('GET %s', robots_url)
+        self.rate_limiter.acquire()
+        try:
+            response = self.session.get(robots_url)
+        except requests.RequestException as e:
+            logger.warning('Failed to get %s (%s); using crawl_delay=%s', robots_url, e, self.crawl_delay)
+            return
+        
+        if response.status_code != 200:
+            logger.warning('Got response status %d for %s; using crawl_delay=%s',
+                           response.status_code, robots_url, self.crawl_delay)
+            return
+        
+        self.robots = urllib.robotparser.RobotFileParser(robots_url)
+        self.robots.parse(response.text.splitlines())
+        
+        crawl_delay = self.robots.crawl_delay(self.session.headers['user-agent'])
+        if crawl_delay is not None and float(crawl_delay) > self.crawl_delay:
+            logger.info('Using crawl_delay=%s from robots.txt', crawl_delay)
+            self.crawl_delay = float(crawl_delay)
+            self.rate_controller.setFloor(self.crawl_delay)
+    
     def close(self):
         logger.debug('Closing requests.Session')
-        self.session.close()
\ No newline at end of file
+        self.session.close()
+        
+        self.rate_controller.logSummary()
+        
+        if isinstance(self.rate_limiter, SharedTokenBucket):
+            self.rate_limiter.close()
+        
+        if self.cache is not None:
+            self.cache.close()
+        
+        if self.archive is not None:
+            self.archive.close()
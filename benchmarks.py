@@ -0,0 +1,382 @@
+"""
+Micro-benchmarks for the hot spots in the scrapers.
+
+Each benchmark is a subcommand; run with --help for the list.  Where it makes sense, a
+benchmark can use real pages saved in a response cache (see --cache in the scrapers);
+otherwise it makes up some representative data.
+"""
+import argparse, csv, json, os, tempfile, time, tracemalloc
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+from baseScraper import PARSER_BACKENDS
+from fragments import *
+from genreTokenizer import GenreTokenizer
+from utils import *
+
+def load_aadata(cache_filename, endpoint, limit=-1):
+    """
+    Return the aaData rows from the list pages of endpoint saved in a response cache
+    """
+    from parser_parity import iter_saved_pages
+    rows = []
+    for url, _, text in iter_saved_pages(cache_filename, (endpoint,), limit):
+        rows.extend(json.loads(text)['aaData'])
+    return rows
+
+def make_band_rows(n):
+    """
+    Make up n rows that look like the band list's aaData
+    """
+    statuses = [('active', 'Active'), ('split_up', 'Split-up'), ('on_hold', 'On hold'),
+                ('changed_name', 'Changed name'), ('unknown', 'Unknown')]
+    rows = []
+    for i in range(n):
+        name = 'Band &amp; {}'.format(i) if i % 10 == 0 else 'Band {}'.format(i)
+        rows.append(["<a href='https://www.metal-archives.com/bands/Band_{0}/{1}'>{2}</a>".format(
+                         i, 3540000000+i, name),
+                     'Spain',
+                     'Thrash Metal',
+                     '<span class="{}">{}</span>'.format(*statuses[i % len(statuses)])])
+    return rows
+
+def make_review_rows(n):
+    """
+    Make up n rows that look like the review list's aaData
+    """
+    rows = []
+    for i in range(n):
+        album = 'Assassinos em S&eacute;rie {}'.format(i) if i % 10 == 0 else 'Album {}'.format(i)
+        rows.append(['January {}'.format(1 + i % 31),
+                     '<a href="https://www.metal-archives.com/reviews/Band_{0}/Album_{0}/{1}/Some%20User/{2}" '
+                     'title="ole skool &quot;thrash&quot; metal!" class="iconContainer ui-state-default ui-corner-all">'
+                     '<span class="ui-icon ui-icon-search">Read</span></a>'.format(i, 746000+i, 407000+i),
+                     '<a href="https://www.metal-archives.com/bands/Band_{0}/{1}">Band {0}</a>'.format(i, 3540000000+i),
+                     '<a href="https://www.metal-archives.com/albums/Band_{0}/Album_{0}/{1}">{2}</a>'.format(
+                         i, 746000+i, album),
+                     '{}%'.format(i % 101),
+                     '<a href="https://www.metal-archives.com/users/Some%20User" class="profileMenu">Some User</a>',
+                     '{:02d}:{:02d}'.format(i % 24, i % 60)])
+    return rows
+
+def make_band_page(band_id, n_members=12, n_menu_links=300):
+    """
+    Make up a band page that looks like the real thing: a big header/menu, the band info,
+    stats, and members we parse, a discography placeholder, comment, and footer we don't
+    """
+    menu = ''.join('<li><a href="https://www.metal-archives.com/menu/{0}" class="menu">Menu item {0}</a></li>'.format(i)
+                   for i in range(n_menu_links))
+    members = ''.join('<tr class="lineupRow"><td><a href="https://www.metal-archives.com/artists/Artist_{0}/{0}" '
+                      'class="bold">Artist {0}</a></td><td>Guitars (1991-2001)</td></tr>'
+                      '<tr class="lineupBandsRow"><td colspan="2">See also: ex-<a href="https://www.metal-archives.com/bands/Other/{0}">Other</a></td></tr>'.format(i)
+                      for i in range(n_members))
+    return ('<!DOCTYPE html><html><head><title>Band</title>'
+            + '<script type="text/javascript">var x = [];</script>'*20
+            + '</head><body><div id="header"><ul class="menu">' + menu + '</ul></div>'
+            '<div id="content_wrapper"><div id="band_info">'
+            '<h1 class="band_name"><a href="https://www.metal-archives.com/bands/Band/{0}">Band</a></h1>'
+            '<div id="band_stats"><dl class="float_left"><dt>Country of origin:</dt><dd>Norway</dd></dl>'
+            '<dl class="float_right"><dt>Genre:</dt><dd>Black Metal</dd><dt>Lyrical themes:</dt>'
+            '<dd>Darkness, Winter</dd><dt>Current label:</dt><dd><a href="https://www.metal-archives.com/labels/Label/99">Label</a></dd></dl></div>'
+            '<div class="band_comment clear">' + '<p>Lots of text about the band.</p>'*30 + '</div></div>'
+            '<div id="band_disco"><ul><li><a href="#band_disco_all">Complete discography</a></li></ul>'
+            '<div id="band_disco_all">Loading...</div></div>'
+            '<div id="band_members"><ul><li><a href="#band_tab_members_all">Complete lineup</a></li></ul>'
+            '<div id="band_tab_members_all"><table><tbody><tr class="lineupHeaders"><td colspan="2">Current</td></tr>'
+            + members + '</tbody></table></div></div></div>'
+            '<div id="footer">' + menu + '</div>'
+            '<div id="auditTrail"><table><tr><td>Added by: x</td><td>Modified by: y</td></tr>'
+            '<tr><td>Added on: 2002-07-23 15:51:34</td><td>Last modified on: 2019-01-01 10:00:00</td></tr></table></div>'
+            '</body></html>').format(band_id)
+
+def time_per_row(function, rows, repeat):
+    """
+    Best time (over repeat runs) of function(rows), in microseconds per row
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        _t = time.perf_counter()
+        function(rows)
+        best = min(best, time.perf_counter() - _t)
+    return 1e6*best/max(len(rows), 1)
+
+def report(name, rows, timings):
+    """
+    Print per-row timings, with speedups relative to the first one
+    """
+    print('{}: {} rows'.format(name, len(rows)))
+    print('  {:<24} {:>10} {:>10} {:>8}'.format('method', 'us/row', 'rows/s', 'speedup'))
+    reference = timings[0][1]
+    for method, us in timings:
+        print('  {:<24} {:>10.2f} {:>10.0f} {:>7.1f}x'.format(method, us, 1e6/us, reference/us))
+
+def bench_band_rows(args):
+    """
+    parse_band_rows_soup vs parse_band_rows (regex fast path)
+    """
+    if args.cache:
+        rows = load_aadata(args.cache, 'band_list', args.limit)
+    else:
+        rows = make_band_rows(args.rows)
+
+    if parse_band_rows(rows, args.parser) != parse_band_rows_soup(rows, args.parser):
+        logger.warning('Fast path and BeautifulSoup disagree on some rows!')
+
+    timings = [('soup ({})'.format(args.parser),
+                time_per_row(lambda r: parse_band_rows_soup(r, args.parser), rows, args.repeat)),
+               ('fast',
+                time_per_row(lambda r: parse_band_rows(r, args.parser), rows, args.repeat))]
+    report('band rows', rows, timings)
+
+def bench_review_rows(args):
+    """
+    parse_review_rows_soup vs parse_review_rows (whole page fast path), a page at a time
+    """
+    if args.cache:
+        from parser_parity import iter_saved_pages
+        pages = [json.loads(text)['aaData']
+                 for _, _, text in iter_saved_pages(args.cache, ('review_list',), args.limit)]
+    else:
+        rows = make_review_rows(args.rows)
+        pages = [rows[i:i+200] for i in range(0, len(rows), 200)]
+    rows = flatten(pages)
+
+    def by_page(parse):
+        return lambda _: [parse(page, 2000, 1, args.parser) for page in pages]
+
+    if by_page(parse_review_rows)(None) != by_page(parse_review_rows_soup)(None):
+        logger.warning('Fast path and BeautifulSoup disagree on some rows!')
+
+    timings = [('soup ({})'.format(args.parser),
+                time_per_row(by_page(parse_review_rows_soup), rows, args.repeat)),
+               ('fast',
+                time_per_row(by_page(parse_review_rows), rows, args.repeat))]
+    report('review rows', rows, timings)
+
+def peak_memory_per_row(function, rows):
+    """
+    Peak memory (in KB, from tracemalloc) of function(row), the worst over rows
+    """
+    peak = 0
+    for row in rows:
+        tracemalloc.start()
+        function(row)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peak/1024
+
+def parse_or_error(parse, page):
+    try:
+        return parse(page)
+    except Exception as e:
+        return 'error: {!r}'.format(e)
+
+def bench_band_page(args):
+    """
+    BandPageScraper.parseBandPage on the whole page vs with BAND_PAGE_STRAINER (which
+    html5lib doesn't support), per backend: time and peak memory per page
+    """
+    from band_page_scraper import BandPageScraper
+    
+    if args.cache:
+        from parser_parity import iter_saved_pages
+        pages = [(get_band_id_from_band_url(url), text)
+                 for url, _, text in iter_saved_pages(args.cache, ('band_page',), args.limit)]
+    else:
+        pages = [(band_id, make_band_page(band_id)) for band_id in range(1, args.pages+1)]
+    
+    print('band page: {} pages'.format(len(pages)))
+    print('  {:<24} {:>10} {:>10} {:>8} {:>12} {:>8}'.format('method', 'ms/page', 'pages/s', 'speedup',
+                                                            'peak KB/page', 'mismatch'))
+    reference = None
+    n_mismatches = 0
+    for backend in args.parsers:
+        scraper = BandPageScraper(None, soup_features=backend)
+        whole_page_results = None
+        for strain in ((False, True) if backend != 'html5lib' else (False,)):
+            scraper.strain_band_page = strain
+            parse = lambda page: scraper.parseBandPage(*page)
+            
+            method = '{} ({})'.format(backend, 'strained' if strain else 'whole page')
+            
+            # the strained parse has to give the same results as the whole page (with the same
+            # backend), or its speedup doesn't mean anything, so it isn't timed
+            results = [parse_or_error(parse, page) for page in pages]
+            if whole_page_results is None:
+                whole_page_results = results
+            mismatches = sum(result != expected for result, expected in zip(results, whole_page_results))
+            if mismatches:
+                n_mismatches += mismatches
+                print('  {:<24} {:>10} {:>10} {:>8} {:>12} {:>8}'.format(method, '-', '-', '-', '-', mismatches))
+                continue
+            
+            us = time_per_row(lambda pages: [parse(page) for page in pages], pages, args.repeat)
+            kb = peak_memory_per_row(parse, pages[:args.memory_pages])
+            reference = reference or us
+            print('  {:<24} {:>10.2f} {:>10.1f} {:>7.1f}x {:>12.0f} {:>8}'.format(
+                method, us/1e3, 1e6/us, reference/us, kb, mismatches))
+    
+    if n_mismatches:
+        logger.warning('Strained and whole page parses disagree on %d pages!', n_mismatches)
+    return n_mismatches
+
+def make_genres(n):
+    """
+    n made up (distinct) genre texts, built from the kinds of things that are in real ones
+    """
+    modifiers = ['Atmospheric', 'Melodic', 'Progressive', 'Symphonic', 'Raw', 'Technical', 'Post', 'Epic']
+    genres = ['Black Metal', 'Death Metal', 'Doom/Stoner Metal', "Rock 'n' Roll", 'Deathcore',
+              'Folk Metal with Middle Eastern influences', 'Post-Rock/Shoegaze', 'Grindcore/Noisecore',
+              'Heavy/Power Metal', 'Thrash Metal (early); Groove Metal (later)', 'Trip-Hop/Darkwave']
+    texts = []
+    for i in range(n):
+        text = '{} {}/{}'.format(modifiers[i % len(modifiers)], genres[i % len(genres)],
+                                 genres[(i//len(genres)) % len(genres)])
+        texts.append('{}, {} {}x'.format(text, genres[(i*7) % len(genres)], i))
+    return texts
+
+def bench_genre_tokenizer(args):
+    """
+    GenreTokenizer with splitBagOfWordsReference vs the compiled splitBagOfWords
+    """
+    if args.database:
+        with lite.connect(args.database) as connection:
+            genres = [row[0] for row in connection.execute('select distinct genre from Bands where genre is not null')]
+    else:
+        genres = make_genres(args.genres)
+
+    reference = GenreTokenizer(compiled=False)
+    compiled = GenreTokenizer(compiled=True)
+    if [reference.tokenize(g) for g in genres] != [compiled.tokenize(g) for g in genres]:
+        logger.warning('Compiled and reference tokenizers disagree on some genres!')
+
+    timings = [('reference',
+                time_per_row(lambda texts: [reference.tokenize(g) for g in texts], genres, args.repeat)),
+               ('compiled',
+                time_per_row(lambda texts: [compiled.tokenize(g) for g in texts], genres, args.repeat))]
+    report('genre texts', genres, timings)
+
+def dump_table(database_filename, table):
+    """
+    All the rows of a table, sorted, without the insert_date column
+    """
+    with lite.connect(database_filename) as connection:
+        cur = connection.execute('select * from {}'.format(table))
+        keep = [i for i, d in enumerate(cur.description) if d[0] != 'insert_date']
+        return sorted(tuple(row[i] for i in keep) for row in cur)
+
+def bench_insert_basic_info(args):
+    """
+    InsertBasicInfo row by row vs bulk (temp tables + set-based upserts), from made up CSVs
+    into fresh databases
+    """
+    from insert_basic_info import InsertBasicInfo
+    
+    schema_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+    with open(schema_filename, 'r') as f:
+        schema = f.read()
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        band_list_filename = os.path.join(tmpdir, 'band_list.csv')
+        with open(band_list_filename, 'w') as f:
+            writer = csv.DictWriter(f, ('band_url', 'band', 'country', 'genre', 'status'))
+            writer.writeheader()
+            writer.writerows(parse_band_rows(make_band_rows(args.bands)))
+        
+        review_list_filename = os.path.join(tmpdir, 'review_list.csv')
+        with open(review_list_filename, 'w') as f:
+            writer = csv.DictWriter(f, ('year', 'month', 'day', 'hour', 'minute',
+                                        'band', 'band_url', 'album', 'album_url',
+                                        'review_title', 'review_url', 'review_percentage',
+                                        'reviewer', 'reviewer_url'))
+            writer.writeheader()
+            writer.writerows(parse_review_rows(make_review_rows(args.reviews), 2000, 1))
+        
+        def insert(bulk):
+            database_filename = os.path.join(tmpdir, 'bulk.db' if bulk else 'rows.db')
+            def run(_):
+                if os.path.exists(database_filename):
+                    os.remove(database_filename)
+                with lite.connect(database_filename) as connection:
+                    connection.executescript(schema)
+                InsertBasicInfo(database_filename, bulk=bulk).run(band_list_filename, review_list_filename)
+            return database_filename, run
+        
+        n_rows = args.bands + args.reviews
+        rows_filename, rows_run = insert(False)
+        bulk_filename, bulk_run = insert(True)
+        timings = [('row by row', time_per_row(rows_run, range(n_rows), args.repeat)),
+                   ('bulk', time_per_row(bulk_run, range(n_rows), args.repeat))]
+        
+        for table in ('Bands', 'Albums', 'Users', 'Reviews'):
+            if dump_table(rows_filename, table) != dump_table(bulk_filename, table):
+                logger.warning('Row by row and bulk inserts disagree on table %s!', table)
+    
+    report('insert basic info ({} bands, {} reviews)'.format(args.bands, args.reviews), range(n_rows), timings)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the scrapers')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Report the best of this many runs')
+    parser.add_argument('--logging-level', type=int, default=logging.WARNING,
+                        help="Set the logging level")
+
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    sub = subparsers.add_parser('band-rows', help='Parsing band list rows (see fragments.py)')
+    sub.add_argument('--cache', type=str, default=None,
+                     help='Use the band list pages saved in this response cache')
+    sub.add_argument('--limit', type=int, default=-1,
+                     help='Only use this many saved pages')
+    sub.add_argument('--rows', type=int, default=5000,
+                     help='Number of made up rows (without --cache)')
+    sub.add_argument('--parser', type=str, default='html5lib', choices=PARSER_BACKENDS,
+                     help='BeautifulSoup backend for the slow path')
+    sub.set_defaults(function=bench_band_rows)
+
+    sub = subparsers.add_parser('review-rows', help='Parsing review list pages (see fragments.py)')
+    sub.add_argument('--cache', type=str, default=None,
+                     help='Use the review list pages saved in this response cache')
+    sub.add_argument('--limit', type=int, default=-1,
+                     help='Only use this many saved pages')
+    sub.add_argument('--rows', type=int, default=2000,
+                     help='Number of made up rows (without --cache)')
+    sub.add_argument('--parser', type=str, default='html5lib', choices=PARSER_BACKENDS,
+                     help='BeautifulSoup backend for the slow path')
+    sub.set_defaults(function=bench_review_rows)
+
+    sub = subparsers.add_parser('band-page', help='Parsing band pages, whole vs strained (see band_page_scraper.py)')
+    sub.add_argument('--cache', type=str, default=None,
+                     help='Use the band pages saved in this response cache')
+    sub.add_argument('--limit', type=int, default=-1,
+                     help='Only use this many saved pages')
+    sub.add_argument('--pages', type=int, default=50,
+                     help='Number of made up pages (without --cache)')
+    sub.add_argument('--memory-pages', type=int, default=10,
+                     help='Measure peak memory on this many pages')
+    sub.add_argument('--parsers', type=str, nargs='+', default=list(PARSER_BACKENDS), choices=PARSER_BACKENDS,
+                     help='BeautifulSoup backends to compare')
+    sub.set_defaults(function=bench_band_page)
+
+    sub = subparsers.add_parser('genre-tokenizer', help='Tokenizing genre texts (see genreTokenizer.py)')
+    sub.add_argument('--database', type=str, default=None,
+                     help='Use the distinct genre texts of the bands in this database')
+    sub.add_argument('--genres', type=int, default=20000,
+                     help='Number of made up genre texts (without --database)')
+    sub.set_defaults(function=bench_genre_tokenizer)
+
+    sub = subparsers.add_parser('insert-basic-info', help='Inserting the list CSVs (see insert_basic_info.py)')
+    sub.add_argument('--bands', type=int, default=20000,
+                     help='Number of made up bands')
+    sub.add_argument('--reviews', type=int, default=20000,
+                     help='Number of made up reviews')
+    sub.set_defaults(function=bench_insert_basic_info)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
+
+    # benchmarks that check their results return the number of mismatches
+    raise SystemExit(1 if args.function(args) else 0)
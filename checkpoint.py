@@ -0,0 +1,71 @@
+import json, os
+import logging
+logger = logging.getLogger(__name__)
+
+class Checkpoint(object):
+    """
+    A small JSON file recording how far a list scraper got, so a run that dies can be
+    resumed from the last completed page instead of starting over.
+
+    The file is replaced atomically (write a temporary file, fsync, rename), so after a
+    crash it holds either the previous checkpoint or the new one, never half of one.
+    """
+    def __init__(self, filename):
+        """
+        Params:
+            filename - where to keep the checkpoint
+        """
+        self.filename = str(filename)
+
+    @staticmethod
+    def filenameFor(outfile):
+        """
+        Name of the checkpoint file that goes with a scraper's outfile
+        """
+        return str(outfile) + '.checkpoint'
+
+    def load(self):
+        """
+        Return the saved state (a dict), or None if there's no checkpoint
+        """
+        if not os.path.isfile(self.filename):
+            return None
+
+        with open(self.filename, 'r') as f:
+            state = json.load(f)
+        logger.info('Loaded checkpoint %s: %s', self.filename, state)
+        return state
+
+    def save(self, state):
+        """
+        Atomically replace the checkpoint with state (a JSON-able dict)
+        """
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+
+        # make the rename itself durable
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def remove(self):
+        """
+        Delete the checkpoint, e.g. after a run finishes
+        """
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+def sync_file(handle):
+    """
+    Flush an open file all the way to disk and return its size in bytes
+    """
+    handle.flush()
+    os.fsync(handle.fileno())
+    return os.fstat(handle.fileno()).st_size
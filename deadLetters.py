@@ -0,0 +1,142 @@
+import traceback, zlib
+import logging
+logger = logging.getLogger(__name__)
+
+# A band that fails is retried after RETRY_BASE_SECONDS, then twice that, and so on, up to
+# RETRY_MAX_SECONDS between attempts.  After MAX_ATTEMPTS we give up on it.
+RETRY_BASE_SECONDS = 60*60
+RETRY_MAX_SECONDS = 7*24*60*60
+MAX_ATTEMPTS = 6
+
+class ScrapeFailure(RuntimeError):
+    """
+    Fetching or parsing one of a band's pages failed.  Carries what we need to record
+    the failure in the DeadLetters table; the original exception is __cause__.
+    """
+    def __init__(self, band_id, endpoint, cause, url=None, status_code=None, text=None):
+        """
+        Params:
+            band_id - the band we were scraping
+            endpoint - which of the band's pages failed (see utils.get_endpoint_from_url)
+            cause - the exception
+            url - URL of the page, if we know it
+            status_code - HTTP status of the response, if we got one
+            text - the raw response body, if we got one
+        """
+        super().__init__('{} for band_id={}: {!r}'.format(endpoint, band_id, cause))
+        self.band_id = band_id
+        self.endpoint = endpoint
+        self.cause = cause
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+
+class DeadLetterStore(object):
+    """
+    Records bands we failed to scrape in the DeadLetters table (one row per band and
+    endpoint, with the exception, traceback, and raw response), so that a crawl can keep
+    going past them and a later pass can retry them with exponential backoff.  The number
+    of attempts and the next attempt are kept per band (on all of its rows).
+
+    None of the methods commit.
+    """
+    def __init__(self, connection):
+        """
+        Params:
+            connection - sqlite3 connection to the database holding the DeadLetters table
+        """
+        self.connection = connection
+        self.connection.execute("""
+            create table if not exists DeadLetters (
+                band_id integer not null,
+                endpoint text not null,
+                insert_date text,
+                modified_date text,
+                n_attempts integer not null default 1,
+                next_attempt_date text,
+                url text,
+                status_code integer,
+                error text,
+                traceback text,
+                response blob,
+                primary key (band_id, endpoint)
+            )""")
+
+    @staticmethod
+    def backoffSeconds(n_attempts):
+        """
+        Seconds to wait before the next attempt after n_attempts failed ones, or None to give up
+        """
+        if n_attempts >= MAX_ATTEMPTS:
+            return None
+        return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS*2**(n_attempts - 1))
+
+    def record(self, band_id, error):
+        """
+        Record a failure for band_id.  error is a ScrapeFailure, or any other exception (which
+        is recorded under the endpoint 'band').  Returns the number of attempts so far.
+        """
+        if isinstance(error, ScrapeFailure):
+            endpoint, url, status_code, text = error.endpoint, error.url, error.status_code, error.text
+            cause = error.cause
+        else:
+            endpoint, url, status_code, text, cause = 'band', None, None, None, error
+        response = zlib.compress(text.encode('utf-8')) if text is not None else None
+        trace = ''.join(traceback.format_exception(type(cause), cause, cause.__traceback__))
+
+        # attempts (and so the backoff) are per band, not per endpoint: a retry can get past
+        # the endpoint that failed last time and fail on another one
+        n_attempts = self.connection.execute('select coalesce(max(n_attempts), 0) + 1 from DeadLetters ' +
+                                             'where band_id=?', (band_id,)).fetchone()[0]
+        backoff = self.backoffSeconds(n_attempts)
+        next_attempt = None if backoff is None else '+{:d} seconds'.format(backoff)
+
+        self.connection.execute('insert into DeadLetters (band_id,endpoint,insert_date,modified_date,' +
+                                'n_attempts,next_attempt_date,url,status_code,error,traceback,response) ' +
+                                "values (?,?,datetime('now'),datetime('now'),?,datetime('now',?),?,?,?,?,?) " +
+                                'on conflict(band_id,endpoint) do update set ' +
+                                'modified_date=excluded.modified_date,n_attempts=excluded.n_attempts,' +
+                                'next_attempt_date=excluded.next_attempt_date,url=excluded.url,' +
+                                'status_code=excluded.status_code,error=excluded.error,' +
+                                'traceback=excluded.traceback,response=excluded.response',
+                                (band_id, endpoint, n_attempts, next_attempt, url, status_code,
+                                 repr(cause), trace, response))
+        # so the band's older rows don't make it due (by min(next_attempt_date)) before its backoff is up
+        self.connection.execute("update DeadLetters set n_attempts=?,next_attempt_date=datetime('now',?) " +
+                                'where band_id=? and endpoint!=?',
+                                (n_attempts, next_attempt, band_id, endpoint))
+        if backoff is None:
+            logger.warning('Giving up on band_id=%d after %d attempts', band_id, n_attempts)
+        return n_attempts
+
+    def resolve(self, band_ids):
+        """
+        Forget the failures of bands we've now scraped successfully
+        """
+        self.connection.executemany('delete from DeadLetters where band_id=?',
+                                    ((band_id,) for band_id in band_ids))
+
+    def countDue(self):
+        return self.connection.execute('select count(distinct band_id) from DeadLetters ' +
+                                       "where next_attempt_date <= datetime('now')").fetchone()[0]
+
+    def due(self):
+        """
+        Return (band_id, band_url) for the bands whose next attempt is due, the ones
+        that have waited longest first
+        """
+        return self.connection.execute('select band_id,band_url from Bands join ' +
+                                       '(select band_id,min(next_attempt_date) as next_attempt_date ' +
+                                       'from DeadLetters ' +
+                                       "where next_attempt_date <= datetime('now') group by band_id) " +
+                                       'using (band_id) order by next_attempt_date').fetchall()
+
+    def getResponse(self, band_id, endpoint):
+        """
+        Return the raw response body we recorded for a failure, or None
+        """
+        rows = self.connection.execute('select response from DeadLetters where band_id=? and endpoint=?',
+                                       (band_id, endpoint)).fetchall()
+        if not rows or rows[0][0] is None:
+            return None
+        return zlib.decompress(rows[0][0]).decode('utf-8')
@@ -0,0 +1,220 @@
+"""
+Parsers for the little HTML fragments in the JSON (aaData) returned by the band list
+and review list endpoints.
+
+The fragments are tiny and regular, like <a href='...'>name</a>, so we pull them apart
+with regexes instead of building a BeautifulSoup document for each one.  Anything that
+doesn't look exactly like we expect is handed to BeautifulSoup instead.
+"""
+import html, re
+import logging
+logger = logging.getLogger(__name__)
+
+import bs4
+
+__all__ = ['parse_anchor',
+           'parse_span',
+           'parse_band_rows',
+           'parse_band_rows_soup',
+           'parse_review_rows',
+           'parse_review_rows_soup',
+           ]
+
+# <a href="url">text</a>, with nothing else in the fragment
+anchor_re = re.compile(r"""\s*<a\s+href\s*=\s*(?:"([^"<>]*)"|'([^'<>]*)')\s*>([^<>]*)</a>\s*""")
+# <a attr="value" ...>inner</a>, for links with more than an href
+link_re = re.compile(r"""\s*<a((?:\s+[\w-]+\s*=\s*(?:"[^"<>]*"|'[^'<>]*'))*)\s*>(.*?)</a>\s*""", re.S)
+attr_re = re.compile(r"""([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+# In attribute values, html5lib leaves things like &copy= alone; html.unescape doesn't
+bare_amp_re = re.compile(r'&(?!#?\w+;)')
+# <span class="status">text</span>
+span_re = re.compile(r"""\s*<span\s+class\s*=\s*(["'])[^<>]*?\1\s*>([^<>]*)</span>\s*""")
+
+def _unescape(text):
+    return html.unescape(text) if '&' in text else text
+
+def _is_plain(fragment):
+    # html5lib normalizes newlines and NULs; let it deal with those
+    return '\r' not in fragment and '\x00' not in fragment
+
+def parse_anchor(fragment):
+    """
+    Return (href, text) from a fragment like <a href='https://...'>name</a>, or None if the
+    fragment is anything fancier than that.
+    """
+    m = anchor_re.fullmatch(fragment)
+    if m is None or not _is_plain(fragment):
+        return None
+    href = m.group(1) if m.group(2) is None else m.group(2)
+    if bare_amp_re.search(href):
+        return None
+    return _unescape(href), _unescape(m.group(3))
+
+def parse_span(fragment):
+    """
+    Return the text from a fragment like <span class="split_up">Split-up</span>, or None if
+    the fragment is anything fancier than that.
+    """
+    m = span_re.fullmatch(fragment)
+    if m is None or not _is_plain(fragment):
+        return None
+    return _unescape(m.group(2))
+
+def parse_link(fragment):
+    """
+    Return (attrs, inner) from a fragment like <a href="..." title="...">inner</a>, where
+    attrs is a dict of the (unescaped) attributes and inner is the raw inner HTML, or None
+    if the fragment is anything fancier than that.
+    """
+    m = link_re.fullmatch(fragment)
+    if m is None or not _is_plain(fragment):
+        return None
+
+    attrs = {}
+    for name, double, single in attr_re.findall(m.group(1)):
+        value = double or single
+        if name in attrs or bare_amp_re.search(value):
+            return None
+        attrs[name.lower()] = _unescape(value)
+    return attrs, m.group(2)
+
+def parse_band_rows(band_data, features='html5lib'):
+    """
+    Like parse_band_rows_soup, but without building BeautifulSoup documents unless a row
+    looks unusual.
+    """
+    rows = []
+    for data_list in band_data:
+        anchor = parse_anchor(data_list[0])
+        status = parse_span(data_list[3])
+        if anchor is None or status is None:
+            logger.debug('Falling back to BeautifulSoup for band row %s', data_list)
+            rows.extend(parse_band_rows_soup((data_list,), features))
+            continue
+
+        band_url, band = anchor
+        rows.append({'band': band,
+                     'band_url': band_url,
+                     'country': data_list[1],
+                     'genre': data_list[2],
+                     'status': status})
+    return rows
+
+def parse_band_rows_soup(band_data, features='html5lib'):
+    """
+    Takes band data of the form
+    [["<a href='https://www.metal-archives.com/bands/Abducted/3540381624'>Abducted</a>",
+      'Spain',
+      'Thrash Metal',
+      '<span class="split_up">Split-up</span>'],
+     ...]
+
+    and cleans it up a bit.  Returns a list of dicts with the URL (from href), name (from text),
+    country, genre, and status (from text).
+    """
+    rows = []
+    for data_list in band_data:
+        soup = bs4.BeautifulSoup(data_list[0], features)
+        soup2 = bs4.BeautifulSoup(data_list[3], features)
+
+        rows.append({'band': soup.a.text,
+                     'band_url': soup.a.get('href'),
+                     'country': data_list[1],
+                     'genre': data_list[2],
+                     'status': soup2.span.text})
+    return rows
+
+def _parse_review_columns(review_data):
+    """
+    Column-at-a-time fast path for parse_review_rows.  Returns a list with a row dict (or None
+    if the row needs BeautifulSoup) for each review.
+    """
+    if not review_data:
+        return []
+
+    # Each column is handled with a single pass of one compiled pattern
+    dates, reviews, bands, albums, percentages, reviewers, times = zip(*(r[:7] for r in review_data))
+    review_links = map(parse_link, reviews)
+    band_links = map(parse_anchor, bands)
+    album_links = map(parse_anchor, albums)
+    reviewer_links = map(parse_link, reviewers)
+
+    rows = []
+    for date, review, band, album, percentage, reviewer, time_ in zip(
+            dates, review_links, band_links, album_links, percentages, reviewer_links, times):
+        if (review is None or band is None or album is None or reviewer is None
+                or '<' in reviewer[1] or 'href' not in review[0] or 'href' not in reviewer[0]):
+            rows.append(None)
+            continue
+
+        hour, minute = time_.split(':')
+        rows.append({'day': int(date.split()[1]),
+                     'hour': int(hour),
+                     'minute': int(minute),
+                     'band': band[1],
+                     'band_url': band[0],
+                     'album': album[1],
+                     'album_url': album[0],
+                     'review_title': review[0].get('title'),
+                     'review_url': review[0]['href'],
+                     'review_percentage': int(percentage[:-1]),
+                     'reviewer': _unescape(reviewer[1]),
+                     'reviewer_url': reviewer[0]['href']})
+    return rows
+
+def parse_review_rows(review_data, year, month, features='html5lib'):
+    """
+    Like parse_review_rows_soup, but parses a whole page (e.g., 200 rows of aaData) at once
+    without building BeautifulSoup documents unless a row looks unusual.  URLs are returned
+    as they appear in the page (still percent-encoded), like BeautifulSoup does.
+    """
+    rows = []
+    for review, row in zip(review_data, _parse_review_columns(review_data)):
+        if row is None:
+            logger.debug('Falling back to BeautifulSoup for review row %s', review)
+            rows.extend(parse_review_rows_soup((review,), year, month, features))
+        else:
+            rows.append(dict(year=year, month=month, **row))
+    return rows
+
+def parse_review_rows_soup(review_data, year, month, features='html5lib'):
+    """
+    Takes review data of the form
+        [['January 31',
+          '<a href="https://www.metal-archives.com/reviews/Toxik_Attack/Assassinos_em_S%C3%A9rie/746017/Cosmic_Mystery/407515" title="ole skool thrash metal!" class="iconContainer ui-state-default ui-corner-all"><span class="ui-icon ui-icon-search">Read</span></a>',
+          '<a href="https://www.metal-archives.com/bands/Toxik_Attack/3540389184">Toxik Attack</a>',
+          '<a href="https://www.metal-archives.com/albums/Toxik_Attack/Assassinos_em_S%C3%A9rie/746017">Assassinos em Série</a>',
+          '67%',
+          '<a href="https://www.metal-archives.com/users/Cosmic%20Mystery" class="profileMenu">Cosmic Mystery</a>',
+          '23:18'],
+         ...]
+
+    and cleans it up a bit.  Returns a list of dicts, one per review.
+    """
+    rows = []
+    for review in review_data:
+        day = int(review[0].split()[1])
+        hour, minute = map(int, review[6].split(':'))
+
+        review_percentage = int(review[4][:-1])
+
+        review_soup = bs4.BeautifulSoup(review[1], features)
+        band_soup = bs4.BeautifulSoup(review[2], features)
+        album_soup = bs4.BeautifulSoup(review[3], features)
+        reviewer_soup = bs4.BeautifulSoup(review[5], features)
+
+        rows.append({'year': year,
+                     'month': month,
+                     'day': day,
+                     'hour': hour,
+                     'minute': minute,
+                     'band': band_soup.a.text,
+                     'band_url': band_soup.a.get('href'),
+                     'album': album_soup.a.text,
+                     'album_url': album_soup.a.get('href'),
+                     'review_title': review_soup.a.get('title'),
+                     'review_url': review_soup.a.get('href'),
+                     'review_percentage': review_percentage,
+                     'reviewer': reviewer_soup.a.text,
+                     'reviewer_url': reviewer_soup.a.get('href')})
+    return rows
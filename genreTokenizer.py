@@ -1,4 +1,4 @@
-import unittest, re, string
+import os, unittest, re, string
 import sqlite3 as lite
 import logging
 logger = logging.getLogger(__name__)
@@ -9,11 +9,96 @@ def allgrams(text):
     tokens = text.split(' ')
     return tokens
 
+# Tables for splitBagOfWords
+
+# Replacements done (in order) before any further tokenization
+PRE_SPLIT_REPLACE = [#(" 'n' ", "-'n'-"),
+                     #(" n' ", "-'n'-"),
+                     #("'n'roll", "-'n'-roll"),
+                     (" 'n' ", " "),
+                     (" n' ", " "),
+                     ("'n'roll", " roll"),
+                     ('a cappella', 'a-cappella'),
+                     ('post ', 'post-'),
+                     ('\u200b', ''),
+                     ('middle eastern', 'middle-eastern'),
+                     ]
+
+# Drop certain tokens
+DROP_TOKENS = frozenset(['',None,'-',';',
+                         'with','influences','elements','of','and','music'])
+
+# Map certain tokens to other tokens (or list of tokens)
+# mainly to fix some easy things up
+MAP_TOKENS = {
+    'core': ('hardcore',),
+    'ebm-gothic': ('ebm', 'gothic'),
+    'electro': ('electronic',),
+    'electronica': ('electronic',),
+    'electronics': ('electronic',),
+    'hop': ('hip-hop',), # ???
+    'neoclassical': ('neoclassic',),
+    'operatic': ('opera',),
+    'post-': ('post',),
+    'stone': ('stoner',),
+    }
+
+# populate if you want to split the cores
+MAP_CORE = {
+    'blackened': ('black',),
+    'breakcore': ('electronic', 'dance', 'hardcore'),
+    'cybergrind': ('electronic', 'hardcore'),
+    'crustcore': ('crust', 'hardcore'),
+    'darkwave': ('dark', 'wave'),
+    'deathrock': ('death', 'metal', 'rock'),
+    'goregrind': ('gore', 'grind'),
+    'jazz-fusion': ('jazz', 'fusion'),
+    'mathcore': ('math', 'hardcore'),
+    'neoclassic': ('new', 'classic'),
+    'noisecore': ('noise', 'hardcore'),
+    'noisegrid': ('noise', 'grind'),
+    'post-black': ('post', 'black'),
+    'post-doom': ('post', 'doom'),
+    'post-grunge': ('post', 'grunge'),
+    'post-hardcore': ('post', 'hardcore'),
+    'post-industrial': ('post', 'industrial'),
+    'post-metal': ('post', 'metal'),
+    'post-punk': ('post', 'punk'),
+    'post-rock': ('post', 'rock'),
+    'post-sludge': ('post', 'sludge'),
+    'powerviolence': ('power', 'violence'),
+    'psychobilly': ('punk', 'rockabilly'),
+    'slowcore': ('downtempo', 'core'),
+    'synthpop': ('synth', 'pop'),
+    'synthwave': ('synth', 'wave'),
+    'thrashcore': ('thrash', 'core'),
+    'trip-hop': ('trip', 'hip-hop', 'downtempo'),
+    }
+
+# Even split up these?
+#EVEN_THE_BIG_BOYS = {}
+#EVEN_THE_BIG_BOYS = {
+#    'deathcore': ('death', 'metal', 'hardcore'),
+#    'grindcore': ('grind', 'hardcore'),
+#    'metalcore': ('metal', 'hardcore'),
+#    }
+EVEN_THE_BIG_BOYS = {
+    'deathcore': ('deathcore', 'death', 'metal', 'hardcore'),
+    'grindcore': ('grindcore', 'grind', 'hardcore'),
+    'metalcore': ('metalcore', 'metal', 'hardcore'),
+    }
+
 class GenreTokenizer(object):
     """
     Try to tokenize those pesky genre texts.
     """
-    def __init__(self, method='bag-of-words'):
+    def __init__(self, method='bag-of-words', compiled=True):
+        """
+        Params:
+            method - 'bag-of-words' or 'split2' (WIP)
+            compiled - use the tables built here for bag-of-words (splitBagOfWords), rather
+                       than splitBagOfWordsReference; they give the same tokens
+        """
         if method == 'split2':
             log.warning('split2 is a WIP')
             
@@ -95,7 +180,32 @@ class GenreTokenizer(object):
         self.split_these_tokens = ['core', 'noise', 'grind', 'synth', 'wave',]
         
         self.method = method
+        self.compiled = compiled
+        
+        # for splitBagOfWords
+        self.pre_split_prefilter = re.compile('|'.join(re.escape(pat) for pat,_ in PRE_SPLIT_REPLACE))
+        self.rewrite_table = self.buildRewriteTable()
+        
+        # genre text: tokens, for tokenizeCached
+        self.memo = {}
         
+    def tokenizeCached(self, genre_text):
+        """
+        Like tokenize, but remembers the tokens for each genre text; lots of bands share
+        the same genre text.  Don't modify the returned list.
+        """
+        tokens = self.memo.get(genre_text)
+        if tokens is None:
+            tokens = self.memo[genre_text] = self.tokenize(genre_text)
+        return tokens
+    
+    def tokenizeMany(self, genre_texts):
+        """
+        Tokenize a bunch of genre texts at once; returns a list of token lists, in the same
+        order.  Each distinct text is only tokenized once (see tokenizeCached).
+        """
+        return [self.tokenizeCached(genre_text) for genre_text in genre_texts]
+    
     def tokenize(self, genre_text):
         genre_text = self.normalizeWhitespace(genre_text).lower()
         genre_text = self.removeParens(genre_text)
@@ -109,17 +219,17 @@ class GenreTokenizer(object):
         
         # do the messy split split
         if self.method == 'bag-of-words':
-            tokens = [token for text in texts for token in self.splitBagOfWords(text)]
+            split = self.splitBagOfWords if self.compiled else self.splitBagOfWordsReference
+            tokens = [token for text in texts for token in split(text)]
         elif self.method == 'split2':
             tokens = [token for text in texts for token in self.split2(text)]
         else:
             raise ValueError('unknown split method {}'.format(self.method))
         
         # Check for weird tokens
-        for bad_token in self.bad_tokens:
-            if bad_token in tokens or any(map(lambda token: len(token)==1, tokens)):
-                print(genre_text, tokens)
-                raise RuntimeError('bug')
+        if any(token in self.bad_tokens or len(token)==1 for token in tokens):
+            print(genre_text, tokens)
+            raise RuntimeError('bug')
         
         return tokens
     
@@ -374,22 +484,57 @@ class GenreTokenizer(object):
     def splitBagOfWords(self, text):
         """
         Do the split.  This shouldn't be too bad.  Just a list of all words.
+        
+        Same tokens as splitBagOfWordsReference, but with the tables built once in __init__:
+        one regex search to see if any of the PRE_SPLIT_REPLACE patterns are there at all (they
+        usually aren't), and one merged rewrite table instead of three mapping passes.
+        """
+        text = str(text)
+        
+        # The replacements still go one after the other, since one can make room for the next
+        if self.pre_split_prefilter.search(text):
+            for pat,sub in PRE_SPLIT_REPLACE:
+                text = text.replace(pat,sub)
+        
+        # Deal with modifiers like 'atmospheric black/folk metal'
+        # (splitting on '/' and then on ' ' is splitting on either)
+        tokens = []
+        for token in text.replace('/', ' ').split(' '):
+            if token in DROP_TOKENS:
+                continue
+            rewrite = self.rewrite_table.get(token)
+            if rewrite is None:
+                tokens.append(token)
+            else:
+                tokens.extend(rewrite)
+        return tokens
+    
+    @staticmethod
+    def buildRewriteTable():
+        """
+        Merge MAP_TOKENS, MAP_CORE, and EVEN_THE_BIG_BOYS (applied in that order) into one
+        dict of token: tuple of tokens.  Tokens that aren't keys of any of them map to themselves.
+        """
+        def map_token_list(token_list, mapping):
+            return flatten(mapping[token] if token in mapping else (token,) for token in token_list)
+        
+        table = {}
+        for token in set(MAP_TOKENS) | set(MAP_CORE) | set(EVEN_THE_BIG_BOYS):
+            tokens = map_token_list([token], MAP_TOKENS)
+            tokens = map_token_list(tokens, MAP_CORE)
+            tokens = map_token_list(tokens, EVEN_THE_BIG_BOYS)
+            table[token] = tuple(tokens)
+        return table
+    
+    def splitBagOfWordsReference(self, text):
+        """
+        The original (slow) splitBagOfWords, one step at a time; splitBagOfWords must give
+        the same tokens (see Test.testCompiledMatchesReference and genre_tokenizer.py --golden).
         """
         text = str(text)
         
         # Do some replacements before any further tokenization
-        pre_split_replace = [#(" 'n' ", "-'n'-"),
-                             #(" n' ", "-'n'-"),
-                             #("'n'roll", "-'n'-roll"),
-                             (" 'n' ", " "),
-                             (" n' ", " "),
-                             ("'n'roll", " roll"),
-                             ('a cappella', 'a-cappella'),
-                             ('post ', 'post-'),
-                             ('\u200b', ''),
-                             ('middle eastern', 'middle-eastern'),
-                             ]
-        for pat,sub in pre_split_replace:
+        for pat,sub in PRE_SPLIT_REPLACE:
             #text = text.replace(pat,sub)
             text = re.sub(pat,sub,text)
             
@@ -399,84 +544,14 @@ class GenreTokenizer(object):
         splits = flatten(text.split(' ') for text in text.split('/'))
         
         # Drop certain tokens
-        drop_tokens = frozenset(['',None,'-',';',
-                                 'with','influences','elements','of','and','music'])
-        tokens = [token for token in splits if token not in drop_tokens]
-        
-        # Map certain tokens to other tokens (or list of tokens)
-        # mainly to fix some easy things up
-        map_tokens = {
-            'core': ('hardcore',),
-            'ebm-gothic': ('ebm', 'gothic'),
-            'electro': ('electronic',),
-            'electronica': ('electronic',),
-            'electronics': ('electronic',),
-            'hop': ('hip-hop',), # ???
-            'neoclassical': ('neoclassic',),
-            'operatic': ('opera',),
-            'post-': ('post',),
-            'stone': ('stoner',),
-            }
-        
-        # populate if you want to split the cores
-        map_core = {
-            'blackened': ('black',),
-            'breakcore': ('electronic', 'dance', 'hardcore'),
-            'cybergrind': ('electronic', 'hardcore'),
-            'crustcore': ('crust', 'hardcore'),
-            'darkwave': ('dark', 'wave'),
-            'deathrock': ('death', 'metal', 'rock'),
-            'goregrind': ('gore', 'grind'),
-            'jazz-fusion': ('jazz', 'fusion'),
-            'mathcore': ('math', 'hardcore'),
-            'neoclassic': ('new', 'classic'),
-            'noisecore': ('noise', 'hardcore'),
-            'noisegrid': ('noise', 'grind'),
-            'post-black': ('post', 'black'),
-            'post-doom': ('post', 'doom'),
-            'post-grunge': ('post', 'grunge'),
-            'post-hardcore': ('post', 'hardcore'),
-            'post-industrial': ('post', 'industrial'),
-            'post-metal': ('post', 'metal'),
-            'post-punk': ('post', 'punk'),
-            'post-rock': ('post', 'rock'),
-            'post-sludge': ('post', 'sludge'),
-            'powerviolence': ('power', 'violence'),
-            'psychobilly': ('punk', 'rockabilly'),
-            'slowcore': ('downtempo', 'core'),
-            'synthpop': ('synth', 'pop'),
-            'synthwave': ('synth', 'wave'),
-            'thrashcore': ('thrash', 'core'),
-            'trip-hop': ('trip', 'hip-hop', 'downtempo'),
-            }
+        tokens = [token for token in splits if token not in DROP_TOKENS]
         
         def map_token_list(token_list, mapping):
             return flatten(mapping[token] if token in mapping else (token,) for token in token_list)
-            #mapped_tokens = []
-            #for token in token_list:
-            #    if token in map:
-            #        mapped_tokens.extend(map[token])
-            #    else:
-            #        mapped_tokens.append(token)
-            #return mapped_tokens
-        
-        # Even split up these?
-        #even_the_big_boys = {}
-        #even_the_big_boys = {
-        #    'deathcore': ('death', 'metal', 'hardcore'),
-        #    'grindcore': ('grind', 'hardcore'),
-        #    'metalcore': ('metal', 'hardcore'),
-        #    }
-        even_the_big_boys = {
-            'deathcore': ('deathcore', 'death', 'metal', 'hardcore'),
-            'grindcore': ('grindcore', 'grind', 'hardcore'),
-            'metalcore': ('metalcore', 'metal', 'hardcore'),
-            }
- 
-        
-        tokens = map_token_list(tokens, map_tokens)
-        tokens = map_token_list(tokens, map_core)
-        tokens = map_token_list(tokens, even_the_big_boys)
+        
+        tokens = map_token_list(tokens, MAP_TOKENS)
+        tokens = map_token_list(tokens, MAP_CORE)
+        tokens = map_token_list(tokens, EVEN_THE_BIG_BOYS)
         
         return tokens
     
@@ -501,5 +576,37 @@ class Test(unittest.TestCase):
             print('test_tokens =', test_tokens)
             print('='*40)
     
+    def testCompiledMatchesReference(self):
+        """
+        The compiled bag-of-words tokens have to match splitBagOfWordsReference; set
+        GENRE_DATABASE to a database filename to check every distinct genre in Bands too.
+        """
+        genres = ["Black 'n' Roll",
+                  "Rock n' Roll/Heavy Metal",
+                  "Death'n'Roll",
+                  'Post Black Metal/Post-Rock',
+                  'post rock with Post metal influences',
+                  'A Cappella Metal',
+                  'Middle Eastern Folk Metal',
+                  'Atmospheric Black/Folk Metal',
+                  'Deathcore/Grindcore, Metalcore',
+                  'Breakcore/Cybergrind',
+                  'Neoclassical Power Metal',
+                  'Slowcore/Post-Punk/Darkwave',
+                  'Trip-Hop/Electronica/EBM-Gothic',
+                  'Stone Rock; Doom Metal',
+                  'Melodic Death Metal with Symphonic elements (early); Thrash Metal (later)',
+                  'Heavy\u200bMetal',
+                  ]
+        database = os.environ.get('GENRE_DATABASE')
+        if database:
+            with lite.connect(database) as connection:
+                genres += [row[0] for row in connection.execute('select distinct genre from Bands where genre is not null')]
+        
+        compiled = GenreTokenizer(compiled=True)
+        reference = GenreTokenizer(compiled=False)
+        for genre in genres:
+            self.assertEqual(compiled.tokenize(genre), reference.tokenize(genre), genre)
+    
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,5 +1,5 @@
 
-import argparse, json
+import argparse, gzip, json
 import sqlite3 as lite
 from pprint import pprint
 import logging
@@ -9,25 +9,88 @@ import tqdm
 
 from utils import *
 from genreTokenizer import GenreTokenizer
+from tokenIndex import TokenIndex
 
-def main(database, method='bag-of-words'):
+def main(database, method='bag-of-words', incremental=False):
+    """
+    Tokenize each distinct genre text once, then update genre_tokens of the bands whose
+    tokens changed, all in one transaction.  With incremental, only bands without
+    genre_tokens (new bands, and bands whose genre changed; see insert_basic_info.py) are
+    tokenized.
+    
+    The GenreTokens/BandGenreTokens index (see tokenIndex.py) is rebuilt too, or with
+    incremental, updated for the bands that were tokenized (and any that were left out of it).
+    """
     with lite.connect(database) as connection:
-        cursor = connection.cursor()
+        query = 'select band_id,genre,genre_tokens from Bands where genre is not null'
+        if incremental:
+            query += ' and genre_tokens is null'
+        bands = connection.execute(query).fetchall()
         
-        n_do = cursor.execute('select count(band_id) from Bands').fetchall()[0][0]
-        logger.info('Going to tokenize %d genre texts', n_do)
+        genres = {genre for _, genre, _ in bands}
+        logger.info('Going to tokenize %d distinct genre texts for %d bands', len(genres), len(bands))
         
+        genres = list(genres)
         tokenizer = GenreTokenizer(method=method)
-        genre_cursor = connection.cursor()
-        for band_id,genre in tqdm.tqdm(genre_cursor.execute('select band_id,genre from Bands'), total=n_do):
-            logger.debug('band_id = %d, genre = %s', band_id, genre)
-            
-            tokens = tokenizer.tokenize(genre)
-            tokens_str = json.dumps(tokens)
-            logger.debug('tokens = %s', tokens_str)
-            
-            cursor.execute('update Bands set genre_tokens=? where band_id=?',
-                           (tokens_str, band_id))
+        tokens = {genre: json.dumps(genre_tokens)
+                  for genre, genre_tokens in zip(genres, tokenizer.tokenizeMany(tqdm.tqdm(genres)))}
+        
+        updates = [(tokens[genre], band_id) for band_id, genre, old_tokens in bands
+                   if tokens[genre] != old_tokens]
+        logger.info('Updating genre_tokens for %d bands', len(updates))
+        connection.executemany('update Bands set genre_tokens=? where band_id=?', updates)
+        
+        band_tokens = {band_id: tokenizer.tokenizeCached(genre) for band_id, genre, _ in bands}
+        n_indexed = TokenIndex(connection, 'genre').update(band_tokens, incremental=incremental)
+        logger.info('Indexed genre tokens of %d bands', n_indexed)
+
+def tokenize_or_error(tokenizer, genre):
+    try:
+        return tokenizer.tokenize(genre)
+    except Exception as e:
+        return 'error: {!r}'.format(e)
+
+def check(database, method='bag-of-words', golden_filename=None, save_golden_filename=None, show_diffs=5):
+    """
+    Tokenize every distinct genre text in the database with the compiled tokenizer and check
+    the tokens against the golden output (from golden_filename, or else from the reference
+    tokenizer, see GenreTokenizer.splitBagOfWordsReference).  Doesn't touch the database.
+    Returns the number of mismatched genre texts.
+    """
+    with lite.connect(database) as connection:
+        genres = [row[0] for row in connection.execute('select distinct genre from Bands where genre is not null')]
+    
+    if golden_filename:
+        with gzip.open(golden_filename, 'rt') as f:
+            golden = json.load(f)
+        logger.info('Loaded golden tokens for %d genre texts from %s', len(golden), golden_filename)
+    else:
+        reference = GenreTokenizer(method=method, compiled=False)
+        golden = {genre: tokenize_or_error(reference, genre) for genre in tqdm.tqdm(genres)}
+    
+    if save_golden_filename:
+        with gzip.open(save_golden_filename, 'wt') as f:
+            json.dump(golden, f)
+        logger.info('Saved golden tokens for %d genre texts to %s', len(golden), save_golden_filename)
+    
+    tokenizer = GenreTokenizer(method=method, compiled=True)
+    n_missing = n_mismatches = 0
+    for genre in tqdm.tqdm(genres):
+        if genre not in golden:
+            n_missing += 1
+            continue
+        tokens = tokenize_or_error(tokenizer, genre)
+        if tokens != golden[genre]:
+            n_mismatches += 1
+            if n_mismatches <= show_diffs:
+                print('Mismatch for genre={!r}'.format(genre))
+                print('  expected:', golden[genre])
+                print('  got:     ', tokens)
+    
+    if n_missing:
+        logger.warning('No golden tokens for %d genre texts; skipped them', n_missing)
+    print('{} genre texts, {} mismatches'.format(len(genres) - n_missing, n_mismatches))
+    return n_mismatches
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Tokenize the genre text for each '
@@ -38,6 +101,16 @@ if __name__ == '__main__':
     
     parser.add_argument('--method', type=str, default='bag-of-words',
                         help='Tokenization method: "bagOfWords", "split2"')
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only tokenize bands that don't have genre_tokens yet (new bands and "
+                        'bands whose genre changed); retokenize everything after changing --method')
+    parser.add_argument('--check', action='store_true',
+                        help="Don't update anything; check the tokens of every distinct genre text "
+                        'against the reference tokenizer (or --golden)')
+    parser.add_argument('--golden', type=str, default=None,
+                        help='With --check, compare against the tokens saved in this file by --save-golden')
+    parser.add_argument('--save-golden', type=str, default=None,
+                        help='With --check, save the expected tokens (gzipped json) to this file')
     
     #subparsers?
     parser.add_argument('--logging-level', type=int, default=logging.WARNING,
@@ -47,4 +120,9 @@ if __name__ == '__main__':
     
     logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
     
-    main(args.database, method=args.method)
+    if args.check:
+        n_mismatches = check(args.database, method=args.method,
+                             golden_filename=args.golden, save_golden_filename=args.save_golden)
+        raise SystemExit(1 if n_mismatches else 0)
+    
+    main(args.database, method=args.method, incremental=args.incremental)
@@ -0,0 +1,90 @@
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+class ValidatorStore(object):
+    """
+    Keeps the ETag/Last-Modified validators we got for each URL in the HttpValidators
+    table, so that we can make conditional GETs (If-None-Match/If-Modified-Since).
+
+    Validators are staged when a response comes in and only written by .flush(), which
+    the scraper calls right before committing the scraped data.  That way we never
+    remember a validator for a page whose data didn't make it into the database.
+    """
+    def __init__(self, connection, lock=None):
+        """
+        Params:
+            connection - sqlite3 connection to the database holding the HttpValidators table
+            lock - lock to hold while using connection, if it's shared between threads
+        """
+        self.connection = connection
+        self.lock = lock if lock is not None else threading.RLock()
+        self.connection.execute("""
+            create table if not exists HttpValidators (
+                url text primary key not null,
+                insert_date text,
+                etag text,
+                last_modified text
+            )""")
+
+        self._staged = {}
+
+    def getHeaders(self, url):
+        """
+        Return a dict of conditional request headers for url (empty if we don't have validators)
+        """
+        with self.lock:
+            rows = self.connection.execute('select etag,last_modified from HttpValidators where url=?',
+                                           (url,)).fetchall()
+        headers = {}
+        if rows:
+            etag, last_modified = rows[0]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def stage(self, url, etag, last_modified):
+        """
+        Remember the validators from a 200 response until the next .flush()
+        """
+        if etag or last_modified:
+            with self.lock:
+                self._staged[url] = (etag, last_modified)
+
+    def takeStaged(self, urls=None):
+        """
+        Return (and forget) the staged validators (only those for urls, if given), so they
+        can travel along with the pages they go with, e.g. through the pipelined scraper.
+        Pass them to .flush() later.
+        """
+        with self.lock:
+            if urls is None:
+                staged, self._staged = self._staged, {}
+            else:
+                staged = {url: self._staged.pop(url) for url in urls if url in self._staged}
+        return staged
+
+    def flush(self, staged=None):
+        """
+        Write staged validators (or those from .takeStaged() if given); doesn't commit.
+        """
+        with self.lock:
+            if staged is None:
+                staged, self._staged = self._staged, {}
+            if not staged:
+                return
+
+            logger.debug('Storing validators for %d URLs', len(staged))
+            self.connection.executemany('insert or replace into HttpValidators '
+                                        "(url,insert_date,etag,last_modified) values (?,datetime('now'),?,?)",
+                                        ((url, etag, last_modified)
+                                         for url, (etag, last_modified) in staged.items()))
+
+    def discard(self):
+        """
+        Forget staged validators, e.g. if we didn't store the data they go with.
+        """
+        with self.lock:
+            self._staged = {}
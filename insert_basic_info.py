@@ -1,4 +1,4 @@
-import argparse, datetime, os, csv
+import argparse, datetime, itertools, os, csv
 import sqlite3 as lite
 from pprint import pprint
 import logging
@@ -8,21 +8,44 @@ import tqdm
 
 from utils import *
 
+def update_review_counts(connection, band_ids=None):
+    """
+    Recount Bands.review_count from Reviews for band_ids (an iterable of band IDs, or the
+    name of a table with a band_id column), or for every band if band_ids is None.
+    Doesn't commit.
+    """
+    query = 'update Bands set review_count=(select count(*) from Reviews where Reviews.band_id=Bands.band_id)'
+    if band_ids is None:
+        connection.execute(query)
+    elif isinstance(band_ids, str):
+        connection.execute(query + ' where band_id in (select band_id from {})'.format(band_ids))
+    else:
+        connection.executemany(query + ' where band_id=?', ((band_id,) for band_id in set(band_ids)))
+
 class InsertBasicInfo(object):
     """
     Inserts basic info from band and review CSVs into database.
     """
-    def __init__(self, database_filename):
+    def __init__(self, database_filename, bulk=False, batch_size=10000):
         """
         Params:
             database_filename - name of sqlite3 database file
+            bulk - stage the CSVs in temp tables and merge them with a few set-based
+                   statements (see .runBulk()), instead of going row by row
+            batch_size - rows per executemany when staging in bulk mode
         """
         
         if not os.path.isfile(database_filename):
             raise ValueError("Database file {} doesn't exist".format(database_filename))
         self.database_filename = database_filename
+        
+        self.bulk = bool(bulk)
+        self.batch_size = int(batch_size)
     
     def run(self, band_list_filename, review_list_filename):
+        if self.bulk:
+            return self.runBulk(band_list_filename, review_list_filename)
+        
         bands_list = read_csv_to_list_of_dicts(band_list_filename)
         with lite.connect(self.database_filename) as self.connection:
             logger.info('Adding basic band info')
@@ -35,20 +58,220 @@ class InsertBasicInfo(object):
             for review_info in tqdm.tqdm(reviews_list):
                 self.insertBasicReviewInfo(review_info)
             
-    def insertBasicBandInfo(self, band_info):
+            logger.info('Updating review counts')
+            band_ids = map(get_band_id_from_band_url,
+                           itertools.chain((b['band_url'] for b in bands_list), (r['band_url'] for r in reviews_list)))
+            update_review_counts(self.connection, (band_id for band_id in band_ids if band_id is not None))
+            
+    def runBulk(self, band_list_filename, review_list_filename):
         """
-        Inserts basic band info into the Bands table.
+        Like .run(), but streams each CSV into a temp table with executemany and then
+        merges it into Bands/Albums/Users/Reviews with one INSERT ... ON CONFLICT per table,
+        all in one transaction.  Gives the same tables as the row-by-row path: the last
+        row for a band wins, and for albums, users, and reviews the first row wins and
+        existing rows are left alone.
+        """
+        with lite.connect(self.database_filename) as self.connection:
+            cur = self.connection.cursor()
+            
+            cur.execute('create temp table BandsStage ' +
+                        '(band_id integer, band text, band_url text, country text, genre text, status text)')
+            cur.execute('create temp table ReviewsStage ' +
+                        '(band_id integer, album_id integer, user_id integer, modified_date text, ' +
+                        'album text, album_url text, user text, user_url text, ' +
+                        'review_title text, review_url text, review_percentage integer)')
+            
+            logger.info('Staging basic band info')
+            n_bands = self.stageRows(band_list_filename, self.bandValues,
+                                     'insert into BandsStage values (?,?,?,?,?,?)')
+            
+            logger.info('Staging basic review/album/reviewer info')
+            n_reviews = self.stageRows(review_list_filename, self.reviewValues,
+                                       'insert into ReviewsStage values (:band_id,:album_id,:user_id,' +
+                                       ':modified_date,:album,:album_url,:user,:user_url,' +
+                                       ':review_title,:review_url,:review_percentage)')
+            
+            logger.info('Merging %d bands and %d reviews', n_bands, n_reviews)
+            # "where true" keeps SQLite from reading "on conflict" as part of a join
+            cur.execute('insert into Bands ' +
+                        '(band_id,band,band_url,country,genre,status,insert_date) ' +
+                        "select band_id,band,band_url,country,genre,status,datetime('now') " +
+                        'from BandsStage where true order by rowid ' +
+                        'on conflict(band_id) do update set ' +
+                        'band=excluded.band,band_url=excluded.band_url,country=excluded.country,' +
+                        'genre=excluded.genre,status=excluded.status,insert_date=excluded.insert_date,' +
+                        # genre_tokenizer.py --incremental retokenizes bands with null genre_tokens
+                        'genre_tokens=case when Bands.genre is excluded.genre then Bands.genre_tokens end')
+            
+            # Albums go by album_id alone (not the (band_id, album_id) key), like .insertBasicAlbumInfo()
+            cur.execute('insert into Albums ' +
+                        '(album_id,band_id,album,album_url,insert_date) ' +
+                        "select album_id,band_id,album,album_url,datetime('now') " +
+                        'from ReviewsStage where rowid in (select min(rowid) from ReviewsStage group by album_id) ' +
+                        'and album_id not in (select album_id from Albums)')
+            cur.execute('insert into Users ' +
+                        '(user_id,user,user_url,insert_date) ' +
+                        "select user_id,user,user_url,datetime('now') " +
+                        'from ReviewsStage where rowid in (select min(rowid) from ReviewsStage group by user_id) ' +
+                        'on conflict do nothing')
+            cur.execute('insert into Reviews ' +
+                        '(band_id,album_id,user_id,modified_date,insert_date,' +
+                        'review_title,review_url,review_percentage) ' +
+                        "select band_id,album_id,user_id,modified_date,datetime('now')," +
+                        'review_title,review_url,review_percentage ' +
+                        'from ReviewsStage where rowid in ' +
+                        '(select min(rowid) from ReviewsStage group by band_id,album_id,user_id) ' +
+                        'on conflict do nothing')
+            
+            logger.info('Updating review counts')
+            cur.execute('create temp table BandIdsStage as select band_id from BandsStage ' +
+                        'union select band_id from ReviewsStage')
+            update_review_counts(self.connection, 'BandIdsStage')
+            
+            cur.execute('drop table BandIdsStage')
+            cur.execute('drop table BandsStage')
+            cur.execute('drop table ReviewsStage')
+    
+    def stageRows(self, csv_filename, make_values, insert_query):
+        """
+        Stream the rows of a CSV through make_values (e.g. .bandValues) into a temp table,
+        batch_size rows per executemany.  Returns the number of rows staged.
+        """
+        n_rows = 0
+        with open(csv_filename, 'r') as f:
+            values = (v for v in map(make_values, tqdm.tqdm(csv.DictReader(f))) if v is not None)
+            while True:
+                batch = list(itertools.islice(values, self.batch_size))
+                if not batch:
+                    break
+                self.connection.executemany(insert_query, batch)
+                n_rows += len(batch)
+        return n_rows
+    
+    def connect(self):
+        """
+        Open self.connection, for using the insert methods outside of .run() (e.g. from the
+        list scrapers).  Use `with self.connection:` around each batch to commit it.
+        """
+        self.connection = lite.connect(self.database_filename)
+        return self.connection
+    
+    def close(self):
+        self.connection.close()
+    
+    def bandValues(self, band_info):
+        """
+        Return (band_id,band,band_url,country,genre,status) for a row from the band list,
+        or None if we can't get a band_id.
         """
         band_url = band_info['band_url']
         band = band_info['band']
-        country = band_info['country']
-        genre = band_info['genre']
-        status = band_info['status']
         
         band_id = get_band_id_from_band_url(band_url)
         if band_id is None:
             logger.warning("Skipping band %s, since we can't produce a valid band_id from %s", band, band_info)
+            return None
+        
+        return (band_id, band, band_url, band_info['country'], band_info['genre'], band_info['status'])
+    
+    def reviewValues(self, review_info):
+        """
+        Return a dict with the columns for Reviews, Albums, and Users for a row from the
+        review list, or None if we can't get the IDs.
+        """
+        year = int(review_info['year'])
+        month = int(review_info['month'])
+        day = int(review_info['day'])
+        hour = int(review_info['hour'])
+        minute = int(review_info['minute'])
+        modified_date = datetime.datetime(year,month,day,hour,minute,0)
+        modified_date_str = modified_date.strftime('%F %T') # should be ISO8601 and match DATETIME('NOW') format
+        
+        #band = review_info['band']
+        band_url = review_info['band_url']
+        band_id = get_band_id_from_band_url(band_url)
+        if band_id is None:
+            logger.warning("Skipping a review, since we can't produce a valid band_id from %s", review_info)
+            return None
+        
+        album_url = review_info['album_url']
+        album_id = get_album_id_from_album_url(album_url)
+        if album_id is None:
+            logger.warning("Skipping a review, since we can't produce a valid album_id from %s", review_info)
+            return None
+        
+        review_url = review_info['review_url']
+        user_id = get_user_id_from_review_url(review_url)
+        if user_id is None:
+            logger.warning("Skipping a review, since we can't produce a valid user_id from %s", review_info)
+            return None
+        
+        return {'band_id': band_id,
+                'album_id': album_id,
+                'user_id': user_id,
+                'modified_date': modified_date_str,
+                'album': review_info['album'],
+                'album_url': album_url,
+                'user': review_info['reviewer'],
+                'user_url': review_info['reviewer_url'],
+                'review_title': review_info['review_title'],
+                'review_url': review_url,
+                'review_percentage': review_info['review_percentage'],
+                }
+    
+    def insertBandRows(self, bands_list):
+        """
+        Upsert a batch of rows from the band list (e.g. one page) into Bands.  Doesn't commit.
+        """
+        values = [v for v in map(self.bandValues, bands_list) if v is not None]
+        self.connection.executemany('insert into Bands ' +
+                                    '(band_id,band,band_url,country,genre,status,insert_date) ' +
+                                    "values (?,?,?,?,?,?,datetime('now')) " +
+                                    'on conflict(band_id) do update set ' +
+                                    'band=excluded.band,band_url=excluded.band_url,country=excluded.country,' +
+                                    'genre=excluded.genre,status=excluded.status,insert_date=excluded.insert_date,' +
+                                    'genre_tokens=case when Bands.genre is excluded.genre then Bands.genre_tokens end',
+                                    values)
+        # new bands may already have reviews
+        update_review_counts(self.connection, (v[0] for v in values))
+        return len(values)
+    
+    def insertReviewRows(self, reviews_list):
+        """
+        Insert a batch of rows from the review list (e.g. one page) into Reviews, along with
+        their albums and users.  Like .insertBasicReviewInfo(), leaves existing rows alone.
+        Doesn't commit.
+        """
+        values = [v for v in map(self.reviewValues, reviews_list) if v is not None]
+        # like .insertBasicAlbumInfo(), go by album_id alone (not the (band_id, album_id) key)
+        self.connection.executemany('insert into Albums ' +
+                                    "(album_id,band_id,album,album_url,insert_date) " +
+                                    "select :album_id,:band_id,:album,:album_url,datetime('now') " +
+                                    'where not exists (select 1 from Albums where album_id=:album_id)',
+                                    values)
+        self.connection.executemany('insert into Users ' +
+                                    "(user_id,user,user_url,insert_date) " +
+                                    "values (:user_id,:user,:user_url,datetime('now')) " +
+                                    'on conflict do nothing',
+                                    values)
+        self.connection.executemany('insert into Reviews ' +
+                                    '(band_id,album_id,user_id,modified_date,insert_date,' +
+                                    'review_title,review_url,review_percentage) ' +
+                                    "values (:band_id,:album_id,:user_id,:modified_date,datetime('now')," +
+                                    ':review_title,:review_url,:review_percentage) ' +
+                                    'on conflict do nothing',
+                                    values)
+        update_review_counts(self.connection, (v['band_id'] for v in values))
+        return len(values)
+    
+    def insertBasicBandInfo(self, band_info):
+        """
+        Inserts basic band info into the Bands table.
+        """
+        values = self.bandValues(band_info)
+        if values is None:
             return
+        band_id, band, band_url, country, genre, status = values
         
         cur = self.connection.cursor()
         
@@ -62,9 +285,10 @@ class InsertBasicInfo(object):
         elif len(rows) == 1:
             logger.debug('Band %s with id %d already in Bands; updating basic info', band, band_id)
             cur.execute('update Bands ' + 
-                        "set band=?, band_url=?,country=?,genre=?,status=?,insert_date=datetime('now') " +
+                        "set band=?, band_url=?,country=?,genre=?,status=?,insert_date=datetime('now')," +
+                        'genre_tokens=case when genre is ? then genre_tokens end ' +
                         'where band_id=?',
-                        (band,band_url,country,genre,status,band_id))
+                        (band,band_url,country,genre,status,genre,band_id))
             
         else:
             logger.debug('Inserting band %s into Bands with id %d', band, band_id)
@@ -80,43 +304,17 @@ class InsertBasicInfo(object):
             - inserts basic album info
             - inserts basic reviewer info
         """
-        year = int(review_info['year'])
-        month = int(review_info['month'])
-        day = int(review_info['day'])
-        hour = int(review_info['hour'])
-        minute = int(review_info['minute'])
-        modified_date = datetime.datetime(year,month,day,hour,minute,0)
-        modified_date_str = modified_date.strftime('%F %T') # should be ISO8601 and match DATETIME('NOW') format
-        
-        #band = review_info['band']
-        band_url = review_info['band_url']
-        band_id = get_band_id_from_band_url(band_url)
-        if band_id is None:
-            logger.warning("Skipping a review, since we can't produce a valid band_id from %s", review_info)
+        values = self.reviewValues(review_info)
+        if values is None:
             return
-        
-        album = review_info['album']
-        album_url = review_info['album_url']
-        album_id = get_album_id_from_album_url(album_url)
-        if album_id is None:
-            logger.warning("Skipping a review, since we can't produce a valid album_id from %s", review_info)
-            return
-        
-        review_title = review_info['review_title']
-        review_url = review_info['review_url']
-        review_percentage = review_info['review_percentage']
-        user_id = get_user_id_from_review_url(review_url)
-        if user_id is None:
-            logger.warning("Skipping a review, since we can't produce a valid user_id from %s", review_info)
-            return
-        
-        user = review_info['reviewer']
-        user_url = review_info['reviewer_url']
+        band_id = values['band_id']
+        album_id = values['album_id']
+        user_id = values['user_id']
         
         cur = self.connection.cursor()
         
-        self.insertBasicAlbumInfo(band_id, album_id, album, album_url)
-        self.insertBasicUserInfo(user_id, user, user_url)
+        self.insertBasicAlbumInfo(band_id, album_id, values['album'], values['album_url'])
+        self.insertBasicUserInfo(user_id, values['user'], values['user_url'])
         
         # check if review is already in the DB
         cur.execute('select band_id,album_id,user_id from Reviews where band_id=? and album_id=? and user_id=?',
@@ -137,14 +335,7 @@ class InsertBasicInfo(object):
                         'review_title,review_url,review_percentage) ' + 
                         "values (:band_id,:album_id,:user_id,:modified_date,datetime('now')," +
                         ':review_title,:review_url,:review_percentage)',
-                        {'band_id': band_id,
-                         'album_id': album_id,
-                         'user_id': user_id,
-                         'modified_date': modified_date_str,
-                         'review_title': review_title,
-                         'review_url': review_url,
-                         'review_percentage': review_percentage,
-                         })
+                        values)
     
     def insertBasicAlbumInfo(self, band_id, album_id, album, album_url):
         cur = self.connection.cursor()
@@ -193,6 +384,9 @@ if __name__ == '__main__':
                         help='Filename of CSV file produced by BandListScraper')
     parser.add_argument('review_list', type=str,
                         help='Filename of CSV file produced by ReviewListScraper')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Stage the CSVs in temp tables and merge them with set-based upserts '
+                        '(much faster than going row by row)')
 
     #subparsers?
     parser.add_argument('--logging-level', type=int, default=logging.WARNING,
@@ -203,6 +397,7 @@ if __name__ == '__main__':
     logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
     
     scraper = InsertBasicInfo(args.database,
+                              bulk=args.bulk,
                               )
     
     scraper.run(args.band_list, args.review_list)
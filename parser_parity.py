@@ -0,0 +1,169 @@
+import argparse, collections, gzip, json, re, time
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+import tqdm
+
+from baseScraper import PARSER_BACKENDS
+from band_page_scraper import BandPageScraper
+from fragments import parse_band_rows, parse_review_rows
+from responseCache import ResponseCache
+from utils import *
+
+# Every backend is checked against the output of this one
+REFERENCE_BACKEND = 'html5lib'
+
+ENDPOINTS = ('band_page', 'read_more', 'recommendations', 'discography', 'band_list', 'review_list')
+
+id_re = re.compile(r'/id/(\d+)')
+selection_re = re.compile(r'/selection/(\d{4})-(\d{2})/')
+
+def iter_saved_pages(cache_filename, endpoints, limit=-1):
+    """
+    Yield (url, endpoint, text) for the pages saved in a response cache (see responseCache.py)
+    """
+    with lite.connect(f'file:{cache_filename}?mode=ro', uri=True) as connection:
+        query = 'select url,endpoint,status_code,headers,body from Responses where endpoint in ({}) order by url'.format(
+            ','.join('?'*len(endpoints)))
+        if limit >= 0:
+            query += ' limit {}'.format(int(limit))
+        for url, endpoint, status_code, headers, body in connection.execute(query, endpoints):
+            yield url, endpoint, ResponseCache.makeResponse(url, status_code, headers, body).text
+
+def parse_page(scraper, url, endpoint, text):
+    """
+    Parse a saved page with scraper (a BandPageScraper with the backend we want) the same
+    way the scrapers would.  Returns something JSON-able.
+    """
+    if endpoint == 'band_page':
+        result = scraper.parseBandPage(get_band_id_from_band_url(url), text)
+    elif endpoint == 'read_more':
+        result = scraper.parseBandsFullComment(text)
+    elif endpoint == 'recommendations':
+        result = scraper.parseSimilarBands(int(id_re.search(url).group(1)), text)
+    elif endpoint == 'discography':
+        result = scraper.parseBandsDiscography(int(id_re.search(url).group(1)), text)
+    elif endpoint == 'band_list':
+        result = parse_band_rows(json.loads(text)['aaData'], scraper.soup_features)
+    elif endpoint == 'review_list':
+        year, month = map(int, selection_re.search(url).groups())
+        result = parse_review_rows(json.loads(text)['aaData'], year, month, scraper.soup_features)
+    else:
+        raise ValueError('Unknown endpoint {}'.format(endpoint))
+
+    # tuples -> lists, etc., so results compare the same way as results loaded from a golden file
+    return json.loads(json.dumps(result))
+
+def main(cache_filename, backends, endpoints, limit=-1, golden_filename=None, save_golden_filename=None,
+         show_diffs=5):
+    """
+    Parse every saved page with every backend, check the results against the golden output
+    (from golden_filename, or else from REFERENCE_BACKEND), and report mismatches and timings.
+    Returns the number of mismatched pages.
+    """
+    scrapers = {backend: BandPageScraper(None, soup_features=backend) for backend in backends}
+
+    golden = None
+    if golden_filename:
+        with gzip.open(golden_filename, 'rt') as f:
+            golden = json.load(f)
+        logger.info('Loaded golden output for %d pages from %s', len(golden), golden_filename)
+    elif REFERENCE_BACKEND not in scrapers:
+        scrapers[REFERENCE_BACKEND] = BandPageScraper(None, soup_features=REFERENCE_BACKEND)
+
+    save_golden = {} if save_golden_filename else None
+
+    # (backend, endpoint): [pages, mismatches, errors, seconds]
+    stats = collections.defaultdict(lambda: [0, 0, 0, 0.])
+    n_diffs_shown = 0
+
+    for url, endpoint, text in tqdm.tqdm(iter_saved_pages(cache_filename, endpoints, limit)):
+        results = {}
+        for backend, scraper in scrapers.items():
+            stat = stats[(backend, endpoint)]
+            stat[0] += 1
+            _t = time.perf_counter()
+            try:
+                results[backend] = parse_page(scraper, url, endpoint, text)
+            except Exception as e:
+                stat[2] += 1
+                results[backend] = 'error: {!r}'.format(e)
+            stat[3] += time.perf_counter() - _t
+
+        if golden is not None:
+            if url not in golden:
+                logger.warning('No golden output for %s; skipping', url)
+                continue
+            expected = golden[url]
+        else:
+            expected = results[REFERENCE_BACKEND]
+
+        if save_golden is not None:
+            save_golden[url] = expected
+
+        for backend in backends:
+            if results[backend] != expected:
+                stats[(backend, endpoint)][1] += 1
+                if n_diffs_shown < show_diffs:
+                    n_diffs_shown += 1
+                    print('Mismatch for backend={} url={}'.format(backend, url))
+                    print('  expected:', json.dumps(expected)[:500])
+                    print('  got:     ', json.dumps(results[backend])[:500])
+
+    if save_golden is not None:
+        with gzip.open(save_golden_filename, 'wt') as f:
+            json.dump(save_golden, f)
+        logger.info('Saved golden output for %d pages to %s', len(save_golden), save_golden_filename)
+
+    print('{:<12} {:<16} {:>8} {:>10} {:>8} {:>10} {:>8}'.format(
+        'backend', 'endpoint', 'pages', 'mismatch', 'errors', 'ms/page', 'speedup'))
+    n_mismatches = 0
+    for (backend, endpoint), (pages, mismatches, errors, seconds) in sorted(stats.items()):
+        ref_pages, _, _, ref_seconds = stats.get((REFERENCE_BACKEND, endpoint), (0, 0, 0, 0.))
+        if ref_pages and seconds:
+            speedup = '{:.1f}x'.format((ref_seconds/ref_pages)/(seconds/pages))
+        else: # didn't run the reference backend (e.g. with --golden)
+            speedup = '-'
+        print('{:<12} {:<16} {:>8} {:>10} {:>8} {:>10.2f} {:>8}'.format(
+            backend, endpoint, pages, mismatches, errors, 1e3*seconds/max(pages, 1), speedup))
+        if backend in backends:
+            n_mismatches += mismatches
+
+    return n_mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the parser backends give the same results '
+                                     'on saved pages, and time them.')
+    parser.add_argument('cache', type=str,
+                        help='Filename of a response cache (see --cache in the scrapers) with saved pages')
+    parser.add_argument('--backends', type=str, nargs='+', default=list(PARSER_BACKENDS),
+                        choices=PARSER_BACKENDS,
+                        help='Parser backends to check')
+    parser.add_argument('--endpoints', type=str, nargs='+', default=list(ENDPOINTS),
+                        choices=ENDPOINTS,
+                        help='Only check pages from these endpoints')
+    parser.add_argument('--limit', type=int, default=-1,
+                        help='Only check this many pages')
+    parser.add_argument('--golden', type=str, default=None,
+                        help='Check against the golden output in this file (from --save-golden) '
+                        'instead of against {}'.format(REFERENCE_BACKEND))
+    parser.add_argument('--save-golden', type=str, default=None,
+                        help='Save the golden output to this (gzipped JSON) file')
+    parser.add_argument('--show-diffs', type=int, default=5,
+                        help='Print this many mismatches')
+
+    #subparsers?
+    parser.add_argument('--logging-level', type=int, default=logging.WARNING,
+                        help="Set the logging level")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
+
+    n_mismatches = main(args.cache, args.backends, args.endpoints,
+                        limit=args.limit,
+                        golden_filename=args.golden,
+                        save_golden_filename=args.save_golden,
+                        show_diffs=args.show_diffs)
+    raise SystemExit(1 if n_mismatches else 0)
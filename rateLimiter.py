@@ -0,0 +1,287 @@
+import asyncio, collections, email.utils, threading, time
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+from utils import get_endpoint_from_url
+
+# Responses that mean "slow down and try again"
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter on the monotonic clock.
+
+    One token is added every `interval` seconds, up to `capacity` tokens.  Each request
+    takes a token; if there isn't one, it reserves the next one and waits for it.  With
+    the default capacity of 1, requests are spaced at least `interval` seconds apart
+    (measured from when each request is allowed to start, so the transfer time of one
+    request overlaps with the wait for the next).
+
+    The same bucket can be shared by threads and by coroutines (see .acquire() and
+    .acquireAsync()).
+    """
+    def __init__(self, interval, capacity=1):
+        """
+        Params:
+            interval - seconds per token, e.g. the crawl delay from robots.txt
+            capacity - most tokens that can pile up (i.e. the biggest burst we allow)
+        """
+        self.interval = float(interval)
+        self.capacity = float(capacity)
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._last_time = time.monotonic()
+
+    def reserve(self):
+        """
+        Take a token and return how many seconds the caller must wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.interval > 0:
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_time)/self.interval)
+            else:
+                self._tokens = self.capacity
+            self._last_time = now
+
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.
+            return -self._tokens*self.interval
+
+    def acquire(self):
+        """
+        Block until we're allowed to make a request
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquireAsync(self):
+        """
+        Like .acquire(), but doesn't block the event loop
+        """
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def setInterval(self, interval):
+        """
+        Change the interval (e.g. after reading robots.txt).  Already reserved tokens keep
+        their old wait times.
+        """
+        interval = float(interval)
+        with self._lock:
+            now = time.monotonic()
+            if self.interval > 0:
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_time)/self.interval)
+                # reservations we've handed out are a debt in seconds, not in tokens
+                if self._tokens < 0 and interval > 0:
+                    self._tokens *= self.interval/interval
+            self._last_time = now
+            self.interval = interval
+
+    def defer(self, seconds):
+        """
+        Don't let the next request start for at least seconds (e.g. from a Retry-After header).
+        Already reserved tokens keep their old wait times.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.interval > 0:
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_time)/self.interval)
+                self._tokens = min(self._tokens, 1. - float(seconds)/self.interval)
+            self._last_time = now
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A TokenBucket (with a capacity of 1) shared by every process that points at the same
+    sqlite3 file, so several scrapers together still make at most one request per interval.
+
+    The file holds the (wall clock) time at which the next request may start.  Each
+    reservation reads and bumps it in a single immediate transaction, so two processes
+    never get the same slot.
+    """
+    def __init__(self, filename, interval, name='metal-archives'):
+        """
+        Params:
+            filename - sqlite3 file holding the shared schedule; created if it doesn't exist
+            interval - seconds between requests, e.g. the crawl delay from robots.txt
+            name - key of the limit in the file, in case several sites share it
+        """
+        super().__init__(interval)
+        self.filename = str(filename)
+        self.name = str(name)
+
+        # autocommit; .reserve() manages its own transactions
+        self.connection = lite.connect(self.filename, timeout=60., isolation_level=None,
+                                       check_same_thread=False)
+        self.connection.execute("""
+            create table if not exists RateLimits (
+                name text primary key not null,
+                next_time real not null /* unix time */
+            )""")
+
+    def reserve(self):
+        """
+        Take the next free slot and return how many seconds the caller must wait before using it
+        """
+        with self._lock:
+            self.connection.execute('begin immediate')
+            try:
+                row = self.connection.execute('select next_time from RateLimits where name=?',
+                                              (self.name,)).fetchone()
+                now = time.time()
+                start = now if row is None else max(now, row[0])
+                self.connection.execute('insert into RateLimits (name,next_time) values (?,?) ' +
+                                        'on conflict(name) do update set next_time=excluded.next_time',
+                                        (self.name, start + self.interval))
+                self.connection.execute('commit')
+            except:
+                self.connection.execute('rollback')
+                raise
+            return start - now
+
+    def defer(self, seconds):
+        """
+        Don't let any process start a request for at least seconds
+        """
+        with self._lock:
+            self.connection.execute('insert into RateLimits (name,next_time) values (?,?) ' +
+                                    'on conflict(name) do update set next_time=max(next_time,excluded.next_time)',
+                                    (self.name, time.time() + float(seconds)))
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header (either seconds or an HTTP date), or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        logger.debug("Can't parse Retry-After: %s", value)
+        return None
+
+class EndpointStats(object):
+    """
+    Request counts, statuses, and latencies for one endpoint
+    """
+    def __init__(self):
+        self.n_requests = 0
+        self.n_errors = 0
+        self.statuses = collections.Counter()
+        self.total_latency = 0.
+        self.max_latency = 0.
+
+    def add(self, status_code, latency):
+        """
+        Params:
+            status_code - HTTP status, or None if the request failed without a response
+            latency - seconds from sending the request to getting the response
+        """
+        self.n_requests += 1
+        self.statuses[status_code] += 1
+        if status_code is None or status_code >= 400:
+            self.n_errors += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def asDict(self):
+        return {'requests': self.n_requests,
+                'error_rate': self.n_errors/max(self.n_requests, 1),
+                'mean_latency': self.total_latency/max(self.n_requests, 1),
+                'max_latency': self.max_latency,
+                'statuses': dict(self.statuses)}
+
+class AdaptiveRateController(object):
+    """
+    Adjusts a TokenBucket's interval from the responses we get.
+
+    On a 429 or 5xx the interval is multiplied by backoff (up to ceiling), and if the
+    server sent Retry-After, no request starts until that's up.  Each good response
+    relaxes the interval (multiplying by relax) back down to floor, which is the crawl
+    delay from robots.txt; we never go faster than that.
+
+    Also keeps per-endpoint (see utils.get_endpoint_from_url) request telemetry.
+    """
+    def __init__(self, limiter, floor, ceiling=120., backoff=2., relax=0.9, max_retries=5):
+        """
+        Params:
+            limiter - the TokenBucket (or SharedTokenBucket) to adjust
+            floor - shortest interval we'll use, e.g. the crawl delay
+            ceiling - longest interval (and longest Retry-After wait) we'll use
+            backoff - multiply the interval by this on a 429/5xx
+            relax - multiply the interval by this on any other response
+            max_retries - retry a request this many times on a 429/5xx before giving up
+        """
+        self.limiter = limiter
+        self.floor = float(floor)
+        self.ceiling = float(ceiling)
+        self.backoff = float(backoff)
+        self.relax = float(relax)
+        self.max_retries = int(max_retries)
+
+        self._lock = threading.Lock()
+        self.stats = collections.defaultdict(EndpointStats)
+
+    def setFloor(self, floor):
+        """
+        Change the floor (e.g. after reading robots.txt), raising the interval to it if needed
+        """
+        with self._lock:
+            self.floor = float(floor)
+            if self.limiter.interval < self.floor:
+                self.limiter.setInterval(self.floor)
+
+    def recordError(self, url, latency):
+        """
+        Record a request that failed without a response (e.g. a connection error)
+        """
+        with self._lock:
+            self.stats[get_endpoint_from_url(url)].add(None, latency)
+
+    def onResponse(self, url, response, latency):
+        """
+        Record the response and adjust the rate.  Returns True if the request should be retried.
+        """
+        with self._lock:
+            self.stats[get_endpoint_from_url(url)].add(response.status_code, latency)
+
+            if response.status_code not in RETRY_STATUSES:
+                if self.limiter.interval > self.floor:
+                    self.limiter.setInterval(max(self.floor, self.limiter.interval*self.relax))
+                return False
+
+            interval = min(self.ceiling, max(self.floor, self.limiter.interval*self.backoff))
+            self.limiter.setInterval(interval)
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                self.limiter.defer(min(retry_after, self.ceiling))
+            logger.warning('Got response status %d for %s; crawl interval is now %.2fs%s',
+                           response.status_code, url, interval,
+                           '' if retry_after is None else ' (Retry-After {:.0f}s)'.format(retry_after))
+            return True
+
+    def summary(self):
+        """
+        Return a dict of endpoint: telemetry dict (requests, error_rate, latencies, statuses)
+        """
+        with self._lock:
+            return {endpoint: stats.asDict() for endpoint, stats in sorted(self.stats.items())}
+
+    def logSummary(self):
+        for endpoint, stats in self.summary().items():
+            logger.info('%s: %d requests, %.1f%% errors, %.3fs mean latency, %.3fs max latency, statuses %s',
+                        endpoint, stats['requests'], 100*stats['error_rate'],
+                        stats['mean_latency'], stats['max_latency'], stats['statuses'])
@@ -0,0 +1,112 @@
+"""
+Rebuild the band tables from the pages kept in a response archive (see responseArchive.py and
+band_page_scraper.py --archive), instead of crawling them all again.
+
+The latest archived copy of each band's pages is parsed in a pool of processes, and the
+results are stored just like BandPageScraper stores a fresh scrape.
+"""
+import argparse, concurrent.futures, os
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+import tqdm
+
+from band_page_scraper import BandPageScraper
+from baseScraper import PARSER_BACKENDS
+from deadLetters import ScrapeFailure
+from responseArchive import ResponseArchive
+from utils import *
+
+BAND_ENDPOINTS = ('band_page', 'read_more', 'recommendations', 'discography')
+
+# set up in each worker process by init_worker
+_archive = None
+_scraper = None
+
+def init_worker(archive_directory, soup_features):
+    global _archive, _scraper
+    _archive = ResponseArchive(archive_directory, read_only=True)
+    _scraper = BandPageScraper(None, soup_features=soup_features)
+
+def parse_band(item):
+    """
+    Parse one band's archived pages.  item is (band_id, {endpoint: (segment, offset, size)}).
+    Returns (band_id, results of BandPageScraper.parseBand, None), or (band_id, None, error).
+    """
+    band_id, locations = item
+    pages = {endpoint: _archive.read(*location).decode('utf-8')
+             for endpoint, location in locations.items()}
+    try:
+        return band_id, _scraper.parseBand(band_id, pages), None
+    except ScrapeFailure as e:
+        return band_id, None, str(e)
+
+def main(database_filename, archive_directory, endpoints=BAND_ENDPOINTS, workers=None, limit=-1,
+         soup_features='html5lib', commit_every=100, chunksize=16):
+    """
+    Parse the latest archived pages (of endpoints) of every band in the archive and store
+    the results in the database.  Returns the number of bands that failed to parse.
+    """
+    archive = ResponseArchive(archive_directory, read_only=True)
+    try:
+        bands = archive.latest(endpoints)
+    finally:
+        archive.close()
+
+    work = sorted(bands.items())
+    if limit >= 0:
+        work = work[:limit]
+    logger.info('Reparsing %d bands with %s workers', len(work), workers or os.cpu_count())
+
+    scraper = BandPageScraper(database_filename, soup_features=soup_features, commit_every=commit_every)
+    n_failed = 0
+    with lite.connect(database_filename, isolation_level='IMMEDIATE') as scraper.connection:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                    initargs=(archive_directory, soup_features)) as pool:
+            try:
+                for band_id, results, error in tqdm.tqdm(pool.map(parse_band, work, chunksize=chunksize),
+                                                         total=len(work)):
+                    if error is not None:
+                        logger.warning('Failed to parse band_id=%d: %s', band_id, error)
+                        n_failed += 1
+                        continue
+                    scraper.storeBand(band_id, results)
+            finally:
+                scraper.commitStored()
+
+    scraper.close()
+    if n_failed:
+        logger.warning('Failed to parse %d of %d bands', n_failed, len(work))
+    return n_failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the band tables from a response archive')
+    parser.add_argument('database', type=str,
+                        help='Filename of sqlite3 database; must already exist and have basic band info')
+    parser.add_argument('archive', type=str,
+                        help='Directory of the response archive (see band_page_scraper.py --archive)')
+    parser.add_argument('--endpoints', type=str, nargs='+', default=list(BAND_ENDPOINTS), choices=BAND_ENDPOINTS,
+                        help='Only reparse these pages of each band')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of parser processes (default: number of CPUs)')
+    parser.add_argument('--limit', type=int, default=-1,
+                        help='Only reparse this many bands')
+    parser.add_argument('--commit-every', type=int, default=100,
+                        help='Commit the database every --commit-every bands')
+    BandPageScraper.addParserArgument(parser)
+
+    #subparsers?
+    parser.add_argument('--logging-level', type=int, default=logging.WARNING,
+                        help="Set the logging level")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
+
+    main(args.database, args.archive,
+         endpoints=args.endpoints,
+         workers=args.workers,
+         limit=args.limit,
+         soup_features=args.parser,
+         commit_every=args.commit_every)
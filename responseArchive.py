@@ -0,0 +1,156 @@
+import os, struct, threading, time, zlib
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+from utils import get_endpoint_from_url, get_band_id_from_url
+
+# Each record in a segment is a header (magic, length of the compressed body) followed by
+# the zlib compressed body, so a segment can be read (and the index rebuilt) on its own.
+RECORD_MAGIC = b'MAR1'
+RECORD_HEADER = struct.Struct('<4sI')
+
+class ResponseArchive(object):
+    """
+    Append-only archive of every response body we fetch, so that pages can be parsed
+    again (see reparse.py) without crawling them again.
+
+    Bodies are zlib compressed and appended to segment files (segment-000001.dat, ...) in
+    a directory; a new segment is started once the current one passes segment_bytes.
+    Nothing is ever overwritten.  The index (index.sqlite3 in the same directory) maps
+    (band_id, endpoint, fetch_time) to where each body is.
+
+    Several processes (e.g. scrape queue workers) can append to the same archive: each
+    append holds the index's write lock from finding the end of the segment to recording
+    the offset.
+    """
+    def __init__(self, directory, segment_bytes=256*1024**2, read_only=False):
+        """
+        Params:
+            directory - where to keep the segments and the index; created if it doesn't exist
+            segment_bytes - start a new segment once the current one is this big
+            read_only - only read from the archive (e.g. in reparse workers)
+        """
+        self.directory = str(directory)
+        self.segment_bytes = int(segment_bytes)
+        self.read_only = bool(read_only)
+
+        index_filename = os.path.join(self.directory, 'index.sqlite3')
+        self._lock = threading.Lock()
+        if self.read_only:
+            self.connection = lite.connect(f'file:{index_filename}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            # other processes appending hold the write lock for a bit, so wait for it
+            self.connection = lite.connect(index_filename, timeout=60., check_same_thread=False)
+            self.connection.executescript("""
+                create table if not exists Archive (
+                    id integer primary key,
+                    band_id integer, /* null for pages that aren't a band's */
+                    endpoint text,
+                    url text, /* full URL, including query string */
+                    fetch_time real, /* unix time */
+                    segment integer,
+                    offset integer, /* of the compressed body in the segment */
+                    size integer /* of the compressed body */
+                );
+                create index if not exists ArchiveBandEndpointTime on Archive (band_id, endpoint, fetch_time);
+                """)
+            self.connection.commit()
+
+        self._segment = None
+        self._segment_handle = None
+        self._read_handles = {}
+
+    def segmentFilename(self, segment):
+        return os.path.join(self.directory, 'segment-{:06d}.dat'.format(segment))
+
+    def openSegment(self):
+        """
+        Open the segment to append to (the last one in the index), starting a new one if it's
+        full, and seek to its end.  Should be called with self._lock and the index's write
+        lock held, since other processes may have appended (or started a segment) since.
+        """
+        segment = self.connection.execute('select coalesce(max(segment), 1) from Archive').fetchone()[0]
+        if self._segment_handle is None or segment != self._segment:
+            if self._segment_handle is not None:
+                self._segment_handle.close()
+            self._segment = segment
+            self._segment_handle = open(self.segmentFilename(self._segment), 'ab')
+
+        while self._segment_handle.seek(0, os.SEEK_END) >= self.segment_bytes:
+            self._segment_handle.close()
+            self._segment += 1
+            self._segment_handle = open(self.segmentFilename(self._segment), 'ab')
+        return self._segment_handle
+
+    def append(self, url, content, fetch_time=None):
+        """
+        Archive the body (bytes) of a response for url (the full URL, including query string)
+        """
+        if self.read_only:
+            raise RuntimeError("Can't append to a read-only archive")
+
+        body = zlib.compress(content)
+        fetch_time = time.time() if fetch_time is None else fetch_time
+        with self._lock:
+            # the write lock keeps other processes out of the segment until the offset is recorded
+            self.connection.execute('begin immediate')
+            try:
+                handle = self.openSegment()
+                handle.write(RECORD_HEADER.pack(RECORD_MAGIC, len(body)))
+                offset = handle.tell()
+                handle.write(body)
+                handle.flush()
+
+                self.connection.execute('insert into Archive (band_id,endpoint,url,fetch_time,segment,offset,size) '
+                                        'values (?,?,?,?,?,?,?)',
+                                        (get_band_id_from_url(url), get_endpoint_from_url(url), url, fetch_time,
+                                         self._segment, offset, len(body)))
+            except BaseException:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+
+    def read(self, segment, offset, size):
+        """
+        Return the body (bytes) stored at offset in segment
+        """
+        with self._lock:
+            handle = self._read_handles.get(segment)
+            if handle is None:
+                handle = self._read_handles[segment] = open(self.segmentFilename(segment), 'rb')
+            handle.seek(offset)
+            body = handle.read(size)
+        return zlib.decompress(body)
+
+    def latest(self, endpoints, band_ids=None):
+        """
+        Return a dict of band_id: {endpoint: (segment, offset, size)} with the most recently
+        fetched body of each of the band's pages in endpoints (all bands, or just band_ids)
+        """
+        query = ('select band_id,endpoint,segment,offset,size,max(fetch_time) from Archive '
+                 'where band_id is not null and endpoint in ({}) '.format(','.join('?'*len(endpoints))))
+        params = list(endpoints)
+        if band_ids is not None:
+            band_ids = list(band_ids)
+            query += 'and band_id in ({}) '.format(','.join('?'*len(band_ids)))
+            params += band_ids
+        query += 'group by band_id,endpoint'
+
+        bands = {}
+        with self._lock:
+            # with max(), sqlite takes the other columns from the row with the max
+            for band_id, endpoint, segment, offset, size, _ in self.connection.execute(query, params):
+                bands.setdefault(band_id, {})[endpoint] = (segment, offset, size)
+        return bands
+
+    def close(self):
+        with self._lock:
+            if self._segment_handle is not None:
+                self._segment_handle.close()
+                self._segment_handle = None
+            for handle in self._read_handles.values():
+                handle.close()
+            self._read_handles = {}
+            self.connection.close()
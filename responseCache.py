@@ -0,0 +1,234 @@
+import json, threading, time, zlib
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+import requests
+
+from utils import get_endpoint_from_url
+
+# Default time-to-live (seconds) for cached responses, per endpoint (see utils.get_endpoint_from_url).
+# None means the cached response never expires.
+DAY = 24*60*60
+DEFAULT_TTLS = {'band_page': 30*DAY,
+                'read_more': 30*DAY,
+                'recommendations': 30*DAY,
+                'discography': 30*DAY,
+                'band_list': 7*DAY,
+                'review_list': 7*DAY,
+                'other': DAY,
+                }
+
+class ReplayMiss(RuntimeError):
+    """
+    Raised in replay-only mode when a request isn't in the cache.
+    """
+    pass
+
+class ResponseCache(object):
+    """
+    Persistent, compressed store of HTTP responses, keyed by the full request URL
+    (including the query string built from params).
+
+    Only 200 responses are stored.  Bodies are zlib compressed and kept in a small
+    sqlite3 database.  When the total (compressed) size exceeds max_bytes, the least
+    recently used responses are evicted.
+    """
+    def __init__(self, cache_filename, max_bytes=2*1024**3, ttls=None, replay_only=False):
+        """
+        Params:
+            cache_filename - sqlite3 file to keep the responses in; created if it doesn't exist
+            max_bytes - evict least recently used responses when the store grows past this
+            ttls - dict of endpoint: seconds, overriding DEFAULT_TTLS
+            replay_only - never touch the network; a miss raises ReplayMiss.  Expired
+                          responses are still served in this mode.
+        """
+        self.cache_filename = str(cache_filename)
+        self.max_bytes = int(max_bytes)
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.replay_only = bool(replay_only)
+
+        # The scrapers may call us from a few threads (pipelined/async modes)
+        self._lock = threading.Lock()
+        self.connection = lite.connect(self.cache_filename, check_same_thread=False)
+        self.connection.executescript("""
+            create table if not exists Responses (
+                url text primary key not null, /* full URL, including query string */
+                endpoint text,
+                status_code integer,
+                headers text, /* JSON */
+                body blob, /* zlib compressed */
+                size integer, /* len(body) */
+                fetch_time real, /* unix time */
+                access_time real /* unix time */
+            );
+            create index if not exists Responses_access_time on Responses (access_time);
+            """)
+        self.connection.commit()
+
+        self._total_bytes = self.connection.execute(
+            'select coalesce(sum(size), 0) from Responses').fetchall()[0][0]
+
+        self.hits = 0
+        self.misses = 0
+
+        logger.info('Opened response cache %s (%d bytes, replay_only=%s)',
+                    self.cache_filename, self._total_bytes, self.replay_only)
+
+    @staticmethod
+    def makeKey(url, params=None):
+        """
+        Return the full URL requests would use for url and params.  Params are sorted
+        so that the key doesn't depend on dict ordering.
+        """
+        if params:
+            params = sorted(params.items()) if isinstance(params, dict) else sorted(params)
+        return requests.Request('GET', url, params=params).prepare().url
+
+    def get(self, url, params=None):
+        """
+        Return a cached requests.Response for url and params, or None if we don't have a
+        fresh one.  In replay-only mode, a miss raises ReplayMiss.
+        """
+        key = self.makeKey(url, params)
+        with self._lock:
+            rows = self.connection.execute('select endpoint,status_code,headers,body,fetch_time '
+                                           'from Responses where url=?', (key,)).fetchall()
+
+            now = time.time()
+            if rows:
+                endpoint, status_code, headers, body, fetch_time = rows[0]
+                ttl = self.ttls.get(endpoint)
+                if self.replay_only or ttl is None or now - fetch_time < ttl:
+                    self.connection.execute('update Responses set access_time=? where url=?', (now, key))
+                    self.connection.commit()
+                    self.hits += 1
+                    return self.makeResponse(key, status_code, headers, body)
+                logger.debug('Cached response for %s has expired', key)
+
+            self.misses += 1
+            if self.replay_only:
+                raise ReplayMiss('No cached response for {}'.format(key))
+            return None
+
+    def put(self, url, params, response):
+        """
+        Store response (a requests.Response) for url and params.  Non-200 responses aren't stored.
+        """
+        if response.status_code != 200:
+            return
+
+        key = self.makeKey(url, params)
+        endpoint = get_endpoint_from_url(key)
+        body = zlib.compress(response.content)
+        headers = json.dumps(dict(response.headers))
+        now = time.time()
+
+        with self._lock:
+            old_size = self.connection.execute('select size from Responses where url=?', (key,)).fetchall()
+            if old_size:
+                self._total_bytes -= old_size[0][0]
+
+            self.connection.execute('insert or replace into Responses '
+                                    '(url,endpoint,status_code,headers,body,size,fetch_time,access_time) '
+                                    'values (?,?,?,?,?,?,?,?)',
+                                    (key, endpoint, response.status_code, headers, body, len(body), now, now))
+            self._total_bytes += len(body)
+
+            if self._total_bytes > self.max_bytes:
+                self.evict()
+
+            self.connection.commit()
+
+    def touch(self, url, params=None):
+        """
+        Mark the cached response for url and params as freshly fetched, e.g. after the
+        server told us it hasn't changed (304).
+        """
+        key = self.makeKey(url, params)
+        now = time.time()
+        with self._lock:
+            self.connection.execute('update Responses set fetch_time=?,access_time=? where url=?',
+                                    (now, now, key))
+            self.connection.commit()
+
+    def evict(self):
+        """
+        Drop least recently used responses until we're under 90% of max_bytes.
+        Should be called with self._lock held.
+        """
+        target = int(0.9*self.max_bytes)
+        logger.debug('Evicting responses from cache (%d > %d bytes)', self._total_bytes, self.max_bytes)
+
+        cur = self.connection.cursor()
+        evict_urls = []
+        for url, size in cur.execute('select url,size from Responses order by access_time asc'):
+            if self._total_bytes <= target:
+                break
+            evict_urls.append((url,))
+            self._total_bytes -= size
+        cur.close()
+
+        self.connection.executemany('delete from Responses where url=?', evict_urls)
+        logger.info('Evicted %d responses from cache', len(evict_urls))
+
+    @staticmethod
+    def makeResponse(url, status_code, headers, body):
+        """
+        Build a requests.Response out of what we stored, so that callers can use
+        .text, .json(), etc. just like with a fresh response.
+        """
+        response = requests.Response()
+        response.url = url
+        response.status_code = status_code
+        response.reason = 'OK'
+        response.headers = requests.structures.CaseInsensitiveDict(json.loads(headers))
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = zlib.decompress(body)
+        response.from_cache = True
+        return response
+
+    def close(self):
+        logger.info('Closing response cache %s (%d hits, %d misses)', self.cache_filename, self.hits, self.misses)
+        with self._lock:
+            self.connection.close()
+
+def add_cache_arguments(parser):
+    """
+    Add the response cache CLI arguments to an argparse.ArgumentParser
+    """
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Filename of a sqlite3 response cache; responses are replayed from '
+                        'here when fresh and recorded here otherwise')
+    parser.add_argument('--cache-max-mb', type=int, default=2048,
+                        help='Evict least recently used responses when the cache grows past this many MB')
+    parser.add_argument('--cache-ttl', type=str, action='append', default=[],
+                        help='Per-endpoint TTL override of the form endpoint=seconds, e.g. '
+                        'band_page=86400.  Endpoints: {}'.format(', '.join(DEFAULT_TTLS)))
+    parser.add_argument('--replay-only', action='store_true',
+                        help='Only use responses from --cache; never touch the network')
+
+def cache_from_args(args):
+    """
+    Make a ResponseCache from parsed CLI arguments (see add_cache_arguments), or None if
+    --cache wasn't given.
+    """
+    if args.replay_only and not args.cache:
+        raise ValueError('--replay-only requires --cache')
+
+    if not args.cache:
+        return None
+
+    ttls = {}
+    for ttl in args.cache_ttl:
+        endpoint, seconds = ttl.split('=')
+        if endpoint not in DEFAULT_TTLS:
+            raise ValueError('Unknown endpoint {} in --cache-ttl'.format(endpoint))
+        ttls[endpoint] = float(seconds)
+
+    return ResponseCache(args.cache,
+                         max_bytes=args.cache_max_mb*1024**2,
+                         ttls=ttls,
+                         replay_only=args.replay_only)
@@ -1,29 +1,61 @@
-import argparse, datetime, os, json, csv
+import argparse, asyncio, datetime, os, json, csv
+import sqlite3 as lite
 import logging
 logger = logging.getLogger(__name__)
 
-import bs4
-
-from baseScraper import BaseScraper
+from asyncBaseScraper import AsyncBaseScraper
+from checkpoint import Checkpoint, sync_file
+from insert_basic_info import InsertBasicInfo
+from fragments import parse_review_rows
+from responseCache import add_cache_arguments, cache_from_args
+from utils import *
  
-class ReviewListScraper(BaseScraper):
+class ReviewListScraper(AsyncBaseScraper):
     """
     Collects brief review info from https://www.metal-archives.com/review/browse
     """
-    def __init__(self, outfile='', start='200207', stop=''):
+    def __init__(self, outfile='', start='200207', stop='', use_async=False, max_in_flight=4,
+                 soup_features='html5lib', cache=None, resume=False, database_filename=None, incremental_database=None):
         """
         Params:
             outfile - where to put CSV
             test - do a shorter test instead of a full run
+            use_async - make the requests for each month concurrently (still at most one
+                        request per crawl delay); see AsyncBaseScraper
+            max_in_flight - most requests in flight at once with use_async
+            soup_features - BeautifulSoup parser backend ('html5lib', 'lxml', or 'html.parser')
+            cache - a responseCache.ResponseCache to replay/record responses
+            resume - continue from the checkpoint for outfile (if there is one), appending
+                     to outfile
+            database_filename - insert each page straight into this sqlite3 database (see
+                                InsertBasicInfo) instead of writing a CSV
+            incremental_database - only get reviews newer than the newest one in this sqlite3
+                                   database: start at the month of max(Reviews.modified_date)
+                                   (instead of start), and stop paging through a month once
+                                   we reach reviews already in the database (as long as the
+                                   pages really come newest first).  The list pages are
+                                   always fetched again, never served from the cache.
         """
-        super().__init__()
+        super().__init__(max_in_flight=max_in_flight, cache=cache, soup_features=soup_features)
+        
+        self.inserter = None
+        if database_filename:
+            self.inserter = InsertBasicInfo(database_filename)
+            # only used to name the checkpoint
+            outfile = database_filename + '.review_list'
+        
+        if resume and not outfile:
+            raise ValueError('Need the outfile to resume')
         
         if not outfile:
             date = datetime.datetime.utcnow()
             date_str = date.strftime('%Y%m%d_%H%M%S')
             outfile = 'metal-archives_review_list_' + date_str + '.csv'
         self.outfile = str(outfile)
-        print('Will output band data to', self.outfile)
+        if self.inserter is None:
+            print('Will output review data to', self.outfile)
+        else:
+            print('Will insert review data into', database_filename)
         
         self.start = datetime.date(year=int(start[0:4]), month=int(start[4:6]), day=1)
         
@@ -32,6 +64,23 @@ class ReviewListScraper(BaseScraper):
         else:
             self.stop = datetime.date(year=int(stop[0:4]), month=int(stop[4:6]), day=1)
         
+        self.use_async = bool(use_async)
+        
+        self.known_reviews = None
+        self.n_new_reviews = 0
+        # stop paging through a month at the first review we have (see writeReviewData)
+        self.stop_at_known = False
+        if incremental_database:
+            self.loadKnownReviews(incremental_database)
+            self.stop_at_known = True
+            if self.cache is not None:
+                # a stale first page from the cache would look like there's nothing new
+                self.cache.ttls['review_list'] = 0
+        
+        self.resume = bool(resume)
+        self.checkpoint = Checkpoint(Checkpoint.filenameFor(self.outfile))
+        self.records_before = 0
+        
         # seems their API requires getting 200 reviews at a time 
         self.display_length = 200
         
@@ -39,8 +88,12 @@ class ReviewListScraper(BaseScraper):
         """
         Do the stuff.  Will close things at the end of .run()
         """
+        state = self.checkpoint.load() if self.resume else None
+        if self.resume and state is None:
+            print('No checkpoint for "{}"; starting from the beginning'.format(self.outfile))
+        
         # check if the output file already exists and ask the user if they wish to overwrite
-        if os.path.isfile(self.outfile):
+        if self.inserter is None and state is None and os.path.isfile(self.outfile):
             print('The outfile "{}" already exists.'.format(self.outfile))
             response = input('Overwrite (y/n): ').lower()
             if response != 'y':
@@ -49,48 +102,186 @@ class ReviewListScraper(BaseScraper):
             else:
                 print('Okay, will overwrite')
         
-        self.openOutfile()
+        self.openOutfile(state['offset'] if state else None)
+        self.records_before = state['records_before'] if state else 0
+        work = self.remainingWork(state)
         
-        total_records_sum = 0
+        if self.use_async:
+            self.runOnEventLoop(self.runAsync, work)
+        else:
+            for (year, month), last_start, total_records in work:
+                self.scrapeMonth(year, month, last_start, total_records)
         
+        self.close()
+        self.closeOutfile()
+        self.checkpoint.remove()
+        
+        if self.inserter is not None:
+            print('Inserted {} reviews into {}'.format(self.n_new_reviews, self.inserter.database_filename))
+        elif self.known_reviews is None:
+            print('There should be {} rows in {}'.format(self.records_before+1, self.outfile))
+        else:
+            print('Wrote {} new reviews to {}'.format(self.n_new_reviews, self.outfile))
+    
+    def loadKnownReviews(self, database_filename):
+        """
+        Find the newest review in the database, start from its month, and remember the
+        reviews we already have from that month on (as (band_id, album_id, user_id)).
+        """
+        if not os.path.isfile(database_filename):
+            raise ValueError("Database file {} doesn't exist".format(database_filename))
+        
+        with lite.connect(database_filename) as connection:
+            newest, = connection.execute('select max(modified_date) from Reviews').fetchone()
+            if newest is None:
+                print('No reviews in {}; doing a full scrape'.format(database_filename))
+                self.known_reviews = set()
+                return
+            
+            newest = datetime.datetime.strptime(newest, '%Y-%m-%d %H:%M:%S')
+            self.start = datetime.date(year=newest.year, month=newest.month, day=1)
+            self.known_reviews = set(connection.execute(
+                'select band_id,album_id,user_id from Reviews where modified_date >= ?',
+                (self.start.strftime('%F'),)))
+        
+        print('Newest review in {} is from {}; starting at {} with {} known reviews'.format(
+            database_filename, newest, self.start.strftime('%Y-%m'), len(self.known_reviews)))
+    
+    def months(self):
+        """
+        Return a list of (year, month) from self.start to self.stop, inclusive
+        """
         start_year = self.start.year
         start_month = self.start.month
         
         stop_year = self.stop.year
         stop_month = self.stop.month
         
+        months = []
         for year in range(start_year, stop_year+1):
             for month in range(start_month if year == start_year else 1,
                                stop_month+1 if year == stop_year else 12+1):
+                months.append((year, month))
+        return months
+    
+    def remainingWork(self, state):
+        """
+        Return a list of ((year, month), last_start, total_records) still to do, given
+        the state from the checkpoint (or None to do everything).  last_start and
+        total_records are None for months we haven't started.
+        """
+        months = self.months()
+        if state is None:
+            return [(year_month, None, None) for year_month in months]
+        
+        key = tuple(state['key'])
+        if key not in months:
+            raise ValueError('Checkpoint {} is for {:04d}-{:02d}, which is not between --start and --stop'.format(
+                self.checkpoint.filename, *key))
+        
+        print('Resuming from {:04d}-{:02d} after start={}'.format(*key, state['last_start']))
+        i = months.index(key)
+        return ([(key, state['last_start'], state['total_records'])]
+                + [(year_month, None, None) for year_month in months[i+1:]])
+    
+    def scrapeMonth(self, year, month, last_start=None, total_records=None):
+        """
+        Get all the reviews for one month and write them to the outfile, starting after
+        last_start if given (when resuming).
+        Returns the total number of records for the month.
+        """
+        date_str = '{:04d}-{:02d}'.format(year, month)
+        print('Getting stuff for ', date_str)
+        
+        if last_start is None:
+            # Make the first request
+            # That will tell us the total number of entries for this month
+            data = self.makeRequest(date_str, start=0)
             
-                date_str = '{:04d}-{:02d}'.format(year, month)
-                print('Getting stuff for ', date_str)
-                
-                # Make the first request
-                # That will tell us the total number of entries for this month
-                start = 0
-                data = self.makeRequest(date_str, start=start)
+            reached_known = self.writeReviewData(data['aaData'], year, month)
+            
+            total_records = data['iTotalRecords']
+            self.saveCheckpoint(year, month, 0, total_records)
+            if reached_known:
+                print('Reached reviews we already have; done with', date_str)
+                last_start = total_records
+        
+        # Now make all the other requests
+        for start in self.remainingStarts(date_str, total_records, last_start):
+            data = self.makeRequest(date_str, start=start)
+            
+            reached_known = self.writeReviewData(data['aaData'], year, month)
+            self.saveCheckpoint(year, month, start, total_records)
+            if reached_known:
+                print('Reached reviews we already have; done with', date_str)
+                break
+        
+        self.records_before += total_records
+        return total_records
+    
+    async def runAsync(self, work):
+        """
+        Like the sequential part of .run(), but each month's requests after the first
+        are in flight concurrently.  Results are still written (and checkpointed) in order.
+        """
+        for (year, month), last_start, total_records in work:
+            date_str = '{:04d}-{:02d}'.format(year, month)
+            print('Getting stuff for ', date_str)
             
-                self.writeReviewData(data['aaData'], year, month)
-           
+            if last_start is None:
+                data = await self.makeRequestAsync(date_str, start=0)
+                reached_known = self.writeReviewData(data['aaData'], year, month)
+                
                 total_records = data['iTotalRecords']
-                total_records_sum += total_records
-                print('There are {} records for {}'.format(total_records, date_str))
+                self.saveCheckpoint(year, month, 0, total_records)
+                if reached_known:
+                    print('Reached reviews we already have; done with', date_str)
+                    last_start = total_records
             
-                n_do = max(0, total_records - self.display_length) // self.display_length + 1
-                print('Going to do {} more requests'.format(n_do))
+            starts = self.remainingStarts(date_str, total_records, last_start)
+            tasks = [asyncio.ensure_future(self.makeRequestAsync(date_str, start=start))
+                     for start in starts]
+            try:
+                for start, task in zip(starts, tasks):
+                    data = await task
+                    reached_known = self.writeReviewData(data['aaData'], year, month)
+                    self.saveCheckpoint(year, month, start, total_records)
+                    if reached_known:
+                        # the requests still in flight are cancelled below
+                        print('Reached reviews we already have; done with', date_str)
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
             
-                # Now make all the other requests
-                for _ in range(n_do):
-                    start += self.display_length
-                    data = self.makeRequest(date_str, start=start)
-           
-                    self.writeReviewData(data['aaData'], year, month)
+            self.records_before += total_records
         
-        self.close()
-        self.closeOutfile()
+        return self.records_before
+    
+    def saveCheckpoint(self, year, month, start, total_records):
+        """
+        Record that the page for (year, month) at start is safely in the outfile
+        """
+        self.checkpoint.save({'key': [year, month],
+                              'last_start': start,
+                              'total_records': total_records,
+                              'records_before': self.records_before,
+                              'offset': sync_file(self.outfile_handle) if self.inserter is None else None})
+    
+    def remainingStarts(self, date_str, total_records, last_start=None):
+        """
+        Return the iDisplayStart values of the requests after the first (and after
+        last_start, if given)
+        """
+        print('There are {} records for {}'.format(total_records, date_str))
+        
+        n_do = max(0, total_records - self.display_length) // self.display_length + 1
+        starts = [self.display_length*(i+1) for i in range(n_do)]
+        if last_start is not None:
+            starts = [start for start in starts if start > last_start]
+        print('Going to do {} more requests'.format(len(starts)))
         
-        print('There should be {} rows in {}'.format(total_records_sum+1, self.outfile))
+        return starts
     
     def close(self):
         super().close()
@@ -99,6 +290,22 @@ class ReviewListScraper(BaseScraper):
         """
         Make a GET request and return the JSON response as a dict
         """
+        url, payload = self.requestArgs(date_str, start)
+        response = self.sessionGet(url, params=payload)
+        return self.parseResponse(response)
+    
+    async def makeRequestAsync(self, date_str, start=0):
+        """
+        Like .makeRequest(), but async
+        """
+        url, payload = self.requestArgs(date_str, start)
+        response = await self.asyncSessionGet(url, params=payload)
+        return self.parseResponse(response)
+    
+    def requestArgs(self, date_str, start):
+        """
+        Return the URL and params for the request for date_str starting at start
+        """
         url = self.base_url + '/review/ajax-list-browse/by/date/selection/' + str(date_str) + '/json/1'
         
         if start % self.display_length != 0:
@@ -108,10 +315,15 @@ class ReviewListScraper(BaseScraper):
         payload = {'sEcho': '',
                    'iDisplayStart': start,
                    'iDisplayLength': self.display_length}
+        if self.known_reviews is not None:
+            # newest first (column 0 is the date), so we can stop at the first known review
+            payload['iSortCol_0'] = 0
+            payload['sSortDir_0'] = 'desc'
         
         print('Making request for date_str={} start={}'.format(date_str, start))
-        response = self.sessionGet(url, params=payload)
-        
+        return url, payload
+    
+    def parseResponse(self, response):
         try:
             data = response.json()
         except json.JSONDecodeError as e:
@@ -120,15 +332,29 @@ class ReviewListScraper(BaseScraper):
         
         return data
     
-    def openOutfile(self):
-        self.outfile_handle = open(self.outfile, 'w')
+    def openOutfile(self, offset=None):
+        """
+        Open the outfile and write the header, or, when resuming, cut the outfile back
+        to offset (the end of the last checkpointed page) and append to it.
+        With a database, just connect to it.
+        """
+        if self.inserter is not None:
+            self.inserter.connect()
+            return
         
         fieldnames = ('year', 'month', 'day', 'hour', 'minute',
                       'band', 'band_url', 'album', 'album_url',
                       'review_title', 'review_url', 'review_percentage',
                       'reviewer', 'reviewer_url')
-        self.outfile_writer = csv.DictWriter(self.outfile_handle, fieldnames)
-        self.outfile_writer.writeheader()
+        if offset is None:
+            self.outfile_handle = open(self.outfile, 'w')
+            self.outfile_writer = csv.DictWriter(self.outfile_handle, fieldnames)
+            self.outfile_writer.writeheader()
+        else:
+            self.outfile_handle = open(self.outfile, 'r+')
+            self.outfile_handle.truncate(offset)
+            self.outfile_handle.seek(0, os.SEEK_END)
+            self.outfile_writer = csv.DictWriter(self.outfile_handle, fieldnames)
     
     def writeReviewData(self, review_data, year, month):
         """
@@ -143,48 +369,55 @@ class ReviewListScraper(BaseScraper):
              '<a href="https://www.metal-archives.com/users/Cosmic%20Mystery" class="profileMenu">Cosmic Mystery</a>',
              '23:18']
         
-        and cleans it up a bit.
+        and cleans it up a bit (see fragments.parse_review_rows, which parses the whole page at once).
+        
+        With a database, inserts the page into Reviews/Albums/Users in one transaction instead.
+        
+        In incremental mode, only writes the reviews we don't already have.  Returns True if
+        the page had a review we already have (so the rest of the month is old news).  That
+        relies on the page being sorted newest first; if one isn't, we stop trusting the
+        sort order and page through every month in full (still only writing new reviews).
         """
-        for review in review_data:
-            day = int(review[0].split()[1])
-            hour, minute = map(int, review[6].split(':'))
-            
-            review_percentage = int(review[4][:-1])
-            
-            review_soup = bs4.BeautifulSoup(review[1], 'html5lib')
-            band_soup = bs4.BeautifulSoup(review[2], 'html5lib')
-            album_soup = bs4.BeautifulSoup(review[3], 'html5lib')
-            reviewer_soup = bs4.BeautifulSoup(review[5], 'html5lib')
-            
-            review_url = review_soup.a.get('href')
-            review_title = review_soup.a.get('title')
-            
-            band_url = band_soup.a.get('href')
-            band = band_soup.a.text
-            
-            album_url = album_soup.a.get('href')
-            album = album_soup.a.text
-            
-            reviewer_url = reviewer_soup.a.get('href')
-            reviewer = reviewer_soup.a.text
-
-            self.outfile_writer.writerow({'year': year,
-                                          'month': month,
-                                          'day': day,
-                                          'hour': hour,
-                                          'minute': minute,
-                                          'band': band,
-                                          'band_url': band_url,
-                                          'album': album,
-                                          'album_url': album_url,
-                                          'review_title': review_title,
-                                          'review_url': review_url,
-                                          'review_percentage': review_percentage,
-                                          'reviewer': reviewer,
-                                          'reviewer_url': reviewer_url})
+        rows = parse_review_rows(review_data, year, month, self.soup_features)
+        new_rows = rows
+        if self.known_reviews is not None:
+            new_rows = [row for row in rows if self.reviewKey(row) not in self.known_reviews]
+            if self.stop_at_known and not self.isNewestFirst(rows):
+                print('Reviews for {:04d}-{:02d} are not sorted newest first; '
+                      'getting every page from now on'.format(year, month))
+                self.stop_at_known = False
+        
+        if self.inserter is None:
+            self.outfile_writer.writerows(new_rows)
+        else:
+            with self.inserter.connection:
+                self.inserter.insertReviewRows(new_rows)
+        self.n_new_reviews += len(new_rows)
+        
+        return self.stop_at_known and len(new_rows) < len(rows)
+    
+    @staticmethod
+    def isNewestFirst(rows):
+        """
+        Whether rows from parse_review_rows are sorted by date, newest first
+        """
+        dates = [(row['day'], row['hour'], row['minute']) for row in rows]
+        return all(a >= b for a, b in zip(dates, dates[1:]))
+    
+    @staticmethod
+    def reviewKey(row):
+        """
+        (band_id, album_id, user_id) for a row from parse_review_rows, like the primary key of Reviews
+        """
+        return (get_band_id_from_band_url(row['band_url']),
+                get_album_id_from_album_url(row['album_url']),
+                get_user_id_from_review_url(row['review_url']))
 
     def closeOutfile(self):
-        self.outfile_handle.close()
+        if self.inserter is not None:
+            self.inserter.close()
+        else:
+            self.outfile_handle.close()
         
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Scrape metal-archives.com for all reviews.')
@@ -194,13 +427,34 @@ if __name__ == '__main__':
                         help='Start date in YYYYMM form.  Earliest is 200207.')
     parser.add_argument('--stop', type=str, default='',
                         help='Stop date in YYYYMM form.  Defaults to now')
+    parser.add_argument('--database', type=str, default=None,
+                        help='Insert into this sqlite3 database (must already exist) instead of writing a CSV')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue a run that died, from the checkpoint next to --outfile')
+    parser.add_argument('--incremental', type=str, default=None, metavar='DATABASE',
+                        help='Only get reviews newer than the newest in this database (overrides --start)')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Make requests concurrently (still at most one per crawl delay)')
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help='Most requests in flight at once with --async')
+    ReviewListScraper.addParserArgument(parser)
+    add_cache_arguments(parser)
 
 
     args = parser.parse_args()
+    if args.resume and not (args.outfile or args.database):
+        parser.error('--resume needs --outfile or --database')
     
     scraper = ReviewListScraper(outfile=args.outfile,
                                 start=args.start,
                                 stop=args.stop,
+                                use_async=args.use_async,
+                                max_in_flight=args.max_in_flight,
+                                soup_features=args.parser,
+                                cache=cache_from_args(args),
+                                resume=args.resume,
+                                database_filename=args.database,
+                                incremental_database=args.incremental,
                                 )
     scraper.run()
     
\ No newline at end of file
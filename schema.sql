@@ -14,9 +14,13 @@ create table Bands (
     genre_tokens text,
     themes text,
     themes_tokens text,
-    comment text
+    comment text,
+    review_count integer not null default 0 /* number of rows in Reviews for this band; see insert_basic_info.py */
 );
 
+drop index if exists BandsReviewCount;
+create index BandsReviewCount on Bands(review_count);
+
 drop table if exists Albums;
 create table Albums (
     album_id integer not null,
@@ -152,3 +156,126 @@ create table AlbumLineup (
     foreign key(artist_id) references Artists(artist_id)
 );
 
+drop table if exists HttpValidators;
+create table HttpValidators (
+    url text primary key not null, /* full URL, including query string */
+
+    insert_date text, /* date entry in DB inserted/updated */
+
+    etag text, /* ETag header of the last 200 response */
+    last_modified text /* Last-Modified header of the last 200 response */
+);
+
+drop table if exists ScrapeQueue;
+create table ScrapeQueue (
+    band_id integer primary key not null, /* id into Bands table */
+
+    insert_date text, /* date entry in DB inserted */
+
+    priority real not null default 0, /* higher is scraped sooner; see scrapeQueue.py */
+    priority_date text, /* when priority was last computed */
+    state text not null default 'pending', /* pending, claimed, done, or failed */
+    claimed_date text,
+    lease_owner text, /* worker that claimed the band; see ScrapeQueue.claim */
+    lease_expires text, /* claims past this are handed to other workers */
+    completed_date text, /* when the band's pages were last stored */
+    n_failures integer not null default 0, /* failures since the last success */
+    last_error text,
+
+    foreign key(band_id) references Bands(band_id)
+);
+
+drop index if exists ScrapeQueueStatePriority;
+create index ScrapeQueueStatePriority on ScrapeQueue(state, priority desc);
+
+drop table if exists DeadLetters;
+create table DeadLetters (
+    band_id integer not null, /* id into Bands table */
+    endpoint text not null, /* band_page, read_more, recommendations, discography, or band; see deadLetters.py */
+
+    insert_date text, /* first failure */
+    modified_date text, /* last failure */
+
+    n_attempts integer not null default 1,
+    next_attempt_date text, /* when to retry; null once we've given up */
+    url text,
+    status_code integer, /* HTTP status, if we got a response */
+    error text, /* repr of the exception */
+    traceback text,
+    response blob, /* zlib compressed response body, if we got one */
+
+    primary key (band_id, endpoint),
+    foreign key(band_id) references Bands(band_id)
+);
+
+/* see tokenIndex.py */
+drop table if exists GenreTokens;
+create table GenreTokens (
+    token_id integer primary key not null,
+    token text not null unique
+);
+
+drop table if exists BandGenreTokens;
+create table BandGenreTokens (
+    band_id integer not null, /* id into Bands table */
+    token_id integer not null, /* id into GenreTokens table */
+    count integer not null default 1, /* times the token is in the band's genre_tokens */
+
+    primary key (band_id, token_id),
+    foreign key(band_id) references Bands(band_id),
+    foreign key(token_id) references GenreTokens(token_id)
+);
+
+drop index if exists BandGenreTokensTokenBand;
+create index BandGenreTokensTokenBand on BandGenreTokens(token_id, band_id);
+
+/* see tokenMatrix.py */
+drop table if exists GenreNeighbors;
+create table GenreNeighbors (
+    band_id integer not null, /* id into Bands table */
+    neighbor_id integer not null, /* id into Bands table */
+
+    rank integer not null, /* 0 for the most similar band */
+    score real not null, /* cosine similarity of the bands' TF-IDF weighted genre tokens */
+    insert_date text, /* date entry in DB inserted/updated */
+
+    primary key (band_id, neighbor_id),
+    foreign key(band_id) references Bands(band_id),
+    foreign key(neighbor_id) references Bands(band_id)
+);
+
+/* see themes_tokenizer.py and tokenIndex.py */
+drop table if exists ThemeTokens;
+create table ThemeTokens (
+    token_id integer primary key not null,
+    token text not null unique
+);
+
+drop table if exists BandThemeTokens;
+create table BandThemeTokens (
+    band_id integer not null, /* id into Bands table */
+    token_id integer not null, /* id into ThemeTokens table */
+    count integer not null default 1, /* times the token is in the band's themes_tokens */
+
+    primary key (band_id, token_id),
+    foreign key(band_id) references Bands(band_id),
+    foreign key(token_id) references ThemeTokens(token_id)
+);
+
+drop index if exists BandThemeTokensTokenBand;
+create index BandThemeTokensTokenBand on BandThemeTokens(token_id, band_id);
+
+/* see tokenMatrix.py */
+drop table if exists ThemeNeighbors;
+create table ThemeNeighbors (
+    band_id integer not null, /* id into Bands table */
+    neighbor_id integer not null, /* id into Bands table */
+
+    rank integer not null, /* 0 for the most similar band */
+    score real not null, /* cosine similarity of the bands' TF-IDF weighted themes */
+    insert_date text, /* date entry in DB inserted/updated */
+
+    primary key (band_id, neighbor_id),
+    foreign key(band_id) references Bands(band_id),
+    foreign key(neighbor_id) references Bands(band_id)
+);
@@ -0,0 +1,209 @@
+import math, os, socket
+import logging
+logger = logging.getLogger(__name__)
+
+# Priority = NEVER_SCRAPED_BONUS (if we've never scraped the band page)
+#          + REVIEWS_WEIGHT*log1p(review_count)
+#          + STALENESS_WEIGHT*log1p(days between Bands.modified_date and Bands.insert_date)
+#          - FAILURE_PENALTY*n_failures
+# so unscraped bands go first, then popular bands, and bands whose scraped data is old
+# compared to when we last saw them in the band list.
+NEVER_SCRAPED_BONUS = 10.
+REVIEWS_WEIGHT = 1.
+STALENESS_WEIGHT = 0.5
+FAILURE_PENALTY = 2.
+
+# after this many failures a band is left alone until it's requeued by hand
+MAX_FAILURES = 3
+
+# seconds a claim is good for, unless the worker renews it with .heartbeat()
+LEASE_SECONDS = 600
+
+PRIORITY_SQL = f"""
+    {NEVER_SCRAPED_BONUS}*(Bands.modified_date is null)
+    + {REVIEWS_WEIGHT}*log1p(Bands.review_count)
+    + {STALENESS_WEIGHT}*log1p(max(0., coalesce(julianday(Bands.insert_date) - julianday(Bands.modified_date), 0.)))
+    - {FAILURE_PENALTY}*coalesce(ScrapeQueue.n_failures, 0)"""
+
+def default_owner():
+    """
+    Name of this worker, for leases: hostname:pid
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def register_functions(connection):
+    """
+    SQLite isn't always built with the math functions; priorities need log1p
+    """
+    connection.create_function('log1p', 1, math.log1p, deterministic=True)
+
+class ScrapeQueue(object):
+    """
+    Priority queue of bands whose pages need (re)scraping, kept in the ScrapeQueue table.
+
+    Bands go from 'pending' to 'claimed' (.claim()), and then to 'done' (.complete()), or
+    back to 'pending' with a lower priority (.fail(), up to MAX_FAILURES, after which they're
+    'failed').  .refresh() adds new bands and recomputes the priorities of bands whose row
+    in Bands changed since their priority was computed, so it only touches what's new.
+
+    Several workers (processes) can share the queue.  A claim is a lease held by owner
+    until lease_expires; the worker extends it with .heartbeat() while it's busy, and if
+    the worker dies, the band is claimed again by whoever asks after the lease runs out.
+
+    None of the methods commit; do that along with the scraped data.  Commit right after
+    .claim() when other workers share the queue, so they see the claims.
+    """
+    def __init__(self, connection, owner=None, lease_seconds=LEASE_SECONDS):
+        """
+        Params:
+            connection - sqlite3 connection to the database with the Bands and ScrapeQueue tables
+            owner - name of this worker; defaults to hostname:pid
+            lease_seconds - how long a claim (or heartbeat) is good for
+        """
+        self.connection = connection
+        self.owner = default_owner() if owner is None else str(owner)
+        self.lease_seconds = float(lease_seconds)
+        register_functions(self.connection)
+
+    def leaseExpires(self):
+        """
+        The datetime() modifier for when a lease taken now expires
+        """
+        return '+{:f} seconds'.format(self.lease_seconds)
+
+    def refresh(self):
+        """
+        Add bands that aren't in the queue yet, and recompute the priority of (and requeue)
+        bands whose Bands row was updated since their priority was computed, e.g. by
+        InsertBasicInfo after a new band list.  Returns the number of rows touched.
+        """
+        cur = self.connection.cursor()
+        cur.execute('insert into ScrapeQueue (band_id,priority,state,n_failures,priority_date,insert_date) ' +
+                    f"select band_id,{PRIORITY_SQL},'pending',0,datetime('now'),datetime('now') " +
+                    'from Bands left join ScrapeQueue using (band_id) where ScrapeQueue.band_id is null')
+        n_new = cur.rowcount
+
+        cur.execute('update ScrapeQueue ' +
+                    f"set priority=(select {PRIORITY_SQL} from Bands where Bands.band_id=ScrapeQueue.band_id)," +
+                    "state=case when state='done' then 'pending' else state end," +
+                    "priority_date=datetime('now') " +
+                    'where band_id in (select Bands.band_id from Bands join ScrapeQueue using (band_id) ' +
+                    'where Bands.insert_date > ScrapeQueue.priority_date)')
+        n_updated = cur.rowcount
+
+        logger.info('Added %d bands to the scrape queue and reprioritized %d', n_new, n_updated)
+        return n_new + n_updated
+
+    def countPending(self):
+        return self.connection.execute("select count(*) from ScrapeQueue where state='pending'").fetchone()[0]
+
+    def claim(self, n=1):
+        """
+        Claim the n bands with the highest priority that are pending, or whose lease has
+        expired (e.g. their worker died).  Returns a list of (band_id, band_url).
+
+        The claim is a single UPDATE, so two workers never get the same band.
+        """
+        band_ids = [row[0] for row in self.connection.execute(
+            'update ScrapeQueue ' +
+            "set state='claimed',claimed_date=datetime('now'),lease_owner=?,lease_expires=datetime('now',?) " +
+            'where band_id in (select band_id from ScrapeQueue ' +
+            "where state='pending' or (state='claimed' and " +
+            "(lease_expires is null or lease_expires < datetime('now'))) " +
+            'order by priority desc limit ?) ' +
+            'returning band_id',
+            (self.owner, self.leaseExpires(), int(n)))]
+        if not band_ids:
+            return []
+
+        return self.connection.execute('select ScrapeQueue.band_id,band_url from ScrapeQueue ' +
+                                       'join Bands using (band_id) ' +
+                                       'where ScrapeQueue.band_id in ({}) '.format(','.join('?'*len(band_ids))) +
+                                       'order by priority desc',
+                                       band_ids).fetchall()
+
+    def heartbeat(self, band_ids):
+        """
+        Extend our leases on band_ids.  Returns the number of leases extended; claims that
+        expired and went to another worker are left alone.
+        """
+        cur = self.connection.executemany("update ScrapeQueue set lease_expires=datetime('now',?) " +
+                                          "where band_id=? and state='claimed' and lease_owner=?",
+                                          ((self.leaseExpires(), band_id, self.owner) for band_id in band_ids))
+        return cur.rowcount
+
+    def reclaim(self):
+        """
+        Put bands whose lease expired back in the queue.  Returns the number of bands reclaimed.
+        (.claim() takes expired claims anyway; this is for looking at the queue.)
+        """
+        cur = self.connection.execute("update ScrapeQueue set state='pending',lease_owner=null,lease_expires=null " +
+                                      "where state='claimed' and " +
+                                      "(lease_expires is null or lease_expires < datetime('now'))")
+        return cur.rowcount
+
+    def complete(self, band_ids):
+        """
+        Mark our claimed bands as done and recompute their priority from what we just stored;
+        claims that expired and went to another worker are left alone
+        """
+        self.connection.executemany('update ScrapeQueue ' +
+                                    "set state='done',completed_date=datetime('now'),n_failures=0," +
+                                    'lease_owner=null,lease_expires=null,' +
+                                    'last_error=null,priority_date=datetime(\'now\'),' +
+                                    f'priority=(select {PRIORITY_SQL} from Bands where Bands.band_id=ScrapeQueue.band_id) ' +
+                                    "where band_id=? and state='claimed' and lease_owner=?",
+                                    ((band_id, self.owner) for band_id in band_ids))
+
+    def fail(self, band_id, error=None):
+        """
+        Put a band we claimed back in the queue with a lower priority, or give up on it
+        after MAX_FAILURES failures (unless its claim went to another worker)
+        """
+        self.connection.execute('update ScrapeQueue ' +
+                                f"set n_failures=n_failures+1,last_error=?,priority=priority-{FAILURE_PENALTY}," +
+                                'lease_owner=null,lease_expires=null,' +
+                                f"state=case when n_failures+1 >= {MAX_FAILURES} then 'failed' else 'pending' end " +
+                                "where band_id=? and state='claimed' and lease_owner=?",
+                                (error, band_id, self.owner))
+
+    def release(self, band_ids):
+        """
+        Put bands we claimed back in the queue as they were (e.g. we stopped before getting to them)
+        """
+        self.connection.executemany("update ScrapeQueue set state='pending',lease_owner=null,lease_expires=null " +
+                                    "where band_id=? and state='claimed' and lease_owner=?",
+                                    ((band_id, self.owner) for band_id in band_ids))
+
+    def requeue(self, states=('claimed', 'failed')):
+        """
+        Put every band in one of states back in the queue, e.g. claims left behind by a
+        run that died.  Returns the number of bands requeued.
+        """
+        cur = self.connection.execute("update ScrapeQueue set state='pending',n_failures=0," +
+                                      'lease_owner=null,lease_expires=null ' +
+                                      'where state in ({})'.format(','.join('?'*len(states))),
+                                      tuple(states))
+        return cur.rowcount
+
+    def claims(self):
+        """
+        Return the claimed bands as (band_id, lease_owner, lease_expires)
+        """
+        return self.connection.execute('select band_id,lease_owner,lease_expires from ScrapeQueue ' +
+                                       "where state='claimed' order by lease_expires").fetchall()
+
+    def top(self, n=10):
+        """
+        Return the n pending bands with the highest priority as (band_id, band, priority)
+        """
+        return self.connection.execute('select ScrapeQueue.band_id,band,priority from ScrapeQueue ' +
+                                       'join Bands using (band_id) ' +
+                                       "where state='pending' order by priority desc limit ?",
+                                       (int(n),)).fetchall()
+
+    def stats(self):
+        """
+        Return a dict of state: number of bands
+        """
+        return dict(self.connection.execute('select state,count(*) from ScrapeQueue group by state'))
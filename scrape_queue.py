@@ -0,0 +1,73 @@
+"""
+Look at and tend the band page scrape queue (see scrapeQueue.py and band_page_scraper.py --queue)
+"""
+import argparse
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+from scrapeQueue import ScrapeQueue
+from utils import *
+
+def refresh(queue, args):
+    n = queue.refresh()
+    print('Refreshed {} bands'.format(n))
+
+def top(queue, args):
+    for band_id, band, priority in queue.top(args.n):
+        print('{:>8.3f}  {:>12}  {}'.format(priority, band_id, band))
+
+def stats(queue, args):
+    for state, count in sorted(queue.stats().items()):
+        print('{:<8} {:>8}'.format(state, count))
+
+def claims(queue, args):
+    for band_id, owner, expires in queue.claims():
+        print('{:>12}  {:<24}  {}'.format(band_id, owner or '', expires or ''))
+
+def reclaim(queue, args):
+    n = queue.reclaim()
+    print('Reclaimed {} bands with expired leases'.format(n))
+
+def requeue(queue, args):
+    n = queue.requeue(args.states)
+    print('Requeued {} bands'.format(n))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look at and tend the band page scrape queue')
+    parser.add_argument('database', type=str,
+                        help='Filename of sqlite3 database; must already exist')
+    parser.add_argument('--logging-level', type=int, default=logging.WARNING,
+                        help="Set the logging level")
+    
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    
+    sub = subparsers.add_parser('refresh', help='Add new bands and recompute priorities of updated bands')
+    sub.set_defaults(function=refresh)
+    
+    sub = subparsers.add_parser('top', help='Show the pending bands with the highest priority')
+    sub.add_argument('n', type=int, nargs='?', default=10,
+                     help='Number of bands to show')
+    sub.set_defaults(function=top)
+    
+    sub = subparsers.add_parser('stats', help='Count the bands in each state')
+    sub.set_defaults(function=stats)
+    
+    sub = subparsers.add_parser('claims', help='Show claimed bands with their lease owner and expiry')
+    sub.set_defaults(function=claims)
+    
+    sub = subparsers.add_parser('reclaim', help='Put claimed bands whose lease expired back in the queue')
+    sub.set_defaults(function=reclaim)
+    
+    sub = subparsers.add_parser('requeue', help='Put claimed (e.g. by a run that died) and failed bands back in the queue')
+    sub.add_argument('--states', type=str, nargs='+', default=['claimed', 'failed'],
+                     help='Requeue bands in these states')
+    sub.set_defaults(function=requeue)
+    
+    args = parser.parse_args()
+    
+    logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
+    
+    with lite.connect(args.database) as connection:
+        args.function(ScrapeQueue(connection), args)
@@ -0,0 +1,92 @@
+import unittest, re
+import logging
+logger = logging.getLogger(__name__)
+
+# Themes that don't tell us anything
+DROP_THEMES = frozenset(['', 'n/a', 'none', 'unknown', 'various', 'various themes', 'various topics',
+                         'misc', 'miscellaneous', 'etc', 'other', 'others', 'more'])
+
+# Same theme, different spelling
+MAP_THEMES = {
+    'anti-christian': 'anti-christianity',
+    'anti christianity': 'anti-christianity',
+    'anti-religious': 'anti-religion',
+    'anti religion': 'anti-religion',
+    'satan': 'satanism',
+    'occult': 'occultism',
+    'the occult': 'occultism',
+    'warfare': 'war',
+    }
+
+class ThemesTokenizer(object):
+    """
+    Tokenize the lyrical themes text of a band page (e.g. "Nature, Paganism (early);
+    Politics (later)") into a list of themes (['nature', 'paganism', 'politics']).
+
+    Unlike genres, each theme is a phrase ('social issues', 'norse mythology'), so the text is
+    only split on the separators (, ; / & and 'and'), not on spaces.
+    """
+    def __init__(self):
+        self.whitespace_regex = re.compile(r'\s+')
+        self.paren_regex = re.compile(r'\(.*?\)|\[.*?\]')
+        self.split_regex = re.compile(r'\s*(?:[,;/&|]|\band\b|\.\.\.|\betc\.)\s*')
+        self.strip_chars = ' .-:"\'!?*'
+
+        # themes text: tokens, for tokenizeCached
+        self.memo = {}
+
+    def tokenizeCached(self, themes_text):
+        """
+        Like tokenize, but remembers the tokens for each themes text; lots of bands share
+        the same themes text.  Don't modify the returned list.
+        """
+        tokens = self.memo.get(themes_text)
+        if tokens is None:
+            tokens = self.memo[themes_text] = self.tokenize(themes_text)
+        return tokens
+
+    def tokenizeMany(self, themes_texts):
+        """
+        Tokenize a bunch of themes texts at once; returns a list of token lists, in the same
+        order.  Each distinct text is only tokenized once (see tokenizeCached).
+        """
+        return [self.tokenizeCached(themes_text) for themes_text in themes_texts]
+
+    def tokenize(self, themes_text):
+        themes_text = self.whitespace_regex.sub(' ', str(themes_text)).strip().lower()
+        if themes_text in DROP_THEMES:
+            # before splitting, since 'n/a' has a '/'
+            return []
+        themes_text = self.paren_regex.sub('', themes_text)
+
+        tokens = []
+        for token in self.split_regex.split(themes_text):
+            token = token.strip(self.strip_chars)
+            token = MAP_THEMES.get(token, token)
+            if token in DROP_THEMES or len(token) == 1:
+                continue
+            if token not in tokens:
+                tokens.append(token)
+        return tokens
+
+class Test(unittest.TestCase):
+    def testSomeExamples(self):
+        example_text_tokens = [('Darkness, Satan & Winter',
+                                ['darkness', 'satanism', 'winter']),
+                               ('Nature, Paganism (early); Politics (later)',
+                                ['nature', 'paganism', 'politics']),
+                               ('Life and Death, Social issues',
+                                ['life', 'death', 'social issues']),
+                               ('Anti-Christian, Hatred, War...',
+                                ['anti-christianity', 'hatred', 'war']),
+                               ('Norse mythology/Vikings, etc.',
+                                ['norse mythology', 'vikings']),
+                               ('N/A', []),
+                               ]
+
+        tokenizer = ThemesTokenizer()
+        for text, ref_tokens in example_text_tokens:
+            self.assertEqual(tokenizer.tokenize(text), ref_tokens, text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import argparse, json
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+import tqdm
+
+from utils import *
+from themesTokenizer import ThemesTokenizer
+from tokenIndex import TokenIndex
+
+def main(database, incremental=False):
+    """
+    Tokenize each distinct lyrical themes text once, then update themes_tokens of the bands
+    whose tokens changed, all in one transaction.  With incremental, only bands without
+    themes_tokens (new bands, and bands whose themes changed when their page was scraped;
+    see band_page_scraper.STORE_RESETS) are tokenized.
+
+    The ThemeTokens/BandThemeTokens index (see tokenIndex.py) is rebuilt too, or with
+    incremental, updated for the bands that were tokenized (and any that were left out of it).
+    """
+    with lite.connect(database) as connection:
+        query = 'select band_id,themes,themes_tokens from Bands where themes is not null'
+        if incremental:
+            query += ' and themes_tokens is null'
+        bands = connection.execute(query).fetchall()
+
+        themes = list({themes for _, themes, _ in bands})
+        logger.info('Going to tokenize %d distinct themes texts for %d bands', len(themes), len(bands))
+
+        tokenizer = ThemesTokenizer()
+        tokens = {text: json.dumps(themes_tokens)
+                  for text, themes_tokens in zip(themes, tokenizer.tokenizeMany(tqdm.tqdm(themes)))}
+
+        updates = [(tokens[text], band_id) for band_id, text, old_tokens in bands
+                   if tokens[text] != old_tokens]
+        logger.info('Updating themes_tokens for %d bands', len(updates))
+        connection.executemany('update Bands set themes_tokens=? where band_id=?', updates)
+
+        band_tokens = {band_id: tokenizer.tokenizeCached(text) for band_id, text, _ in bands}
+        n_indexed = TokenIndex(connection, 'themes').update(band_tokens, incremental=incremental)
+        logger.info('Indexed themes of %d bands', n_indexed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokenize the lyrical themes text for each '
+                                     'band in the database.  This updates the '
+                                     '`themes_tokens` column.')
+    parser.add_argument('database', type=str,
+                        help='Filename of sqlite3 database; must already exist')
+
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only tokenize bands that don't have themes_tokens yet (new bands and "
+                        'bands whose themes changed since)')
+
+    #subparsers?
+    parser.add_argument('--logging-level', type=int, default=logging.WARNING,
+                        help="Set the logging level")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
+
+    main(args.database, incremental=args.incremental)
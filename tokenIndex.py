@@ -0,0 +1,174 @@
+import collections, json
+import logging
+logger = logging.getLogger(__name__)
+
+# name: (vocabulary table, band table, column of Bands with the text, column of Bands with the json token lists)
+INDEXES = {
+    'genre': ('GenreTokens', 'BandGenreTokens', 'genre', 'genre_tokens'),
+    'themes': ('ThemeTokens', 'BandThemeTokens', 'themes', 'themes_tokens'),
+    }
+
+class TokenIndex(object):
+    """
+    Integer coded index of the tokens of each band (the genre tokens from GenreTokenizer, or
+    the themes from ThemesTokenizer),
+    so that "all bands tagged 'atmospheric' and 'black'" is an index lookup instead of a scan
+    of Bands decoding json.
+
+    Tokens are interned in a vocabulary table (token_id, token), and each band's tokens are
+    rows (band_id, token_id, count) of a band table, indexed both ways.  token_ids don't
+    change once a token is in the vocabulary, even if no band uses it anymore.
+
+    None of the methods commit.
+    """
+    def __init__(self, connection, name='genre'):
+        """
+        Params:
+            connection - sqlite3 connection to the database with the Bands table
+            name - which index, one of INDEXES
+        """
+        if name not in INDEXES:
+            raise ValueError('unknown token index {}'.format(name))
+        self.connection = connection
+        self.name = name
+        self.vocabulary_table, self.band_table, self.text_column, self.bands_column = INDEXES[name]
+
+        # (not executescript, which would commit whatever the caller has going)
+        self.connection.execute(f"""
+            create table if not exists {self.vocabulary_table} (
+                token_id integer primary key not null,
+                token text not null unique
+            )""")
+        self.connection.execute(f"""
+            create table if not exists {self.band_table} (
+                band_id integer not null,
+                token_id integer not null,
+                count integer not null default 1,
+                primary key (band_id, token_id)
+            )""")
+        self.connection.execute(f'create index if not exists {self.band_table}TokenBand ' +
+                                f'on {self.band_table}(token_id, band_id)')
+
+        # token: token_id, filled as we go
+        self._token_ids = {}
+
+    def tokenIds(self, tokens, add=False):
+        """
+        Return a dict of token: token_id for tokens.  With add, tokens that aren't in the
+        vocabulary yet are added; otherwise they're left out.
+        """
+        tokens = set(tokens)
+        missing = [token for token in tokens if token not in self._token_ids]
+        if missing and add:
+            self.connection.executemany(f'insert or ignore into {self.vocabulary_table} (token) values (?)',
+                                        ((token,) for token in missing))
+        # sqlite has a limit on the number of parameters in a query, so go in chunks
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            self._token_ids.update(self.connection.execute(
+                f'select token,token_id from {self.vocabulary_table} ' +
+                'where token in ({})'.format(','.join('?'*len(chunk))), chunk))
+        return {token: self._token_ids[token] for token in tokens if token in self._token_ids}
+
+    def setBandTokens(self, band_tokens):
+        """
+        Replace the tokens of some bands.  band_tokens is an iterable of (band_id, list of tokens).
+        Returns the number of bands updated.
+        """
+        band_tokens = [(band_id, collections.Counter(tokens)) for band_id, tokens in band_tokens]
+        token_ids = self.tokenIds({token for _, counts in band_tokens for token in counts}, add=True)
+
+        self.connection.executemany(f'delete from {self.band_table} where band_id=?',
+                                    ((band_id,) for band_id, _ in band_tokens))
+        self.connection.executemany(f'insert into {self.band_table} (band_id,token_id,count) values (?,?,?)',
+                                    ((band_id, token_ids[token], count)
+                                     for band_id, counts in band_tokens for token, count in counts.items()))
+        return len(band_tokens)
+
+    def rebuild(self, band_tokens):
+        """
+        Replace the tokens of every band with band_tokens (an iterable of (band_id, list of tokens))
+        """
+        self.connection.execute(f'delete from {self.band_table}')
+        return self.setBandTokens(band_tokens)
+
+    def update(self, band_tokens, incremental=False):
+        """
+        Index the bands just tokenized; band_tokens is a dict of band_id: list of tokens.
+        Without incremental that's every band, so the index is rebuilt.  With incremental,
+        only those bands are replaced, and bands that are tokenized in Bands but missing from
+        the index (e.g. tokenized before there was an index) are added.
+        """
+        if not incremental:
+            return self.rebuild(band_tokens.items())
+
+        band_tokens = dict(band_tokens)
+        for band_id, tokens in self.connection.execute(
+                f'select band_id,{self.bands_column} from Bands where {self.bands_column} is not null and ' +
+                f'not exists (select 1 from {self.band_table} where {self.band_table}.band_id=Bands.band_id)'):
+            band_tokens.setdefault(band_id, json.loads(tokens))
+        return self.setBandTokens(band_tokens.items())
+
+    def rebuildFromBands(self):
+        """
+        Rebuild the index from the json token lists already in Bands (e.g. after updating
+        the schema of a database that was tokenized before there was an index)
+        """
+        return self.rebuild((band_id, json.loads(tokens)) for band_id, tokens in self.connection.execute(
+            f'select band_id,{self.bands_column} from Bands where {self.bands_column} is not null'))
+
+    def removeBands(self, band_ids):
+        self.connection.executemany(f'delete from {self.band_table} where band_id=?',
+                                    ((band_id,) for band_id in band_ids))
+
+    def bands(self, all_tokens=(), any_tokens=()):
+        """
+        Return the sorted list of band_ids of bands with all of all_tokens (AND) and at least
+        one of any_tokens (OR).  Leave one of them empty to only filter on the other.
+        """
+        all_tokens, any_tokens = set(all_tokens), set(any_tokens)
+        if not all_tokens and not any_tokens:
+            raise ValueError('Give all_tokens and/or any_tokens')
+
+        all_ids = list(self.tokenIds(all_tokens).values())
+        any_ids = list(self.tokenIds(any_tokens).values())
+        if len(all_ids) < len(all_tokens) or (any_tokens and not any_ids):
+            # a token nobody has
+            return []
+
+        queries, params = [], []
+        if all_ids:
+            queries.append(f'select band_id from {self.band_table} ' +
+                           'where token_id in ({}) group by band_id having count(*)=?'.format(','.join('?'*len(all_ids))))
+            params += all_ids + [len(all_ids)]
+        if any_ids:
+            queries.append(f'select band_id from {self.band_table} ' +
+                           'where token_id in ({})'.format(','.join('?'*len(any_ids))))
+            params += any_ids
+        query = ' intersect '.join(queries) + ' order by band_id'
+        return [row[0] for row in self.connection.execute(query, params)]
+
+    def bandTokens(self, band_id):
+        """
+        Return the tokens of a band as a dict of token: count
+        """
+        return dict(self.connection.execute(f'select token,count from {self.band_table} ' +
+                                            f'join {self.vocabulary_table} using (token_id) where band_id=?',
+                                            (band_id,)))
+
+    def tokenCounts(self, n=None, band_ids=None):
+        """
+        Return a list of (token, number of bands with it), most common first; only the top n
+        tokens if n is given, and only counting band_ids if they're given
+        """
+        query = (f'select token,count(*) as n_bands from {self.band_table} ' +
+                 f'join {self.vocabulary_table} using (token_id) ')
+        params = []
+        if band_ids is not None:
+            query += 'where band_id in (select value from json_each(?)) '
+            params.append(json.dumps([int(band_id) for band_id in band_ids]))
+        query += 'group by token_id order by n_bands desc,token'
+        if n is not None:
+            query += ' limit ?'
+            params.append(int(n))
+        return self.connection.execute(query, params).fetchall()
@@ -0,0 +1,192 @@
+import json, os
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import scipy.sparse
+
+from tokenIndex import TokenIndex
+
+# index name (see tokenIndex.INDEXES): table for the neighbors found by TokenMatrix.neighbors
+NEIGHBOR_TABLES = {
+    'genre': 'GenreNeighbors',
+    'themes': 'ThemeNeighbors',
+    }
+
+# files of a saved matrix; all but tokens.json are .npy, so they can be memory mapped
+MATRIX_ARRAYS = ('data', 'indices', 'indptr', 'band_ids', 'token_ids', 'idf')
+
+class TokenMatrix(object):
+    """
+    Sparse (CSR) band x token matrix of TF-IDF weights, from a TokenIndex.
+
+    Row i is the band band_ids[i] (band_ids is sorted), column j is the token tokens[j]
+    (token_ids[j] in the vocabulary).  Weights are (1 + log(count))*idf, with the smoothed
+    idf = 1 + log((1 + n_bands)/(1 + n_bands with the token)), and each row has unit length,
+    so the cosine similarity of two bands is the dot product of their rows.
+
+    .save() writes the arrays as .npy files in a directory; .load() memory maps them.
+    """
+    def __init__(self, matrix, band_ids, token_ids, tokens, idf):
+        """
+        Params:
+            matrix - scipy.sparse.csr_matrix, n_bands x n_tokens
+            band_ids - band_id of each row, sorted
+            token_ids - token_id of each column
+            tokens - token of each column
+            idf - idf of each column
+        """
+        self.matrix = matrix
+        self.band_ids = band_ids
+        self.token_ids = token_ids
+        self.tokens = list(tokens)
+        self.idf = idf
+
+    @classmethod
+    def fromIndex(cls, index):
+        """
+        Build the matrix from the band tokens in a TokenIndex
+        """
+        rows = index.connection.execute(f'select band_id,token_id,count from {index.band_table} '
+                                        'order by band_id,token_id').fetchall()
+        entries = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        band_ids, row = np.unique(entries[:,0], return_inverse=True)
+        token_ids, col = np.unique(entries[:,1], return_inverse=True)
+
+        n_bands = len(band_ids)
+        document_frequency = np.bincount(col, minlength=len(token_ids))
+        idf = (1. + np.log((1. + n_bands)/(1. + document_frequency))).astype(np.float32)
+        data = (1. + np.log(entries[:,2])).astype(np.float32)*idf[col]
+
+        matrix = scipy.sparse.csr_matrix((data, (row, col)), shape=(n_bands, len(token_ids)), dtype=np.float32)
+        matrix.sort_indices()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        matrix = scipy.sparse.csr_matrix(scipy.sparse.diags(1./np.maximum(norms, 1e-12)) @ matrix, dtype=np.float32)
+
+        vocabulary = dict(index.connection.execute(f'select token_id,token from {index.vocabulary_table}'))
+        tokens = [vocabulary[token_id] for token_id in token_ids.tolist()]
+        logger.info('Built a %d bands x %d tokens matrix with %d entries', n_bands, len(token_ids), matrix.nnz)
+        return cls(matrix, band_ids, token_ids, tokens, idf)
+
+    def save(self, directory):
+        """
+        Save the matrix as .npy files (and tokens.json) in directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'data': self.matrix.data, 'indices': self.matrix.indices, 'indptr': self.matrix.indptr,
+                  'band_ids': self.band_ids, 'token_ids': self.token_ids, 'idf': self.idf}
+        for name in MATRIX_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), arrays[name])
+        with open(os.path.join(directory, 'tokens.json'), 'w') as f:
+            json.dump(self.tokens, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Load a matrix saved with .save(); with mmap, the arrays are memory mapped (read only)
+        instead of read into memory
+        """
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in MATRIX_ARRAYS}
+        with open(os.path.join(directory, 'tokens.json')) as f:
+            tokens = json.load(f)
+        shape = (len(arrays['indptr']) - 1, len(arrays['token_ids']))
+        matrix = scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+        return cls(matrix, arrays['band_ids'], arrays['token_ids'], tokens, arrays['idf'])
+
+    def rowsOf(self, band_ids):
+        """
+        Return the rows of band_ids (which must be in the matrix)
+        """
+        band_ids = np.asarray(band_ids, dtype=np.int64)
+        rows = np.searchsorted(self.band_ids, band_ids)
+        if len(rows) and (rows.max() >= len(self.band_ids) or (self.band_ids[rows] != band_ids).any()):
+            raise ValueError('Some bands have no tokens')
+        return rows
+
+    def distinctRows(self):
+        """
+        Group the rows with the same tokens (and weights).  Returns (rows, groups): the first
+        row of each group, and a list of the sorted rows in each group.
+        """
+        groups = {}
+        indptr, indices, data = self.matrix.indptr, self.matrix.indices, self.matrix.data
+        for row in range(len(self.band_ids)):
+            start, end = indptr[row], indptr[row + 1]
+            groups.setdefault((indices[start:end].tobytes(), data[start:end].tobytes()), []).append(row)
+        groups = list(groups.values())
+        return np.array([group[0] for group in groups], dtype=np.int64), groups
+
+    def neighbors(self, k=10, band_ids=None, batch_size=256):
+        """
+        Find the k bands most similar (by cosine similarity) to each band in band_ids (default
+        all bands in the matrix).  Yields (band_id, array of neighbor band_ids, array of scores),
+        best first; fewer than k if there aren't k bands with any tokens in common.
+
+        Lots of bands have the same tokens, so the distinct rows are scored against each
+        other, batch_size at a time, and the k best come from the best groups of rows.
+        """
+        first_rows, groups = self.distinctRows()
+        group_of_row = np.empty(len(self.band_ids), dtype=np.int64)
+        for i, group in enumerate(groups):
+            group_of_row[group] = i
+
+        rows = np.arange(len(self.band_ids)) if band_ids is None else self.rowsOf(band_ids)
+        # group: rows we want the neighbors of
+        queries = {}
+        for row in rows.tolist():
+            queries.setdefault(int(group_of_row[row]), []).append(row)
+        query_groups = list(queries)
+        logger.info('Finding neighbors of %d bands (%d distinct token sets)', len(rows), len(query_groups))
+
+        distinct = self.matrix[first_rows]
+        # k + 1 groups always have enough rows (the band itself is one of them)
+        n_top = min(k + 1, len(groups))
+        for start in range(0, len(query_groups), batch_size):
+            batch = query_groups[start:start + batch_size]
+            # sparse times dense is n_groups x len(batch) dense
+            scores = np.asarray(distinct @ distinct[batch].toarray().T).T
+
+            top = np.argpartition(-scores, n_top - 1, axis=1)[:,:n_top]
+            for group, group_scores, group_top in zip(batch, scores, top):
+                # best first (equal scores by first row)
+                group_top = group_top[np.lexsort((first_rows[group_top], -group_scores[group_top]))]
+                # only the first k + 1 rows, so that big groups (e.g. plain 'black metal') stay cheap
+                sizes = np.minimum([len(groups[i]) for i in group_top], k + 1)
+                candidates = np.concatenate([groups[i][:size] for i, size in zip(group_top, sizes)])[:k + 1]
+                candidate_scores = np.repeat(group_scores[group_top], sizes)[:k + 1]
+                for row in queries[group]:
+                    # bands with nothing in common aren't neighbors
+                    keep = (candidates != row) & (candidate_scores > 0)
+                    neighbors = candidates[keep][:k]
+                    yield int(self.band_ids[row]), self.band_ids[neighbors], candidate_scores[keep][:k]
+
+    def storeNeighbors(self, connection, table, k=10, band_ids=None, batch_size=256):
+        """
+        Find the neighbors of band_ids (default all bands) and replace their rows in table
+        (see NEIGHBOR_TABLES).  Doesn't commit.  Returns the number of bands.
+        """
+        connection.execute(f"""
+            create table if not exists {table} (
+                band_id integer not null,
+                neighbor_id integer not null,
+                rank integer not null,
+                score real not null,
+                insert_date text,
+                primary key (band_id, neighbor_id)
+            )""")
+        if band_ids is None:
+            connection.execute(f'delete from {table}')
+        else:
+            connection.executemany(f'delete from {table} where band_id=?', ((int(band_id),) for band_id in band_ids))
+
+        n_bands = 0
+        def rows():
+            nonlocal n_bands
+            for band_id, neighbor_ids, scores in self.neighbors(k, band_ids, batch_size):
+                n_bands += 1
+                for rank, (neighbor_id, score) in enumerate(zip(neighbor_ids.tolist(), scores.tolist())):
+                    yield band_id, neighbor_id, rank, score
+        connection.executemany(f'insert into {table} (band_id,neighbor_id,rank,score,insert_date) ' +
+                               "values (?,?,?,?,datetime('now'))", rows())
+        return n_bands
@@ -0,0 +1,58 @@
+import argparse
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+from utils import *
+from tokenIndex import TokenIndex, INDEXES
+
+def bands(index, args):
+    band_ids = index.bands(all_tokens=args.all, any_tokens=args.any)
+    for band_id in band_ids:
+        band, text = index.connection.execute(f'select band,{index.text_column} from Bands where band_id=?',
+                                              (band_id,)).fetchone()
+        print('{:>10} {} ({})'.format(band_id, band, text))
+    logger.info('Found %d bands', len(band_ids))
+
+def counts(index, args):
+    for token, n_bands in index.tokenCounts(args.n):
+        print('{:>8} {}'.format(n_bands, token))
+
+def rebuild(index, args):
+    n_bands = index.rebuildFromBands()
+    logger.info('Indexed the tokens of %d bands', n_bands)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look up bands by their tokens (see genre_tokenizer.py and themes_tokenizer.py) '
+                                     'and count the bands with each token')
+    parser.add_argument('database', type=str,
+                        help='Filename of sqlite3 database; must already exist')
+    parser.add_argument('--index', type=str, default='genre', choices=sorted(INDEXES),
+                        help='Which tokens to look at')
+    parser.add_argument('--logging-level', type=int, default=logging.WARNING,
+                        help="Set the logging level")
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    sub = subparsers.add_parser('bands', help='List the bands with --all of some tokens and/or --any of others')
+    sub.add_argument('--all', type=str, nargs='+', default=[],
+                     help='Bands must have all of these tokens')
+    sub.add_argument('--any', type=str, nargs='+', default=[],
+                     help='Bands must have at least one of these tokens')
+    sub.set_defaults(function=bands)
+
+    sub = subparsers.add_parser('counts', help='Show the number of bands with each token, most common first')
+    sub.add_argument('n', type=int, nargs='?', default=None,
+                     help='Only show the n most common tokens')
+    sub.set_defaults(function=counts)
+
+    sub = subparsers.add_parser('rebuild', help='Rebuild the index from the tokens already in Bands')
+    sub.set_defaults(function=rebuild)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
+
+    with lite.connect(args.database) as connection:
+        args.function(TokenIndex(connection, args.index), args)
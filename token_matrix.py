@@ -0,0 +1,85 @@
+import argparse, time
+import sqlite3 as lite
+import logging
+logger = logging.getLogger(__name__)
+
+from utils import *
+from tokenIndex import TokenIndex, INDEXES
+from tokenMatrix import TokenMatrix, NEIGHBOR_TABLES
+
+def get_matrix(connection, args):
+    if args.matrix:
+        return TokenMatrix.load(args.matrix)
+    return TokenMatrix.fromIndex(TokenIndex(connection, args.index))
+
+def export(connection, args):
+    matrix = TokenMatrix.fromIndex(TokenIndex(connection, args.index))
+    matrix.save(args.directory)
+    logger.info('Saved the matrix to %s', args.directory)
+
+def neighbors(connection, args):
+    matrix = get_matrix(connection, args)
+    band_ids = None
+    if args.missing_similarities:
+        have_similarities = {row[0] for row in connection.execute('select distinct band_id from Similarities')}
+        band_ids = [band_id for band_id in matrix.band_ids.tolist() if band_id not in have_similarities]
+
+    _t = time.time()
+    n_bands = matrix.storeNeighbors(connection, NEIGHBOR_TABLES[args.index], k=args.k,
+                                    band_ids=band_ids, batch_size=args.batch_size)
+    logger.info('Stored the %d nearest neighbors of %d bands in %.1f seconds', args.k, n_bands, time.time() - _t)
+
+def similar(connection, args):
+    matrix = get_matrix(connection, args)
+    _, _, text_column, _ = INDEXES[args.index]
+    for _, neighbor_ids, scores in matrix.neighbors(args.k, band_ids=[args.band_id]):
+        for neighbor_id, score in zip(neighbor_ids.tolist(), scores.tolist()):
+            band, text = connection.execute(f'select band,{text_column} from Bands where band_id=?',
+                                            (neighbor_id,)).fetchone()
+            print('{:>6.3f} {:>10} {} ({})'.format(score, neighbor_id, band, text))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the TF-IDF weighted band x token matrix (see tokenMatrix.py) '
+                                     'and find similar bands with it')
+    parser.add_argument('database', type=str,
+                        help='Filename of sqlite3 database; must already exist and have a token index (see token_index.py)')
+    parser.add_argument('--index', type=str, default='genre', choices=sorted(NEIGHBOR_TABLES),
+                        help='Which tokens to use')
+    parser.add_argument('--logging-level', type=int, default=logging.WARNING,
+                        help="Set the logging level")
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    sub = subparsers.add_parser('export', help='Save the matrix as .npy files that can be memory mapped')
+    sub.add_argument('directory', type=str,
+                     help='Directory to save the matrix in')
+    sub.set_defaults(function=export)
+
+    sub = subparsers.add_parser('neighbors', help='Store the k most similar bands of every band '
+                                '(in GenreNeighbors or ThemeNeighbors)')
+    sub.add_argument('--matrix', type=str, default=None,
+                     help='Use the matrix saved in this directory by export, instead of building it')
+    sub.add_argument('-k', type=int, default=10,
+                     help='Number of neighbors of each band')
+    sub.add_argument('--missing-similarities', action='store_true',
+                     help='Only bands without any Similarities rows')
+    sub.add_argument('--batch-size', type=int, default=256,
+                     help='Score this many bands against all bands at once')
+    sub.set_defaults(function=neighbors)
+
+    sub = subparsers.add_parser('similar', help='Show the k most similar bands of a band')
+    sub.add_argument('band_id', type=int,
+                     help='Band to find similar bands for')
+    sub.add_argument('--matrix', type=str, default=None,
+                     help='Use the matrix saved in this directory by export, instead of building it')
+    sub.add_argument('-k', type=int, default=10,
+                     help='Number of similar bands to show')
+    sub.set_defaults(function=similar)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=tqdmForLogging, level=args.logging_level)
+
+    with lite.connect(args.database) as connection:
+        args.function(connection, args)
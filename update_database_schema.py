@@ -5,6 +5,7 @@ logger = logging.getLogger(__name__)
 
 import tqdm
 
+from insert_basic_info import update_review_counts
 from utils import tqdmForLogging, flatten
 
 def main(database_filename, schema_filename):
@@ -49,6 +50,12 @@ def main(database_filename, schema_filename):
         for renamed_table in renamed_tables:
             logger.debug('Dropping old table %s', renamed_table)
             cur.execute(f'drop table {renamed_table}')
+        
+        # Fill in derived columns that didn't exist in the old schema
+        cur.execute('select * from Bands limit 0')
+        if 'review_count' in map(lambda t: t[0], cur.description):
+            logger.debug('Updating Bands.review_count')
+            update_review_counts(connection)
     
     with lite.connect(database_filename) as connection:
         logger.debug('Vacuuming')
@@ -0,0 +1,112 @@
+import logging
+logger = logging.getLogger(__name__)
+
+class UpsertBatch(object):
+    """
+    Collects rows (dicts of column: value) for several tables and writes them with one
+    executemany per run of rows that have the same columns.
+
+    Each row is upserted: inserted with insert_date=datetime('now') if its key isn't in the
+    table yet, otherwise the given columns (but not insert_date) are updated.  That's the
+    same thing as a SELECT on the key followed by an INSERT or UPDATE, without the SELECT.
+
+    Rows that leave out a NOT NULL column (e.g. a Bands row with just band_id and comment)
+    can only ever update an existing row, and SQLite checks NOT NULL before ON CONFLICT, so
+    those get an UPDATE followed by an INSERT of any rows that are still missing (which
+    fails, just like a plain INSERT would).
+
+    resets clears a column that's derived from another one (e.g. Bands.themes_tokens, from
+    themes) when a row changes the other column, and only then; that's how the tokenizers'
+    --incremental finds what to retokenize.
+
+    The SQL for each (table, columns) is built once and reused, so sqlite3's statement
+    cache only ever has to prepare it once.
+    """
+    def __init__(self, keys, resets=None):
+        """
+        Params:
+            keys - dict of table: tuple of key columns (a primary key or unique index of the
+                   table); .flush() writes the tables in this order
+            resets - dict of table: dict of column: derived column, set to null when an
+                     update changes column
+        """
+        self.keys = dict(keys)
+        self.resets = {table: dict(columns) for table, columns in (resets or {}).items()}
+
+        self._queries = {}
+        self._required = {}
+        self._runs = {table: [] for table in self.keys}
+
+    def __len__(self):
+        return sum(len(rows) for runs in self._runs.values() for _, rows in runs)
+
+    def add(self, table, row):
+        """
+        Queue a row for table
+        """
+        columns = tuple(row)
+        runs = self._runs[table]
+        if runs and runs[-1][0] == columns:
+            runs[-1][1].append(row)
+        else:
+            # new run, so rows for the same key still get written in the order they came
+            runs.append((columns, [row]))
+
+    def extend(self, table, rows):
+        for row in rows:
+            self.add(table, row)
+
+    def requiredColumns(self, connection, table):
+        """
+        Return the set of NOT NULL columns (without defaults) of table
+        """
+        required = self._required.get(table)
+        if required is None:
+            # rows are (cid, name, type, notnull, dflt_value, pk)
+            required = {row[1] for row in connection.execute('pragma table_info({})'.format(table))
+                        if row[3] and row[4] is None}
+            self._required[table] = required
+        return required
+
+    def upsertQueries(self, connection, table, columns):
+        """
+        Return the list of SQL statements that upsert rows with these columns
+        """
+        queries = self._queries.get((table, columns))
+        if queries is None:
+            keys = self.keys[table]
+            updates = [c for c in columns if c not in keys]
+            resets = [(c, derived) for c, derived in self.resets.get(table, {}).items()
+                      if c in updates and derived not in columns]
+            names = ','.join(columns)
+            values = ','.join(':'+c for c in columns)
+            where = ' and '.join('{0}=:{0}'.format(k) for k in keys)
+
+            if self.requiredColumns(connection, table) <= set(columns):
+                queries = ['insert into {} ({},insert_date) values ({},datetime(\'now\')) on conflict({}) '.format(
+                               table, names, values, ','.join(keys))
+                           + ('do update set ' + ','.join(
+                               ['{0}=excluded.{0}'.format(c) for c in updates] +
+                               ['{1}=case when {0}.{2} is excluded.{2} then {0}.{1} end'.format(table, derived, c)
+                                for c, derived in resets])
+                              if updates else 'do nothing')]
+            else:
+                queries = ['insert into {} ({},insert_date) select {},datetime(\'now\') '.format(table, names, values)
+                           + 'where not exists (select 1 from {} where {})'.format(table, where)]
+                if updates:
+                    queries.insert(0, 'update {} set {} where {}'.format(
+                        table, ','.join(['{0}=:{0}'.format(c) for c in updates] +
+                                        ['{1}=case when {0} is :{0} then {1} end'.format(c, derived)
+                                         for c, derived in resets]), where))
+            self._queries[(table, columns)] = queries
+        return queries
+
+    def flush(self, connection):
+        """
+        Write the queued rows with connection, table by table; doesn't commit
+        """
+        for table in self.keys:
+            for columns, rows in self._runs[table]:
+                for query in self.upsertQueries(connection, table, columns):
+                    connection.executemany(query, rows)
+            self._runs[table] = []
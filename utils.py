@@ -1,4 +1,4 @@
-import csv, functools, time
+import csv, functools, re, time
 import logging
 logger = logging.getLogger(__name__)
 
@@ -9,6 +9,8 @@ __all__ = ['get_band_id_from_band_url',
            'get_user_id_from_review_url',
            'get_artist_id_from_artist_url',
            'get_label_id_from_label_url',
+           'get_endpoint_from_url',
+           'get_band_id_from_url',
            'read_csv_to_list_of_dicts',
            'flatten',
            'tqdmForLogging',
@@ -28,6 +30,43 @@ get_user_id_from_review_url = get_band_id_from_band_url
 get_artist_id_from_artist_url = get_band_id_from_band_url
 get_label_id_from_label_url = get_band_id_from_band_url
 
+# (endpoint name, regex on the URL path); first match wins
+ENDPOINT_PATTERNS = (('band_page', re.compile(r'/bands/')),
+                     ('read_more', re.compile(r'/band/read-more/')),
+                     ('recommendations', re.compile(r'/band/ajax-recommendations/')),
+                     ('discography', re.compile(r'/band/discography/')),
+                     ('band_list', re.compile(r'/browse/ajax-letter/')),
+                     ('review_list', re.compile(r'/review/ajax-list-browse/')),
+                     )
+
+def get_endpoint_from_url(url):
+    """
+    Classify a metal-archives URL into one of the endpoints we scrape, e.g.
+    'https://www.metal-archives.com/band/read-more/id/123' -> 'read_more'.
+    Returns 'other' if the URL doesn't match any known endpoint.
+    """
+    for endpoint, regex in ENDPOINT_PATTERNS:
+        if regex.search(url):
+            return endpoint
+    return 'other'
+
+# /band/read-more/id/123, /band/discography/id/123/tab/all, etc.
+band_id_re = re.compile(r'/id/(\d+)')
+
+def get_band_id_from_url(url):
+    """
+    Return the band_id from the URL of any of the band's pages (band page, read more,
+    recommendations, or discography), or None for other URLs.
+    """
+    endpoint = get_endpoint_from_url(url)
+    if endpoint == 'band_page':
+        return get_band_id_from_band_url(url.split('?')[0])
+    if endpoint in ('read_more', 'recommendations', 'discography'):
+        match = band_id_re.search(url)
+        if match is not None:
+            return int(match.group(1))
+    return None
+
 def read_csv_to_list_of_dicts(csv_filename):
     with open(csv_filename, 'r') as f:
         reader = csv.DictReader(f)